@@ -28,11 +28,16 @@ def get_encoder(encoding, input_dim=3,
         from gridencoder import GridEncoder
         encoder = GridEncoder(input_dim=input_dim, num_levels=num_levels, level_dim=level_dim, base_resolution=base_resolution, log2_hashmap_size=log2_hashmap_size, desired_resolution=desired_resolution, gridtype='tiled', align_corners=align_corners)
     
+    elif encoding == 'triplane':
+        # xy, yz and xz hash planes of a 3D input, input_dim is always 3
+        from gridencoder import TriplaneEncoder
+        encoder = TriplaneEncoder(num_levels=num_levels, level_dim=level_dim, base_resolution=base_resolution, log2_hashmap_size=log2_hashmap_size, desired_resolution=desired_resolution, gridtype='hash', align_corners=align_corners)
+    
     elif encoding == 'ash':
         from ashencoder import AshEncoder
         encoder = AshEncoder(input_dim=input_dim, output_dim=16, log2_hashmap_size=log2_hashmap_size, resolution=desired_resolution)
 
     else:
-        raise NotImplementedError('Unknown encoding mode, choose from [None, frequency, spherical_harmonics, hashgrid, tiledgrid]')
+        raise NotImplementedError('Unknown encoding mode, choose from [None, frequency, spherical_harmonics, hashgrid, tiledgrid, triplane]')
 
     return encoder, encoder.output_dim
\ No newline at end of file
@@ -6,10 +6,8 @@ from torch.autograd import Function
 from torch.autograd.function import once_differentiable
 from torch.cuda.amp import custom_bwd, custom_fwd 
 
-try:
-    import _freqencoder as _backend
-except ImportError:
-    from .backend import _backend
+# kernels are loaded on first use, see backend.py
+from .backend import _backend
 
 
 class _freq_encoder(Function):
@@ -19,7 +17,7 @@ class _freq_encoder(Function):
         # inputs: [B, input_dim], float 
         # RETURN: [B, F], float
 
-        if not inputs.is_cuda: inputs = inputs.cuda()
+        if _backend.use_cuda and not inputs.is_cuda: inputs = inputs.cuda()
         inputs = inputs.contiguous()
 
         B, input_dim = inputs.shape # batch size, coord dim
@@ -0,0 +1,31 @@
+''' Pure-PyTorch implementation of the frequency encoder kernels.
+
+freq_encode_forward / freq_encode_backward mirror the bindings in src/bindings.cpp (same arguments, outputs written
+in-place), with the same output layout: [x, sin(x), cos(x), sin(2x), cos(2x), ...], each block of input_dim channels.
+'''
+
+import math
+
+import torch
+
+
+def freq_encode_forward(inputs, B, D, deg, C, outputs):
+    # inputs: [B, D]
+    # outputs: [B, C], C = D + D * 2 * deg
+    freqs = 2 ** torch.arange(deg, dtype=inputs.dtype, device=inputs.device)
+    x = inputs[:, None, :] * freqs[:, None] # [B, deg, D]
+    # cos is written as a phase shifted sin, as in the kernel.
+    feats = torch.stack([torch.sin(x), torch.sin(x + math.pi / 2)], 2) # [B, deg, 2, D]
+    outputs.copy_(torch.cat([inputs, feats.view(B, -1)], -1))
+
+
+def freq_encode_backward(grad, outputs, B, D, deg, C, grad_inputs):
+    # grad: [B, C]
+    # grad_inputs: [B, D]
+    freqs = 2 ** torch.arange(deg, dtype=grad.dtype, device=grad.device)
+    grad_feats = grad[:, D:].view(B, deg, 2, D)
+    feats = outputs[:, D:].view(B, deg, 2, D)
+
+    # d sin / dx = freq * cos, d cos / dx = - freq * sin
+    result = grad_feats[:, :, 0] * feats[:, :, 1] - grad_feats[:, :, 1] * feats[:, :, 0]
+    grad_inputs.copy_(grad[:, :D] + (freqs[:, None] * result).sum(1))
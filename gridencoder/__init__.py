@@ -1 +1 @@
-from .grid import GridEncoder
\ No newline at end of file
+from .grid import GridEncoder, TriplaneEncoder
\ No newline at end of file
@@ -6,10 +6,8 @@ from torch.autograd import Function
 from torch.autograd.function import once_differentiable
 from torch.cuda.amp import custom_bwd, custom_fwd 
 
-try:
-    import _gridencoder as _backend
-except ImportError:
-    from .backend import _backend
+# kernels are loaded on first use, see backend.py
+from .backend import _backend
 
 _gridtype_to_id = {
     'hash': 0,
@@ -152,4 +150,117 @@ class GridEncoder(nn.Module):
 
         #print('outputs', outputs.shape, outputs.dtype, outputs.min().item(), outputs.max().item())
 
+        return outputs
+
+
+class _triplane_encode(Function):
+    @staticmethod
+    @custom_fwd
+    def forward(ctx, inputs, embeddings, offsets, per_level_scale, base_resolution, calc_grad_inputs=False, gridtype=0, align_corners=False):
+        # inputs: [B, 3], float in [0, 1]
+        # embeddings: [3 * sO, C], float, the xy, yz and xz planes
+        # offsets: [L + 1], int, shared by the planes
+        # RETURN: [B, 3 * L * C], float, same as cat([xy, yz, xz]) of three GridEncoders
+
+        inputs = inputs.float().contiguous()
+
+        B = inputs.shape[0] # batch size
+        L = offsets.shape[0] - 1 # level
+        C = embeddings.shape[1] # embedding dim for each level
+        S = np.log2(per_level_scale) # resolution multiplier at each level, apply log2 for later CUDA exp2f
+        H = base_resolution # base resolution
+
+        # manually handle autocast, same as _grid_encode
+        if torch.is_autocast_enabled() and C % 2 == 0:
+            embeddings = embeddings.to(torch.half)
+
+        # written directly in [B, 3, L, C] order, no permute needed.
+        outputs = torch.empty(B, 3 * L * C, device=inputs.device, dtype=embeddings.dtype)
+
+        if calc_grad_inputs:
+            dy_dx = torch.empty(B, 3 * L * 2 * C, device=inputs.device, dtype=embeddings.dtype)
+        else:
+            dy_dx = None
+
+        _backend.triplane_encode_forward(inputs, embeddings, offsets, outputs, B, C, L, S, H, dy_dx, gridtype, align_corners)
+
+        ctx.save_for_backward(inputs, embeddings, offsets, dy_dx)
+        ctx.dims = [B, C, L, S, H, gridtype]
+        ctx.align_corners = align_corners
+
+        return outputs
+
+    @staticmethod
+    @custom_bwd
+    def backward(ctx, grad):
+
+        inputs, embeddings, offsets, dy_dx = ctx.saved_tensors
+        B, C, L, S, H, gridtype = ctx.dims
+        align_corners = ctx.align_corners
+
+        grad = grad.contiguous()
+
+        grad_embeddings = torch.zeros_like(embeddings)
+
+        if dy_dx is not None:
+            grad_inputs = torch.zeros_like(inputs, dtype=embeddings.dtype)
+        else:
+            grad_inputs = None
+
+        _backend.triplane_encode_backward(grad, inputs, embeddings, offsets, grad_embeddings, B, C, L, S, H, dy_dx, grad_inputs, gridtype, align_corners)
+
+        if dy_dx is not None:
+            grad_inputs = grad_inputs.to(inputs.dtype)
+
+        return grad_inputs, grad_embeddings, None, None, None, None, None, None
+
+
+
+triplane_encode = _triplane_encode.apply
+
+
+class TriplaneEncoder(GridEncoder):
+    ''' the xy, yz and xz planes of a 3D input as three 2D GridEncoders, in one kernel launch.
+    The planes share the offsets table, embeddings is [3 * offsets[-1], level_dim] with the planes stacked in that order.
+    '''
+    def __init__(self, num_levels=16, level_dim=2, per_level_scale=2, base_resolution=16, log2_hashmap_size=19, desired_resolution=None, gridtype='hash', align_corners=False):
+        super().__init__(input_dim=2, num_levels=num_levels, level_dim=level_dim, per_level_scale=per_level_scale, base_resolution=base_resolution,
+                         log2_hashmap_size=log2_hashmap_size, desired_resolution=desired_resolution, gridtype=gridtype, align_corners=align_corners)
+
+        self.output_dim = 3 * num_levels * level_dim
+        self.n_params = 3 * self.n_params
+        self.embeddings = nn.Parameter(torch.empty(3 * int(self.offsets[-1]), level_dim))
+
+        self.reset_parameters()
+
+    def __repr__(self):
+        return 'Triplane' + super().__repr__()
+
+    @staticmethod
+    def convert_state_dict(state_dict, prefix, planes):
+        ''' merge the state dict of three 2D GridEncoders (checkpoints before TriplaneEncoder) in place.
+        Args:
+            prefix: key prefix of the TriplaneEncoder, e.g. 'encoder.'
+            planes: key prefixes of the xy, yz and xz GridEncoders, e.g. ['encoder_xy.', 'encoder_yz.', 'encoder_xz.']
+        '''
+        keys = [p + 'embeddings' for p in planes]
+        if prefix + 'embeddings' in state_dict or not all(k in state_dict for k in keys):
+            return
+        state_dict[prefix + 'embeddings'] = torch.cat([state_dict.pop(k) for k in keys], dim=0)
+        state_dict[prefix + 'offsets'] = state_dict[planes[0] + 'offsets']
+        for p in planes:
+            state_dict.pop(p + 'offsets', None)
+
+    def forward(self, inputs, bound=1):
+        # inputs: [..., 3], normalized real world positions in [-bound, bound]
+        # return: [..., 3 * num_levels * level_dim]
+
+        inputs = (inputs + bound) / (2 * bound) # map to [0, 1]
+
+        prefix_shape = list(inputs.shape[:-1])
+        inputs = inputs.view(-1, 3)
+
+        outputs = triplane_encode(inputs, self.embeddings, self.offsets, self.per_level_scale, self.base_resolution, inputs.requires_grad, self.gridtype_id, self.align_corners)
+        outputs = outputs.view(prefix_shape + [self.output_dim])
+
         return outputs
\ No newline at end of file
@@ -0,0 +1,116 @@
+''' Check TriplaneEncoder against three 2D GridEncoders sharing its weights, and the pytorch kernels (torch_backend.py)
+against the CUDA extension.
+Needs a GPU and the compiled extension, run from the repo root:
+    python -m gridencoder.parity
+'''
+
+import numpy as np
+import torch
+
+from . import torch_backend
+from .backend import _backend
+from .grid import GridEncoder, TriplaneEncoder
+
+
+def check(name, a, b, atol=1e-4, rtol=1e-3):
+    a = a.float().cpu()
+    b = b.float().cpu()
+    ok = a.shape == b.shape and torch.allclose(a, b, atol=atol, rtol=rtol)
+    err = (a - b).abs().max().item() if a.shape == b.shape and a.numel() > 0 else float('nan')
+    print(f'[{"OK" if ok else "FAIL"}] {name}: max abs err = {err:.3e}')
+    return ok
+
+
+def run_both(fn, *args, outputs):
+    ''' call fn of both backends on copies of the inputs.
+    Args:
+        args: arguments, tensors are copied to the GPU for CUDA and to the CPU for pytorch.
+        outputs: indices of args that are written in-place.
+    Returns:
+        two lists with the in-place outputs of CUDA and pytorch.
+    '''
+    results = []
+    for backend, device in ((_backend.load(), 'cuda'), (torch_backend, 'cpu')):
+        xs = [x.clone().to(device) if torch.is_tensor(x) else x for x in args]
+        getattr(backend, fn)(*xs)
+        results.append([xs[i] for i in outputs])
+    return results
+
+
+def triplane_vs_grids(device, B=4096, gridtype='hash', align_corners=False, level_dim=1, seed=0):
+    ''' encode the same points with a TriplaneEncoder and with the xy, yz and xz GridEncoders it replaced,
+    the triplane weights being loaded from the three planes through convert_state_dict.
+    Returns:
+        list of (name, triplane, reference) for the outputs, embedding gradients and input gradients.
+    '''
+    torch.manual_seed(seed)
+
+    # the config of NeRFNetwork.encoder_triplane, with a smaller table so the finer levels are hashed.
+    kwargs = dict(num_levels=12, level_dim=level_dim, base_resolution=64, log2_hashmap_size=12, desired_resolution=1024, gridtype=gridtype, align_corners=align_corners)
+    planes = [GridEncoder(input_dim=2, **kwargs).to(device) for _ in torch_backend.TRIPLANE_DIMS]
+    for plane in planes:
+        plane.embeddings.data.uniform_(-1, 1)
+
+    state_dict = {}
+    for name, plane in zip(['xy', 'yz', 'xz'], planes):
+        state_dict.update({f'encoder_{name}.{k}': v for k, v in plane.state_dict().items()})
+    TriplaneEncoder.convert_state_dict(state_dict, 'encoder.', ['encoder_xy.', 'encoder_yz.', 'encoder_xz.'])
+    triplane = TriplaneEncoder(**kwargs).to(device)
+    triplane.load_state_dict({k[len('encoder.'):]: v for k, v in state_dict.items()})
+
+    bound = 2
+    x = (torch.rand(B, 3, device=device) * 2 - 1) * bound
+    grad = torch.randn(B, triplane.output_dim, device=device)
+
+    x_triplane = x.clone().requires_grad_(True)
+    y_triplane = triplane(x_triplane, bound=bound)
+    (y_triplane * grad).sum().backward()
+
+    x_planes = x.clone().requires_grad_(True)
+    y_planes = torch.cat([plane(x_planes[:, dims], bound=bound) for plane, dims in zip(planes, torch_backend.TRIPLANE_DIMS)], -1)
+    (y_planes * grad).sum().backward()
+
+    return [
+        ('outputs', y_triplane.detach(), y_planes.detach()),
+        ('grad_embeddings', triplane.embeddings.grad, torch.cat([plane.embeddings.grad for plane in planes], 0)),
+        ('grad_inputs', x_triplane.grad, x_planes.grad),
+    ]
+
+
+def main(B=4096, seed=0):
+    torch.manual_seed(seed)
+    ok = True
+
+    for gridtype in ('hash', 'tiled'):
+        for align_corners in (False, True):
+            tag = gridtype + ('/align_corners' if align_corners else '')
+
+            # pytorch kernels against CUDA, on a 2D and a 3D grid.
+            for D in (2, 3):
+                encoder = GridEncoder(input_dim=D, num_levels=8, level_dim=2, base_resolution=16, log2_hashmap_size=12, desired_resolution=256, gridtype=gridtype, align_corners=align_corners)
+                embeddings = encoder.embeddings.data.uniform_(-1, 1)
+                L, C, S, H = encoder.num_levels, encoder.level_dim, np.log2(encoder.per_level_scale), encoder.base_resolution
+                inputs = torch.rand(B, D)
+
+                args = [inputs, embeddings, encoder.offsets, torch.empty(L, B, C), B, D, C, L, S, H, torch.empty(B, L * D * C), encoder.gridtype_id, align_corners]
+                c_fwd, t_fwd = run_both('grid_encode_forward', *args, outputs=[3, 10])
+                ok &= check(f'grid_encode_forward/{D}D/{tag}/outputs', c_fwd[0], t_fwd[0])
+                ok &= check(f'grid_encode_forward/{D}D/{tag}/dy_dx', c_fwd[1], t_fwd[1], atol=1e-2)
+
+                args = [torch.randn(L, B, C), inputs, embeddings, encoder.offsets, torch.zeros_like(embeddings), B, D, C, L, S, H, t_fwd[1], torch.zeros(B, D), encoder.gridtype_id, align_corners]
+                c_bwd, t_bwd = run_both('grid_encode_backward', *args, outputs=[4, 12])
+                ok &= check(f'grid_encode_backward/{D}D/{tag}/grad_embeddings', c_bwd[0], t_bwd[0], atol=1e-3)
+                ok &= check(f'grid_encode_backward/{D}D/{tag}/grad_inputs', c_bwd[1], t_bwd[1], atol=1e-2)
+
+            # the fused triplane kernels against three launches of the grid kernels.
+            for level_dim in (1, 2):
+                for name, a, b in triplane_vs_grids('cuda', B, gridtype, align_corners, level_dim, seed):
+                    ok &= check(f'triplane/{tag}/C={level_dim}/{name}', a, b, atol=1e-3)
+
+    print('[INFO] all kernels match.' if ok else '[WARN] some kernels differ, see above.')
+    return ok
+
+
+if __name__ == '__main__':
+    assert _backend.use_cuda, 'parity check needs a GPU and the CUDA extension.'
+    main()
@@ -5,4 +5,6 @@
 PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
     m.def("grid_encode_forward", &grid_encode_forward, "grid_encode_forward (CUDA)");
     m.def("grid_encode_backward", &grid_encode_backward, "grid_encode_backward (CUDA)");
+    m.def("triplane_encode_forward", &triplane_encode_forward, "triplane_encode_forward (CUDA)");
+    m.def("triplane_encode_backward", &triplane_encode_backward, "triplane_encode_backward (CUDA)");
 }
\ No newline at end of file
@@ -477,3 +477,365 @@ void grid_encode_backward(const at::Tensor grad, const at::Tensor inputs, const
     }));
     
 }
+
+
+// ---------------- triplane ----------------
+// the xy, yz and xz planes of a 3D input, encoded in one launch.
+// each plane is a 2D grid with the same offsets table, plane p's embeddings start at p * offsets[L].
+
+// input dim of the i-th (0 or 1) coordinate of plane p: xy = (0, 1), yz = (1, 2), xz = (0, 2)
+static inline __device__ uint32_t triplane_dim(const uint32_t p, const uint32_t i) {
+    return p == 2 ? i * 2 : p + i;
+}
+
+
+template <typename scalar_t, uint32_t C>
+__global__ void kernel_triplane(
+    const float * __restrict__ inputs, 
+    const scalar_t * __restrict__ grid, 
+    const int * __restrict__ offsets, 
+    scalar_t * __restrict__ outputs, 
+    const uint32_t B, const uint32_t L, const float S, const uint32_t H,
+    scalar_t * __restrict__ dy_dx,
+    const uint32_t gridtype,
+    const bool align_corners
+) {
+    const uint32_t b = blockIdx.x * blockDim.x + threadIdx.x;
+    
+    if (b >= B) return;
+
+    const uint32_t level = blockIdx.y;
+    const uint32_t plane = blockIdx.z;
+    
+    // locate
+    grid += ((uint32_t)offsets[L] * plane + (uint32_t)offsets[level]) * C;
+    inputs += b * 3;
+    outputs += b * 3 * L * C + (plane * L + level) * C; // B 3 L C, so no permute is needed
+    if (dy_dx) {
+        dy_dx += b * 3 * L * 2 * C + (plane * L + level) * 2 * C; // B 3 L 2 C
+    }
+
+    const float x[2] = { inputs[triplane_dim(plane, 0)], inputs[triplane_dim(plane, 1)] };
+
+    // if input out of bound, just set output to 0
+    if (x[0] < 0 || x[0] > 1 || x[1] < 0 || x[1] > 1) {
+        #pragma unroll
+        for (uint32_t ch = 0; ch < C; ch++) {
+            outputs[ch] = 0; 
+        }
+        if (dy_dx) {
+            #pragma unroll
+            for (uint32_t ch = 0; ch < 2 * C; ch++) {
+                dy_dx[ch] = 0; 
+            }
+        }
+        return;
+    }
+
+    const uint32_t hashmap_size = offsets[level + 1] - offsets[level];
+    const float scale = exp2f(level * S) * H - 1.0f;
+    const uint32_t resolution = (uint32_t)ceil(scale) + 1;
+    
+    // calculate coordinate
+    float pos[2];
+    uint32_t pos_grid[2];
+
+    #pragma unroll
+    for (uint32_t d = 0; d < 2; d++) {
+        pos[d] = x[d] * scale + (align_corners ? 0.0f : 0.5f);
+        pos_grid[d] = floorf(pos[d]);
+        pos[d] -= (float)pos_grid[d];
+    }
+
+    // interpolate
+    scalar_t results[C] = {0}; // temp results in register
+
+    #pragma unroll
+    for (uint32_t idx = 0; idx < 4; idx++) {
+        float w = 1;
+        uint32_t pos_grid_local[2];
+
+        #pragma unroll
+        for (uint32_t d = 0; d < 2; d++) {
+            if ((idx & (1 << d)) == 0) {
+                w *= 1 - pos[d];
+                pos_grid_local[d] = pos_grid[d];
+            } else {
+                w *= pos[d];
+                pos_grid_local[d] = pos_grid[d] + 1;
+            }
+        }
+
+        uint32_t index = get_grid_index<2, C>(gridtype, align_corners, 0, hashmap_size, resolution, pos_grid_local);
+
+        #pragma unroll
+        for (uint32_t ch = 0; ch < C; ch++) {
+            results[ch] += w * grid[index + ch];
+        }
+    }    
+
+    #pragma unroll
+    for (uint32_t ch = 0; ch < C; ch++) {
+        outputs[ch] = results[ch]; 
+    }
+
+    // prepare dy_dx, w.r.t. the plane's two coordinates
+    if (dy_dx) {
+
+        #pragma unroll
+        for (uint32_t gd = 0; gd < 2; gd++) {
+
+            scalar_t results_grad[C] = {0};
+            const uint32_t d = 1 - gd;
+
+            #pragma unroll
+            for (uint32_t idx = 0; idx < 2; idx++) {
+                float w = scale;
+                uint32_t pos_grid_local[2];
+
+                if (idx == 0) {
+                    w *= 1 - pos[d];
+                    pos_grid_local[d] = pos_grid[d];
+                } else {
+                    w *= pos[d];
+                    pos_grid_local[d] = pos_grid[d] + 1;
+                }
+
+                pos_grid_local[gd] = pos_grid[gd];
+                uint32_t index_left = get_grid_index<2, C>(gridtype, align_corners, 0, hashmap_size, resolution, pos_grid_local);
+                pos_grid_local[gd] = pos_grid[gd] + 1;
+                uint32_t index_right = get_grid_index<2, C>(gridtype, align_corners, 0, hashmap_size, resolution, pos_grid_local);
+
+                #pragma unroll
+                for (uint32_t ch = 0; ch < C; ch++) {
+                    results_grad[ch] += w * (grid[index_right + ch] - grid[index_left + ch]);
+                }
+            }
+
+            #pragma unroll
+            for (uint32_t ch = 0; ch < C; ch++) {
+                dy_dx[gd * C + ch] = results_grad[ch];
+            }
+        }
+    }
+}
+
+
+template <typename scalar_t, uint32_t C, uint32_t N_C>
+__global__ void kernel_triplane_backward(
+    const scalar_t * __restrict__ grad,
+    const float * __restrict__ inputs, 
+    const scalar_t * __restrict__ grid, 
+    const int * __restrict__ offsets, 
+    scalar_t * __restrict__ grad_grid, 
+    const uint32_t B, const uint32_t L, const float S, const uint32_t H,
+    const uint32_t gridtype,
+    const bool align_corners
+) {
+    const uint32_t b = (blockIdx.x * blockDim.x + threadIdx.x) * N_C / C;
+    if (b >= B) return;
+
+    const uint32_t level = blockIdx.y;
+    const uint32_t plane = blockIdx.z;
+    const uint32_t ch = (blockIdx.x * blockDim.x + threadIdx.x) * N_C - b * C;
+
+    // locate
+    grad_grid += ((uint32_t)offsets[L] * plane + (uint32_t)offsets[level]) * C;
+    inputs += b * 3;
+    grad += b * 3 * L * C + (plane * L + level) * C + ch; // B 3 L C
+
+    const float x[2] = { inputs[triplane_dim(plane, 0)], inputs[triplane_dim(plane, 1)] };
+
+    // grad is init as 0, so we simply return.
+    if (x[0] < 0 || x[0] > 1 || x[1] < 0 || x[1] > 1) return;
+
+    const uint32_t hashmap_size = offsets[level + 1] - offsets[level];
+    const float scale = exp2f(level * S) * H - 1.0f;
+    const uint32_t resolution = (uint32_t)ceil(scale) + 1;
+
+    // calculate coordinate
+    float pos[2];
+    uint32_t pos_grid[2];
+
+    #pragma unroll
+    for (uint32_t d = 0; d < 2; d++) {
+        pos[d] = x[d] * scale + (align_corners ? 0.0f : 0.5f);
+        pos_grid[d] = floorf(pos[d]);
+        pos[d] -= (float)pos_grid[d];
+    }
+
+    scalar_t grad_cur[N_C] = {0}; // fetch to register
+    #pragma unroll
+    for (uint32_t c = 0; c < N_C; c++) {
+        grad_cur[c] = grad[c];
+    }
+
+    // interpolate
+    #pragma unroll
+    for (uint32_t idx = 0; idx < 4; idx++) {
+        float w = 1;
+        uint32_t pos_grid_local[2];
+
+        #pragma unroll
+        for (uint32_t d = 0; d < 2; d++) {
+            if ((idx & (1 << d)) == 0) {
+                w *= 1 - pos[d];
+                pos_grid_local[d] = pos_grid[d];
+            } else {
+                w *= pos[d];
+                pos_grid_local[d] = pos_grid[d] + 1;
+            }
+        }
+
+        uint32_t index = get_grid_index<2, C>(gridtype, align_corners, ch, hashmap_size, resolution, pos_grid_local);
+
+        // same as kernel_grid_backward, __half2 atomicAdd when possible
+        if (std::is_same<scalar_t, at::Half>::value && N_C % 2 == 0) {
+            #pragma unroll
+            for (uint32_t c = 0; c < N_C; c += 2) {
+                __half2 v = {(__half)(w * grad_cur[c]), (__half)(w * grad_cur[c + 1])};
+                atomicAdd((__half2*)&grad_grid[index + c], v);
+            }
+        } else {
+            #pragma unroll
+            for (uint32_t c = 0; c < N_C; c++) {
+                atomicAdd(&grad_grid[index + c], w * grad_cur[c]);
+            }
+        }
+    }    
+}
+
+
+template <typename scalar_t, uint32_t C>
+__global__ void kernel_triplane_input_backward(
+    const scalar_t * __restrict__ grad,
+    const scalar_t * __restrict__ dy_dx,  
+    scalar_t * __restrict__ grad_inputs, 
+    uint32_t B, uint32_t L
+) {
+    const uint32_t t = threadIdx.x + blockIdx.x * blockDim.x;
+    if (t >= B * 3) return;
+
+    const uint32_t b = t / 3;
+    const uint32_t d = t - b * 3;
+
+    grad += b * 3 * L * C; // 3 L C
+    dy_dx += b * 3 * L * 2 * C; // 3 L 2 C
+
+    scalar_t result = 0;
+
+    // every input dim is shared by two planes
+    # pragma unroll
+    for (uint32_t p = 0; p < 3; p++) {
+        uint32_t i;
+        if (triplane_dim(p, 0) == d) i = 0;
+        else if (triplane_dim(p, 1) == d) i = 1;
+        else continue;
+
+        for (uint32_t l = 0; l < L; l++) {
+            # pragma unroll
+            for (uint32_t ch = 0; ch < C; ch++) {
+                result += grad[(p * L + l) * C + ch] * dy_dx[((p * L + l) * 2 + i) * C + ch];
+            }
+        }
+    }
+
+    grad_inputs[t] = result;
+}
+
+
+// inputs: [B, 3], float, in [0, 1]
+// embeddings: [3 * sO, C], float, the xy, yz and xz planes
+// offsets: [L + 1], uint32_t, shared by the planes
+// outputs: [B, 3 * L * C], float
+// dy_dx: [B, 3 * L * 2 * C]
+template <typename scalar_t>
+void triplane_encode_forward_cuda(const float *inputs, const scalar_t *embeddings, const int *offsets, scalar_t *outputs, const uint32_t B, const uint32_t C, const uint32_t L, const float S, const uint32_t H, scalar_t *dy_dx, const uint32_t gridtype, const bool align_corners) {
+    static constexpr uint32_t N_THREAD = 512;
+    const dim3 blocks_hashgrid = { div_round_up(B, N_THREAD), L, 3 };
+    switch (C) {
+        case 1: kernel_triplane<scalar_t, 1><<<blocks_hashgrid, N_THREAD>>>(inputs, embeddings, offsets, outputs, B, L, S, H, dy_dx, gridtype, align_corners); break;
+        case 2: kernel_triplane<scalar_t, 2><<<blocks_hashgrid, N_THREAD>>>(inputs, embeddings, offsets, outputs, B, L, S, H, dy_dx, gridtype, align_corners); break;
+        case 4: kernel_triplane<scalar_t, 4><<<blocks_hashgrid, N_THREAD>>>(inputs, embeddings, offsets, outputs, B, L, S, H, dy_dx, gridtype, align_corners); break;
+        case 8: kernel_triplane<scalar_t, 8><<<blocks_hashgrid, N_THREAD>>>(inputs, embeddings, offsets, outputs, B, L, S, H, dy_dx, gridtype, align_corners); break;
+        default: throw std::runtime_error{"TriplaneEncoding: C must be 1, 2, 4, or 8."};
+    }
+}
+
+
+// grad: [B, 3 * L * C], float
+// grad_embeddings: [3 * sO, C]
+// grad_inputs: [B, 3]
+template <typename scalar_t>
+void triplane_encode_backward_cuda(const scalar_t *grad, const float *inputs, const scalar_t *embeddings, const int *offsets, scalar_t *grad_embeddings, const uint32_t B, const uint32_t C, const uint32_t L, const float S, const uint32_t H, scalar_t *dy_dx, scalar_t *grad_inputs, const uint32_t gridtype, const bool align_corners) {
+    static constexpr uint32_t N_THREAD = 256;
+    const uint32_t N_C = std::min(2u, C); // n_features_per_thread
+    const dim3 blocks_hashgrid = { div_round_up(B * C / N_C, N_THREAD), L, 3 };
+    switch (C) {
+        case 1: 
+            kernel_triplane_backward<scalar_t, 1, 1><<<blocks_hashgrid, N_THREAD>>>(grad, inputs, embeddings, offsets, grad_embeddings, B, L, S, H, gridtype, align_corners); 
+            if (dy_dx) kernel_triplane_input_backward<scalar_t, 1><<<div_round_up(B * 3, N_THREAD), N_THREAD>>>(grad, dy_dx, grad_inputs, B, L);
+            break;
+        case 2: 
+            kernel_triplane_backward<scalar_t, 2, 2><<<blocks_hashgrid, N_THREAD>>>(grad, inputs, embeddings, offsets, grad_embeddings, B, L, S, H, gridtype, align_corners);
+            if (dy_dx) kernel_triplane_input_backward<scalar_t, 2><<<div_round_up(B * 3, N_THREAD), N_THREAD>>>(grad, dy_dx, grad_inputs, B, L);
+            break;
+        case 4: 
+            kernel_triplane_backward<scalar_t, 4, 2><<<blocks_hashgrid, N_THREAD>>>(grad, inputs, embeddings, offsets, grad_embeddings, B, L, S, H, gridtype, align_corners);
+            if (dy_dx) kernel_triplane_input_backward<scalar_t, 4><<<div_round_up(B * 3, N_THREAD), N_THREAD>>>(grad, dy_dx, grad_inputs, B, L);
+            break;
+        case 8: 
+            kernel_triplane_backward<scalar_t, 8, 2><<<blocks_hashgrid, N_THREAD>>>(grad, inputs, embeddings, offsets, grad_embeddings, B, L, S, H, gridtype, align_corners);
+            if (dy_dx) kernel_triplane_input_backward<scalar_t, 8><<<div_round_up(B * 3, N_THREAD), N_THREAD>>>(grad, dy_dx, grad_inputs, B, L);
+            break;
+        default: throw std::runtime_error{"TriplaneEncoding: C must be 1, 2, 4, or 8."};
+    }
+}
+
+
+void triplane_encode_forward(const at::Tensor inputs, const at::Tensor embeddings, const at::Tensor offsets, at::Tensor outputs, const uint32_t B, const uint32_t C, const uint32_t L, const float S, const uint32_t H, at::optional<at::Tensor> dy_dx, const uint32_t gridtype, const bool align_corners) {
+    CHECK_CUDA(inputs);
+    CHECK_CUDA(embeddings);
+    CHECK_CUDA(offsets);
+    CHECK_CUDA(outputs);
+    
+    CHECK_CONTIGUOUS(inputs);
+    CHECK_CONTIGUOUS(embeddings);
+    CHECK_CONTIGUOUS(offsets);
+    CHECK_CONTIGUOUS(outputs);
+
+    CHECK_IS_FLOATING(inputs);
+    CHECK_IS_FLOATING(embeddings);
+    CHECK_IS_INT(offsets);
+    CHECK_IS_FLOATING(outputs);
+
+    AT_DISPATCH_FLOATING_TYPES_AND_HALF(
+    embeddings.scalar_type(), "triplane_encode_forward", ([&] {
+        triplane_encode_forward_cuda<scalar_t>(inputs.data_ptr<float>(), embeddings.data_ptr<scalar_t>(), offsets.data_ptr<int>(), outputs.data_ptr<scalar_t>(), B, C, L, S, H, dy_dx.has_value() ? dy_dx.value().data_ptr<scalar_t>() : nullptr, gridtype, align_corners);
+    }));
+}
+
+void triplane_encode_backward(const at::Tensor grad, const at::Tensor inputs, const at::Tensor embeddings, const at::Tensor offsets, at::Tensor grad_embeddings, const uint32_t B, const uint32_t C, const uint32_t L, const float S, const uint32_t H, const at::optional<at::Tensor> dy_dx, at::optional<at::Tensor> grad_inputs, const uint32_t gridtype, const bool align_corners) {
+    CHECK_CUDA(grad);
+    CHECK_CUDA(inputs);
+    CHECK_CUDA(embeddings);
+    CHECK_CUDA(offsets);
+    CHECK_CUDA(grad_embeddings);
+    
+    CHECK_CONTIGUOUS(grad);
+    CHECK_CONTIGUOUS(inputs);
+    CHECK_CONTIGUOUS(embeddings);
+    CHECK_CONTIGUOUS(offsets);
+    CHECK_CONTIGUOUS(grad_embeddings);
+
+    CHECK_IS_FLOATING(grad);
+    CHECK_IS_FLOATING(inputs);
+    CHECK_IS_FLOATING(embeddings);
+    CHECK_IS_INT(offsets);
+    CHECK_IS_FLOATING(grad_embeddings);
+
+    AT_DISPATCH_FLOATING_TYPES_AND_HALF(
+    grad.scalar_type(), "triplane_encode_backward", ([&] {
+        triplane_encode_backward_cuda<scalar_t>(grad.data_ptr<scalar_t>(), inputs.data_ptr<float>(), embeddings.data_ptr<scalar_t>(), offsets.data_ptr<int>(), grad_embeddings.data_ptr<scalar_t>(), B, C, L, S, H, dy_dx.has_value() ? dy_dx.value().data_ptr<scalar_t>() : nullptr, grad_inputs.has_value() ? grad_inputs.value().data_ptr<scalar_t>() : nullptr, gridtype, align_corners);
+    }));
+}
@@ -0,0 +1,159 @@
+''' Pure-PyTorch implementation of the grid encoder kernels.
+
+grid_encode_forward / grid_encode_backward mirror the bindings in src/bindings.cpp (same arguments, outputs written
+in-place), with the same hashing primes, offsets layout and interpolation, so checkpoints trained with the CUDA
+extension load and evaluate unchanged. triplane_encode_forward / triplane_encode_backward run them once per plane.
+'''
+
+import torch
+
+# same primes as fast_hash in src/gridencoder.cu
+PRIMES = [1, 2654435761, 805459861, 3674653429, 2097192037, 1434869437, 2165219737]
+
+# input dims of the xy, yz and xz planes, same as triplane_dim in src/gridencoder.cu
+TRIPLANE_DIMS = [[0, 1], [1, 2], [0, 2]]
+
+
+def _level(inputs, offsets, level, S, H, align_corners):
+    ''' per-level grid constants and the cell of every input.
+    Returns:
+        pos: float, [B, D], position inside the cell.
+        pos_grid: int64, [B, D], lower corner of the cell.
+        hashmap_size, resolution: int
+        scale: float
+    '''
+    hashmap_size = int(offsets[level + 1] - offsets[level])
+    # float32 like the kernel, so the cell boundaries fall at the same inputs.
+    scale = (torch.exp2(torch.tensor(S, dtype=torch.float32) * level) * H - 1.0).item()
+    resolution = int(torch.ceil(torch.tensor(scale, dtype=torch.float32)).item()) + 1
+
+    pos = inputs * scale + (0.0 if align_corners else 0.5)
+    pos_grid = torch.floor(pos)
+    pos = pos - pos_grid
+
+    return pos, pos_grid.long(), hashmap_size, resolution, scale
+
+
+def _grid_index(pos_grid, gridtype, align_corners, hashmap_size, resolution):
+    # pos_grid: int64, [B, D] --> index into the level's [hashmap_size, C] table
+    D = pos_grid.shape[-1]
+
+    stride = 1
+    index = torch.zeros_like(pos_grid[:, 0])
+    for d in range(D):
+        if stride > hashmap_size:
+            break
+        index = index + pos_grid[:, d] * stride
+        stride *= resolution if align_corners else resolution + 1
+
+    # gridtype: 0 == hash, 1 == tiled
+    if gridtype == 0 and stride > hashmap_size:
+        index = torch.zeros_like(index)
+        for d in range(D):
+            index = index ^ ((pos_grid[:, d] * PRIMES[d]) & 0xFFFFFFFF)
+
+    return index % hashmap_size
+
+
+def _corners(D, device):
+    # [2^D, D] bits of every cell corner, in the kernel's order.
+    idx = torch.arange(1 << D, device=device)
+    return torch.stack([(idx >> d) & 1 for d in range(D)], -1)
+
+
+def grid_encode_forward(inputs, embeddings, offsets, outputs, B, D, C, L, S, H, dy_dx, gridtype, align_corners):
+    # inputs: [B, D], float, in [0, 1]
+    # outputs: [L, B, C]
+    # dy_dx: [B, L * D * C]
+
+    # out-of-bound inputs give zero features and gradients.
+    valid = ((inputs >= 0) & (inputs <= 1)).all(-1).to(embeddings.dtype)[:, None]
+    corners = _corners(D, inputs.device)
+
+    if dy_dx is not None:
+        dy_dx = dy_dx.view(B, L, D, C)
+
+    for level in range(L):
+        grid = embeddings[int(offsets[level]):int(offsets[level + 1])]
+        pos, pos_grid, hashmap_size, resolution, scale = _level(inputs, offsets, level, S, H, align_corners)
+
+        results = torch.zeros(B, C, dtype=embeddings.dtype, device=inputs.device)
+        grads = torch.zeros(B, D, C, dtype=embeddings.dtype, device=inputs.device) if dy_dx is not None else None
+
+        for bits in corners:
+            # per-dim linear weights of this corner
+            ws = torch.where(bits.bool(), pos, 1 - pos) # [B, D]
+            index = _grid_index(pos_grid + bits, gridtype, align_corners, hashmap_size, resolution)
+            values = grid[index] # [B, C]
+
+            results += (ws.prod(-1)[:, None] * values).to(results.dtype)
+
+            if grads is not None:
+                # d/dx_d of the multilinear weight: the other dims' weights, signed by the side of the corner along d.
+                for d in range(D):
+                    w = scale * (2 * bits[d] - 1) * torch.cat([ws[:, :d], ws[:, d + 1:]], -1).prod(-1)
+                    grads[:, d] += (w[:, None] * values).to(grads.dtype)
+
+        outputs[level] = results * valid
+        if grads is not None:
+            dy_dx[:, level] = grads * valid[:, :, None]
+
+
+def grid_encode_backward(grad, inputs, embeddings, offsets, grad_embeddings, B, D, C, L, S, H, dy_dx, grad_inputs, gridtype, align_corners):
+    # grad: [L, B, C]
+    # grad_embeddings: [sO, C]
+    # grad_inputs: [B, D]
+
+    valid = ((inputs >= 0) & (inputs <= 1)).all(-1).to(grad.dtype)[:, None]
+    corners = _corners(D, inputs.device)
+
+    for level in range(L):
+        offset = int(offsets[level])
+        pos, pos_grid, hashmap_size, resolution, _ = _level(inputs, offsets, level, S, H, align_corners)
+        grad_level = grad[level] * valid
+
+        for bits in corners:
+            w = torch.where(bits.bool(), pos, 1 - pos).prod(-1)
+            index = _grid_index(pos_grid + bits, gridtype, align_corners, hashmap_size, resolution)
+            grad_embeddings.index_add_(0, offset + index, (w[:, None] * grad_level).to(grad_embeddings.dtype))
+
+    if dy_dx is not None:
+        # [L, B, C] x [B, L, D, C] --> [B, D]
+        grad_inputs.copy_(torch.einsum('lbc,bldc->bd', grad, dy_dx.view(B, L, D, C)))
+
+
+def triplane_encode_forward(inputs, embeddings, offsets, outputs, B, C, L, S, H, dy_dx, gridtype, align_corners):
+    # inputs: [B, 3], float, in [0, 1]
+    # embeddings: [3 * sO, C], the xy, yz and xz planes sharing offsets
+    # outputs: [B, 3 * L * C]
+    # dy_dx: [B, 3 * L * 2 * C]
+    sO = int(offsets[L])
+    outputs = outputs.view(B, 3, L, C)
+    if dy_dx is not None:
+        dy_dx = dy_dx.view(B, 3, L * 2 * C)
+
+    for p, dims in enumerate(TRIPLANE_DIMS):
+        plane_outputs = torch.empty(L, B, C, dtype=outputs.dtype, device=outputs.device)
+        plane_dy_dx = torch.empty(B, L * 2 * C, dtype=outputs.dtype, device=outputs.device) if dy_dx is not None else None
+        grid_encode_forward(inputs[:, dims], embeddings[p * sO:(p + 1) * sO], offsets, plane_outputs, B, 2, C, L, S, H, plane_dy_dx, gridtype, align_corners)
+        outputs[:, p] = plane_outputs.permute(1, 0, 2)
+        if dy_dx is not None:
+            dy_dx[:, p] = plane_dy_dx
+
+
+def triplane_encode_backward(grad, inputs, embeddings, offsets, grad_embeddings, B, C, L, S, H, dy_dx, grad_inputs, gridtype, align_corners):
+    # grad: [B, 3 * L * C]
+    # grad_embeddings: [3 * sO, C]
+    # grad_inputs: [B, 3], init as 0
+    sO = int(offsets[L])
+    grad = grad.view(B, 3, L, C)
+    if dy_dx is not None:
+        dy_dx = dy_dx.view(B, 3, L * 2 * C)
+
+    for p, dims in enumerate(TRIPLANE_DIMS):
+        plane_grad_inputs = torch.zeros(B, 2, dtype=grad_inputs.dtype, device=grad_inputs.device) if dy_dx is not None else None
+        # grad_embeddings[...] is a view, so index_add_ accumulates into the plane's rows.
+        grid_encode_backward(grad[:, p].permute(1, 0, 2), inputs[:, dims], embeddings[p * sO:(p + 1) * sO], offsets, grad_embeddings[p * sO:(p + 1) * sO],
+                             B, 2, C, L, S, H, dy_dx[:, p] if dy_dx is not None else None, plane_grad_inputs, gridtype, align_corners)
+        if dy_dx is not None:
+            grad_inputs[:, dims] += plane_grad_inputs
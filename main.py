@@ -32,12 +32,21 @@ if __name__ == '__main__':
     parser.add_argument('--lr_net', type=float, default=1e-3, help="initial learning rate")
     parser.add_argument('--ckpt', type=str, default='latest')
     parser.add_argument('--num_rays', type=int, default=4096 * 16, help="num rays sampled per image for each training step")
+    parser.add_argument('--batch_size', type=int, default=1, help="num frames per training step, --num_rays are split across them (requires --finetune_lips off)")
     parser.add_argument('--cuda_ray', action='store_true', help="use CUDA raymarching instead of pytorch")
     parser.add_argument('--max_steps', type=int, default=16, help="max num steps sampled per ray (only valid when using --cuda_ray)")
     parser.add_argument('--num_steps', type=int, default=16, help="num steps sampled per ray (only valid when NOT using --cuda_ray)")
     parser.add_argument('--upsample_steps', type=int, default=0, help="num steps up-sampled per ray (only valid when NOT using --cuda_ray)")
     parser.add_argument('--update_extra_interval', type=int, default=16, help="iter interval to update extra status (only valid when using --cuda_ray)")
-    parser.add_argument('--max_ray_batch', type=int, default=4096, help="batch size of rays at inference to avoid OOM (only valid when NOT using --cuda_ray)")
+    parser.add_argument('--grid_update', type=str, default='full', choices=['full', 'partial'], help="density grid update, partial re-evaluates only a random subset of cells plus occupied cells after the first 16 updates (only valid when using --cuda_ray)")
+    parser.add_argument('--grid_update_ratio', type=float, default=0.25, help="fraction of the grid cells drawn at random (and again from occupied cells) in each partial update")
+    parser.add_argument('--max_ray_batch', type=int, default=0, help="max rays per pass of full-frame (eval / test / GUI) renders, larger frames are rendered in tiles to bound the memory, 0 to render the whole frame at once")
+    parser.add_argument('--max_ray_mem', type=float, default=0, help="memory budget (MB) of a full-frame render pass, converted to a ray budget (see NeRFRenderer.ray_bytes), 0 for no limit")
+    parser.add_argument('--static_cache', action='store_true', help="test / infer: keep the last frame and re-render only its dynamic (mouth / eye) region, for a fixed camera and pose")
+    parser.add_argument('--static_thresh', type=float, default=0.05, help="dynamic region: ambient_aud or ambient_eye above this fraction of its max")
+    parser.add_argument('--static_dilate', type=int, default=8, help="dilation (pixels) of the dynamic region")
+    parser.add_argument('--static_refresh', type=int, default=25, help="render the full frame every this many frames")
+    parser.add_argument('--static_pose_tol', type=float, default=1e-4, help="render the full frame when the pose changes by more than this (max abs difference)")
 
     ### loss set
     parser.add_argument('--warmup_step', type=int, default=10000, help="warm up steps")
@@ -62,7 +71,10 @@ if __name__ == '__main__':
 
     ### dataset options
     parser.add_argument('--color_space', type=str, default='srgb', help="Color space, supports (linear, srgb)")
-    parser.add_argument('--preload', type=int, default=0, help="0 means load data from disk on-the-fly, 1 means preload to CPU, 2 means GPU.")
+    parser.add_argument('--preload', type=lambda x: -1 if x == 'mmap' else int(x), default=0, help="0 means load data from disk on-the-fly, 1 means preload to CPU, 2 means GPU, mmap means serve frames from a packed memory-mapped file (packed once on first use).")
+    parser.add_argument('--frame_cache', type=float, default=0, help="with --preload 0, keep decoded frames in an LRU cache of this many GB, 0 to disable")
+    parser.add_argument('--prefetch', type=int, default=0, help="decode and composite this many upcoming frames on a background thread pool, 0 to disable")
+    parser.add_argument('--num_workers', type=int, default=4, help="number of threads used for dataset loading and by --prefetch")
     # (the default value is for the fox dataset)
     parser.add_argument('--bound', type=float, default=1, help="assume the scene is bounded in box[-bound, bound]^3, if > 1, will invoke adaptive ray marching.")
     parser.add_argument('--scale', type=float, default=4, help="scale camera location into box[-bound, bound]^3")
@@ -72,6 +84,10 @@ if __name__ == '__main__':
     parser.add_argument('--density_thresh', type=float, default=10, help="threshold for density grid to be occupied (sigma)")
     parser.add_argument('--density_thresh_torso', type=float, default=0.01, help="threshold for density grid to be occupied (alpha)")
     parser.add_argument('--patch_size', type=int, default=1, help="[experimental] render patches in training, so as to apply LPIPS loss. 1 means disabled, use [64, 32, 16] to enable")
+    parser.add_argument('--sample_mode', type=str, default='uniform', choices=['uniform', 'parsing'], help="how training rays are drawn from a frame, parsing draws them per region with --region_probs")
+    parser.add_argument('--region_probs', type=float, nargs=5, default=[0.2, 0.3, 0.2, 0.1, 0.2], help="probabilities of sampling head, face, lips, eye and background (incl. torso) rays with --sample_mode parsing")
+    parser.add_argument('--error_map', action='store_true', help="sample training rays proportional to a per-frame low-res map of recent training error")
+    parser.add_argument('--error_map_uniform', type=float, default=0.25, help="fraction of uniform probability mixed into --error_map sampling")
 
     parser.add_argument('--init_lips', action='store_true', help="init lips region")
     parser.add_argument('--finetune_lips', action='store_true', help="use LPIPS and landmarks to fine tune lips region")
@@ -231,6 +247,9 @@ if __name__ == '__main__':
             ### evaluate metrics (slow)
             if test_loader.has_gt:
                 trainer.evaluate(test_loader)
+
+            if hasattr(test_loader, 'close'):
+                test_loader.close()
     
     else:
 
@@ -239,7 +258,7 @@ if __name__ == '__main__':
         train_loader = NeRFDataset(opt, device=device, type='train').dataloader()
 
         #len(train_loader)的长度等于数据中所有帧的数量,因为要给每一帧安排一个individual code 
-        assert len(train_loader) < opt.ind_num, f"[ERROR] dataset too many frames: {len(train_loader)}, please increase --ind_num to this number!"
+        assert train_loader._data.poses.shape[0] < opt.ind_num, f"[ERROR] dataset too many frames: {train_loader._data.poses.shape[0]}, please increase --ind_num to this number!"
 
         #这种写法真抽象啊，
         # temp fix: for update_extra_states
@@ -282,4 +301,7 @@ if __name__ == '__main__':
             if test_loader.has_gt:
                 trainer.evaluate(test_loader) # blender has gt, so evaluate it.
 
-            trainer.test(test_loader)
\ No newline at end of file
+            trainer.test(test_loader)
+
+            if hasattr(test_loader, 'close'):
+                test_loader.close()
\ No newline at end of file
@@ -0,0 +1,171 @@
+''' Throughput of NeRFNetwork's per-sample queries, run from the repo root:
+    python -m nerf_triplane.benchmark [--num_samples 262144] [--fp16]
+
+Compares NeRFNetwork.density with the reference implementation below (per-frame conditioning broadcast to every
+sample before sigma_net, one launch per enc_x head), and reports samples/sec and the max difference of the outputs.
+
+With --render, times full-frame inference (run_cuda) with and without the marching workspace instead, and reports the
+allocator calls per frame (GPU only).
+'''
+
+import time
+import argparse
+from types import SimpleNamespace
+
+import torch
+
+from .network import NeRFNetwork
+
+
+def make_opt(**kwargs):
+    # the options NeRFNetwork reads, with main.py's defaults (-O).
+    opt = dict(bound=1, min_near=0.05, density_thresh=10, density_thresh_torso=0.01, exp_eye=True, test_train=False,
+               smooth_lips=False, torso=False, cuda_ray=True, ind_num=10000, ind_dim=4, ind_dim_torso=8, train_camera=False,
+               grid_update='full', grid_update_ratio=0.25, emb=False, asr_model='deepspeech', att=2, unc_loss=1, torso_shrink=0.8)
+    opt.update(kwargs)
+    return SimpleNamespace(**opt)
+
+
+def head(model, name, enc_x):
+    # one of the enc_x heads on its own, as the separate MLPs did.
+    return model.enc_x_heads(enc_x, [name])[name]
+
+
+def density_reference(model, x, enc_a, aud_index, e, enc_x, pre_lip):
+    # NeRFNetwork.density before conditioning was folded into sigma_net's first layer and the enc_x heads were fused.
+    N = enc_x.shape[0]
+    pre_lip = model.expand_cond(pre_lip.reshape(-1, 40), N)
+    enc_a = model.expand_cond(enc_a, N)
+    aud_ch_att = head(model, 'aud_ch_att', enc_x)
+    enc_w = enc_a * aud_ch_att
+    aud_index = model.expand_cond(aud_index, N)
+
+    eye_att = torch.sigmoid(head(model, 'eye_att', enc_x))
+    e = e * eye_att
+    aud_index = aud_index * torch.sigmoid(head(model, 'audio_index_att', enc_x))
+    pre_lip = model.lip_encoder(pre_lip) * torch.sigmoid(head(model, 'lip_att', enc_x))
+
+    h = model.sigma_net(torch.cat([enc_x, enc_w, aud_index, e, pre_lip], dim=-1))
+
+    return {
+        'sigma': torch.exp(h[..., 0]),
+        'geo_feat': h[..., 1:],
+        'ambient_aud': aud_ch_att.norm(dim=-1, keepdim=True),
+        'ambient_eye': eye_att,
+    }
+
+
+def sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def timeit(fn, device, iters=20, warmup=3):
+    for _ in range(warmup):
+        fn()
+    sync(device)
+    t = time.time()
+    for _ in range(iters):
+        fn()
+    sync(device)
+    return (time.time() - t) / iters
+
+
+def count_allocs(device):
+    # allocator calls so far (served from the cache or not)
+    return torch.cuda.memory_stats(device)['allocation.all.allocated'] if device.type == 'cuda' else 0
+
+
+def bench_render(model, device, args):
+    # a dense occupancy grid, so every ray marches through the whole aabb.
+    model.eval()
+    model.testing = True
+    model.density_bitfield.fill_(255)
+
+    H = W = args.resolution
+    N = H * W
+    xs = torch.linspace(-0.25, 0.25, W, device=device).repeat(H)
+    ys = torch.linspace(-0.25, 0.25, H, device=device).repeat_interleave(W)
+    rays_d = torch.nn.functional.normalize(torch.stack([xs, ys, -torch.ones_like(xs)], -1), dim=-1).view(1, N, 3)
+    rays_o = torch.tensor([0, 0, 2.0], device=device).expand(1, N, 3).contiguous()
+    bg_coords = torch.zeros(1, N, 2, device=device)
+    poses = torch.eye(4, device=device)[None]
+
+    kwargs = dict(eye=torch.rand(1, 1, device=device) * 0.3, pre_lip=torch.randn(40, 1, device=device), index=torch.zeros(1, dtype=torch.long, device=device),
+                  enc_a=torch.randn(1, model.audio_dim, device=device), perturb=False, dt_gamma=1/256, max_steps=16, T_thresh=1e-4)
+    aud_index = torch.rand(1, model.audio_index_dim, device=device)
+
+    def step():
+        with torch.no_grad(), torch.cuda.amp.autocast(enabled=args.fp16):
+            return model.render(rays_o, rays_d, None, aud_index, bg_coords, poses, staged=True, **kwargs)
+
+    images = {}
+    for use in (False, True):
+        model.use_workspace = use
+        t = timeit(step, device, iters=args.iters)
+        a = count_allocs(device)
+        for _ in range(args.iters):
+            images[use] = step()['image']
+        allocs = (count_allocs(device) - a) / args.iters
+        print(f'[INFO] workspace={use}: {t * 1000:.2f} ms / frame ({H}x{W}), {allocs:.0f} allocations / frame')
+
+    err = (images[True] - images[False]).abs().max().item()
+    print(f'[INFO] image: max abs diff = {err:.3e}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_samples', type=int, default=2 ** 18)
+    parser.add_argument('--iters', type=int, default=20)
+    parser.add_argument('--fp16', action='store_true')
+    parser.add_argument('--backward', action='store_true', help="time forward + backward instead of forward only")
+    parser.add_argument('--render', action='store_true', help="time full-frame inference with and without the marching workspace")
+    parser.add_argument('--resolution', type=int, default=512, help="frame size of --render")
+    args = parser.parse_args()
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    torch.manual_seed(0)
+
+    model = NeRFNetwork(make_opt()).to(device)
+
+    if args.render:
+        bench_render(model, device, args)
+        return
+    N = args.num_samples
+
+    x = (torch.rand(N, 3, device=device) * 2 - 1) * model.bound
+    enc_a = torch.randn(1, model.audio_dim, device=device)
+    aud_index = torch.rand(1, model.audio_index_dim, device=device)
+    e = torch.rand(1, 1, device=device) * 0.3
+    pre_lip = torch.randn(40, 1, device=device)
+
+    with torch.no_grad():
+        enc_x = model.encode_x(x, bound=model.bound)
+
+    def run(fn):
+        def step():
+            with torch.set_grad_enabled(args.backward), torch.cuda.amp.autocast(enabled=args.fp16):
+                outputs = fn(model, x, enc_a, aud_index, e, enc_x, pre_lip)
+            if args.backward:
+                outputs['sigma'].float().sum().backward()
+            return outputs
+        return step
+
+    results = {}
+    for name, fn in (('reference', density_reference), ('density', NeRFNetwork.density)):
+        t = timeit(run(fn), device, iters=args.iters)
+        results[name] = t
+        print(f'[INFO] {name:>10}: {t * 1000:.2f} ms / {N} samples, {N / t / 1e6:.2f} M samples/sec')
+
+    print(f'[INFO] speedup = {results["reference"] / results["density"]:.2f}x')
+
+    with torch.no_grad(), torch.cuda.amp.autocast(enabled=args.fp16):
+        ref = density_reference(model, x, enc_a, aud_index, e, enc_x, pre_lip)
+        out = model.density(x, enc_a, aud_index, e, enc_x, pre_lip)
+    for key in ('sigma', 'geo_feat'):
+        err = ((ref[key] - out[key]).abs().max() / ref[key].abs().max()).item()
+        print(f'[INFO] {key}: max abs diff = {err:.3e} (relative to max abs value)')
+
+
+if __name__ == '__main__':
+    main()
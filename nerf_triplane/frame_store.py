@@ -0,0 +1,189 @@
+import os
+import cv2
+import tqdm
+import threading
+import numpy as np
+from collections import OrderedDict
+
+from .manifest import sources_mtime
+
+# every record in the packed file starts on this boundary, so fp16 views are aligned.
+_ALIGN = 64
+
+
+def _align(n):
+    return (n + _ALIGN - 1) // _ALIGN * _ALIGN
+
+
+def read_frame(image_path, torso_path, depth_path):
+    # decode one frame from disk, without any normalization.
+    # return: image [H, W, 3] uint8, torso [H, W, 4] uint8, depth [H, W] float32
+    image = cv2.imread(image_path, cv2.IMREAD_UNCHANGED) # [H, W, 3]
+    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+    torso = cv2.imread(torso_path, cv2.IMREAD_UNCHANGED) # [H, W, 4]
+    torso = cv2.cvtColor(torso, cv2.COLOR_BGRA2RGBA)
+
+    depth = np.load(depth_path).astype(np.float32) # [H, W]
+
+    return image, torso, depth
+
+
+def pack_frames(pack_path, img_ids, image_paths, torso_paths, depth_paths, H, W):
+    ''' pack all frames into a single binary file plus an offset index.
+    Args:
+        pack_path: str, output prefix, writes {pack_path}.bin and {pack_path}.npz, each through a tmp file and a rename
+        img_ids: [N], int, frame ids in dataset order
+        image_paths, torso_paths, depth_paths: [N], str
+        H, W: int
+    Layout (per frame, each record aligned to 64 bytes):
+        image uint8 [H, W, 3] | torso uint8 [H, W, 4] | depth float16 [H, W]
+    '''
+
+    N = len(img_ids)
+    # taken before reading, a source touched while packing will invalidate the pack on the next run.
+    mtime = sources_mtime(list(image_paths) + list(torso_paths) + list(depth_paths))
+    sizes = [H * W * 3, H * W * 4, H * W * 2]
+
+    offsets = np.zeros((N, 3), dtype=np.int64)
+    cursor = 0
+    for i in range(N):
+        for k in range(3):
+            offsets[i, k] = cursor
+            cursor += _align(sizes[k])
+
+    tmp_path = pack_path + '.bin.tmp'
+    with open(tmp_path, 'wb') as f:
+        for i in tqdm.tqdm(range(N), desc='Packing frames'):
+            image, torso, depth = read_frame(image_paths[i], torso_paths[i], depth_paths[i])
+            assert image.shape[:2] == (H, W) and torso.shape[:2] == (H, W) and depth.shape[:2] == (H, W), f'[ERROR] frame {img_ids[i]} has a wrong size, expected {H}x{W}'
+            for k, arr in enumerate([image, torso, depth.astype(np.float16)]):
+                f.seek(offsets[i, k])
+                f.write(np.ascontiguousarray(arr).tobytes())
+        # pad the tail so the last record is fully backed by the file.
+        f.truncate(cursor)
+
+    os.replace(tmp_path, pack_path + '.bin')
+
+    # the index records the size of the .bin, so a run killed between the two renames is caught on open.
+    # np.savez appends .npz to paths without it, so write through a file object.
+    tmp_path = pack_path + '.npz.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, img_ids=np.asarray(img_ids, dtype=np.int64), offsets=offsets, H=H, W=W, mtime=mtime, nbytes=cursor)
+    os.replace(tmp_path, pack_path + '.npz')
+
+    print(f'[INFO] packed {N} frames ({cursor / 2**30:.2f} GB) to {pack_path}.bin')
+
+
+class PackedFrames:
+    ''' zero-copy reader of a file written by pack_frames.
+    All accessors return numpy views into a copy-on-write memmap, so only the touched pages are read.
+    '''
+    def __init__(self, pack_path):
+        index = np.load(pack_path + '.npz')
+        self.img_ids = index['img_ids']
+        self.offsets = index['offsets']
+        self.H = int(index['H'])
+        self.W = int(index['W'])
+        # newest source mtime at packing time, 0 for packs written before it was recorded.
+        self.mtime = float(index['mtime']) if 'mtime' in index.files else 0
+        # size of the .bin at packing time, -1 for packs written before it was recorded.
+        self.nbytes = int(index['nbytes']) if 'nbytes' in index.files else -1
+        self.rows = {int(img_id): i for i, img_id in enumerate(self.img_ids)}
+
+        # mode 'c' gives writable views (torch.from_numpy refuses read-only arrays) without touching the file.
+        self.data = np.memmap(pack_path + '.bin', dtype=np.uint8, mode='c')
+
+    @staticmethod
+    def exists(pack_path):
+        return os.path.exists(pack_path + '.bin') and os.path.exists(pack_path + '.npz')
+
+    def covers(self, img_ids, H, W):
+        return self.H == H and self.W == W and all(int(i) in self.rows for i in img_ids)
+
+    def select(self, img_ids):
+        # map frame ids to rows in the packed file.
+        return np.array([self.rows[int(i)] for i in img_ids], dtype=np.int64)
+
+    def image(self, row):
+        o = self.offsets[row, 0]
+        return self.data[o:o + self.H * self.W * 3].reshape(self.H, self.W, 3)
+
+    def torso(self, row):
+        o = self.offsets[row, 1]
+        return self.data[o:o + self.H * self.W * 4].reshape(self.H, self.W, 4)
+
+    def depth(self, row):
+        o = self.offsets[row, 2]
+        return self.data[o:o + self.H * self.W * 2].view(np.float16).reshape(self.H, self.W)
+
+
+def open_packed_frames(pack_path, img_ids, image_paths, torso_paths, depth_paths, H, W):
+    # reuse an existing pack if it covers all requested frames and none of their sources changed since, else (re)pack once.
+    if PackedFrames.exists(pack_path):
+        store = PackedFrames(pack_path)
+        if store.data.size != store.nbytes:
+            print(f'[WARN] {pack_path}.bin does not match its index, repacking...')
+        elif not store.covers(img_ids, H, W):
+            print(f'[WARN] {pack_path}.bin does not cover the requested frames, repacking...')
+        elif sources_mtime(list(image_paths) + list(torso_paths) + list(depth_paths)) > store.mtime:
+            print(f'[INFO] sources changed since {pack_path}.bin was packed, repacking...')
+        else:
+            print(f'[INFO] use packed frames from {pack_path}.bin')
+            return store
+        del store
+
+    pack_frames(pack_path, img_ids, image_paths, torso_paths, depth_paths, H, W)
+    return PackedFrames(pack_path)
+
+
+class FrameCache:
+    ''' LRU cache of decoded frames bounded by a byte budget.
+    Values are dicts of tensors (as returned by NeRFDataset.load_frame), their size is counted from the tensors.
+    Guarded by a lock, since frames may be loaded from prefetch threads.
+    '''
+    def __init__(self, max_bytes):
+        self.max_bytes = int(max_bytes)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def nbytes(value):
+        return sum(v.numel() * v.element_size() for v in value.values())
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value[0]
+
+    def put(self, key, value):
+        size = self.nbytes(value)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                return
+            while self.bytes + size > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.bytes -= evicted
+                self.evictions += 1
+            self.entries[key] = (value, size)
+            self.bytes += size
+
+    def clear_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def report(self):
+        total = max(1, self.hits + self.misses)
+        return f'frame cache: {len(self.entries)} frames, {self.bytes / 2**20:.1f}/{self.max_bytes / 2**20:.1f} MB, hit = {self.hits} ({100 * self.hits / total:.1f}%), miss = {self.misses}, evict = {self.evictions}'
@@ -7,6 +7,7 @@ from scipy.spatial.transform import Rotation as R
 from .utils import *
 
 from .asr import ASR
+from .network import StreamingAudioEncoder
 
 
 class OrbitCamera:
@@ -123,6 +124,8 @@ class NeRFGUI:
         # build asr
         if self.opt.asr:
             self.asr = ASR(opt)
+            # only the newest window of the stream is encoded per frame
+            self.audio_stream = StreamingAudioEncoder(trainer.model)
    
         dpg.create_context()
         self.register_dpg()
@@ -185,7 +188,7 @@ class NeRFGUI:
                     # use the live audio stream
                     data['auds'] = self.asr.get_next_feat()
 
-                outputs = self.trainer.test_gui_with_data(data, self.W, self.H)
+                outputs = self.trainer.test_gui_with_data(data, self.W, self.H, audio_stream=self.audio_stream if self.opt.asr else None)
 
                 # sync local camera pose
                 self.cam.update_pose(data['poses_matrix'][0].detach().cpu().numpy())
@@ -0,0 +1,77 @@
+import os
+import json
+import numpy as np
+
+# bump when the content of the manifest changes, so stale files are rebuilt.
+MANIFEST_VERSION = 2
+
+
+def manifest_key(opt, type, downscale, start_index, end_index):
+    # options that change which frames are used or how the per-frame arrays are derived.
+    return json.dumps({
+        'version': MANIFEST_VERSION,
+        'type': type,
+        'downscale': downscale,
+        'data_range': [start_index, end_index],
+        'part': opt.part,
+        'part2': opt.part2,
+        'exp_eye': opt.exp_eye,
+        'finetune_lips': opt.finetune_lips,
+        'stable_lip': opt.stable_lip,
+        'scale': opt.scale,
+        'offset': list(opt.offset),
+    }, sort_keys=True)
+
+
+def manifest_sources(root_path, transform_paths, img_ids):
+    # files the manifest is derived from, the gt/depth folders are included since missing frames are dropped.
+    sources = list(transform_paths)
+    sources.append(os.path.join(root_path, 'au.csv'))
+    sources.append(os.path.join(root_path, 'gt_imgs'))
+    sources.append(os.path.join(root_path, 'depth_npys'))
+    sources.extend(os.path.join(root_path, 'ori_imgs', str(img_id) + '.lms') for img_id in img_ids)
+    return sources
+
+
+def sources_mtime(sources):
+    return max((os.path.getmtime(p) for p in sources if os.path.exists(p)), default=0)
+
+
+def load_manifest(manifest_path, key, root_path, transform_paths):
+    ''' load the cached per-frame arrays if they are still valid.
+    Returns:
+        dict of numpy arrays, or None if the manifest is missing or stale.
+    '''
+    if not os.path.exists(manifest_path):
+        return None
+
+    try:
+        manifest = dict(np.load(manifest_path))
+    except Exception as e:
+        print(f'[WARN] failed to read {manifest_path}: {e}, rebuilding...')
+        return None
+
+    if str(manifest.pop('key', '')) != key:
+        print(f'[INFO] options changed since {manifest_path} was built, rebuilding...')
+        return None
+
+    sources = manifest_sources(root_path, transform_paths, manifest['lms_ids'].tolist())
+    if sources_mtime(sources) > float(manifest.pop('mtime', 0)):
+        print(f'[INFO] sources changed since {manifest_path} was built, rebuilding...')
+        return None
+
+    print(f'[INFO] use dataset manifest {manifest_path}')
+    return manifest
+
+
+def save_manifest(manifest_path, key, root_path, transform_paths, **arrays):
+    # mtime is taken before writing, a source touched in between will invalidate the manifest on the next run.
+    sources = manifest_sources(root_path, transform_paths, arrays['lms_ids'].tolist())
+    mtime = sources_mtime(sources)
+
+    # write to a temp file and rename, so an interrupted run never leaves a truncated manifest.
+    tmp_path = manifest_path + '.tmp.npz'
+    np.savez(tmp_path, key=np.array(key), mtime=np.array(mtime, dtype=np.float64), **arrays)
+    os.replace(tmp_path, manifest_path)
+
+    print(f'[INFO] saved dataset manifest to {manifest_path}')
@@ -3,6 +3,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 from encoding import get_encoder
+from gridencoder import TriplaneEncoder
 from .renderer import NeRFRenderer
 
 # Audio feature extractor
@@ -29,11 +30,11 @@ class AudioAttNet(nn.Module):
         )
 
     def forward(self, x):
-        # x: [1, seq_len, dim_aud]
-        y = x.permute(0, 2, 1)  # [1, dim_aud, seq_len]
+        # x: [B, seq_len, dim_aud], B = 1 unless a multi-frame batch
+        y = x.permute(0, 2, 1)  # [B, dim_aud, seq_len]
         y = self.attentionConvNet(y) 
-        y = self.attentionNet(y.view(1, self.seq_len)).view(1, self.seq_len, 1)
-        return torch.sum(y * x, dim=1) # [1, dim_aud]
+        y = self.attentionNet(y.view(-1, self.seq_len)).view(-1, self.seq_len, 1)
+        return torch.sum(y * x, dim=1) # [B, dim_aud]
 
 
 # Audio feature extractor
@@ -66,6 +67,46 @@ class AudioNet(nn.Module):
         return x
 
 
+# encode_audio for the live ASR stream
+class StreamingAudioEncoder:
+    ''' ASR.get_next_feat slides its [8, C, 16] attention window by one sub-window per call, so AudioNet outputs of
+    the 7 older sub-windows are kept in a ring buffer and only the newest one is encoded before AudioAttNet.
+    Every window returned by the ASR has to go through the same encoder, call reset() when the stream restarts.
+    '''
+    def __init__(self, model):
+        self.model = model
+        self.reset()
+
+    def reset(self):
+        self.feats = None # [8, 64], AudioNet outputs of the current window
+        self.head = 0 # slot of the oldest sub-window
+
+    def __call__(self, a):
+        # a: [8, C, 16] (or [8, 16] if emb), the latest window of ASR.get_next_feat
+        # return: [1, 64], equals model.encode_audio(a)
+
+        model = self.model
+
+        # no attention window to slide over
+        if model.att == 0:
+            return model.encode_audio(a)
+
+        if model.emb:
+            a = model.embedding(a).transpose(-1, -2).contiguous() # [8, 29, 16]
+
+        if self.feats is None:
+            # first window, encode all sub-windows.
+            self.feats = model.audio_net(a) # [8, 64]
+            self.head = 0
+        else:
+            # the newest sub-window replaces the oldest one.
+            self.feats[self.head] = model.audio_net(a[-1:])[0]
+            self.head = (self.head + 1) % self.feats.shape[0]
+
+        feats = torch.roll(self.feats, -self.head, dims=0) # oldest first
+        return model.audio_att_net(feats.unsqueeze(0)) # [1, 64]
+
+
 class Lipencoder(nn.Module):
     def __init__(self, input_dim, encoding_dim):
         super(Lipencoder, self).__init__()
@@ -97,8 +138,9 @@ class MLP(nn.Module):
 
         self.net = nn.ModuleList(net)
     
-    def forward(self, x):
-        for l in range(self.num_layers):
+    def forward(self, x, start=0):
+        # start > 0: x is the (activated) output of layer start - 1, computed by the caller.
+        for l in range(start, self.num_layers):
             x = self.net[l](x)
             if l != self.num_layers - 1:
                 x = F.relu(x, inplace=True)
@@ -107,6 +149,58 @@ class MLP(nn.Module):
         return x
 
 
+class MultiHeadMLP(nn.Module):
+    ''' 2-layer MLPs (no bias) reading the same input, run as one matmul per layer:
+    the hidden layers are concatenated, and the output layer is block-diagonal.
+    '''
+    def __init__(self, dim_in, heads):
+        # heads: [(name, dim_out, dim_hidden), ...], a contiguous run of them can be evaluated alone.
+        super().__init__()
+        self.dim_in = dim_in
+        self.names = [name for name, _, _ in heads]
+        self.dims_out = [dim_out for _, dim_out, _ in heads]
+        self.dims_hidden = [dim_hidden for _, _, dim_hidden in heads]
+
+        # initialized like separate MLPs
+        nets = [MLP(dim_in, dim_out, dim_hidden, 2) for _, dim_out, dim_hidden in heads]
+        self.weight0 = nn.Parameter(torch.cat([net.net[0].weight.data for net in nets], dim=0)) # [sum(hidden), dim_in]
+        self.weight1 = nn.Parameter(torch.block_diag(*[net.net[1].weight.data for net in nets])) # [sum(out), sum(hidden)]
+        # off-diagonal blocks stay zero and get no gradient
+        self.register_buffer('mask', torch.block_diag(*[torch.ones_like(net.net[1].weight) for net in nets]), persistent=False)
+
+    def span(self, names):
+        i = self.names.index(names[0])
+        j = i + len(names)
+        assert self.names[i:j] == list(names), f'heads {names} are not contiguous in {self.names}'
+        return i, j
+
+    def forward(self, x, names=None):
+        # x: [N, dim_in]
+        # return: {name: [N, dim_out]} of the requested heads (default all)
+        names = self.names if names is None else names
+        i, j = self.span(names)
+        h0, h1 = sum(self.dims_hidden[:i]), sum(self.dims_hidden[:j])
+        o0, o1 = sum(self.dims_out[:i]), sum(self.dims_out[:j])
+
+        h = F.relu(F.linear(x, self.weight0[h0:h1]), inplace=True)
+        out = F.linear(h, self.weight1[o0:o1, h0:h1] * self.mask[o0:o1, h0:h1])
+
+        return dict(zip(names, out.split(self.dims_out[i:j], dim=-1)))
+
+    @staticmethod
+    def convert_state_dict(state_dict, prefix, heads):
+        ''' merge the state dict of separate 2-layer MLPs (checkpoints before MultiHeadMLP) in place.
+        Args:
+            prefix: key prefix of the MultiHeadMLP, e.g. 'enc_x_heads.'
+            heads: key prefixes of the MLPs, in the order of the heads, e.g. ['eye_att_net.', ...]
+        '''
+        keys = [[p + f'net.{l}.weight' for p in heads] for l in range(2)]
+        if prefix + 'weight0' in state_dict or not all(k in state_dict for k in keys[0] + keys[1]):
+            return
+        state_dict[prefix + 'weight0'] = torch.cat([state_dict.pop(k) for k in keys[0]], dim=0)
+        state_dict[prefix + 'weight1'] = torch.block_diag(*[state_dict.pop(k) for k in keys[1]])
+
+
 class NeRFNetwork(NeRFRenderer):
     def __init__(self,
                  opt,
@@ -146,20 +240,16 @@ class NeRFNetwork(NeRFRenderer):
         #三平面哈希编码器
         self.num_levels = 12
         self.level_dim = 1
-        self.encoder_xy, self.in_dim_xy = get_encoder('hashgrid', input_dim=2, num_levels=self.num_levels, level_dim=self.level_dim, base_resolution=64, log2_hashmap_size=14, desired_resolution=512 * self.bound)
-        self.encoder_yz, self.in_dim_yz = get_encoder('hashgrid', input_dim=2, num_levels=self.num_levels, level_dim=self.level_dim, base_resolution=64, log2_hashmap_size=14, desired_resolution=512 * self.bound)
-        self.encoder_xz, self.in_dim_xz = get_encoder('hashgrid', input_dim=2, num_levels=self.num_levels, level_dim=self.level_dim, base_resolution=64, log2_hashmap_size=14, desired_resolution=512 * self.bound)
-
-        self.in_dim = self.in_dim_xy + self.in_dim_yz + self.in_dim_xz
+        # xy, yz and xz planes in one parameter, encoded by a single kernel launch
+        self.encoder_triplane, self.in_dim = get_encoder('triplane', num_levels=self.num_levels, level_dim=self.level_dim, base_resolution=64, log2_hashmap_size=14, desired_resolution=512 * self.bound)
+        # checkpoints before the fused encoder store encoder_xy / encoder_yz / encoder_xz
+        self._register_load_state_dict_pre_hook(self.convert_triplane_state_dict)
 
         ## sigma network
         #输出空间点密度，使用了音频和眨眼信息。输出 1 + geo_feat_dim ，1是密度值，geo_feat_dim是空间隐式特征，用来作为color网络的输入
         self.num_layers = 3
         self.hidden_dim = 64
         self.geo_feat_dim = 64
-        self.eye_att_net = MLP(self.in_dim, 1, 16, 2)
-        self.audio_index_att_net = MLP(self.in_dim, 2, 16, 2)
-        self.lip_att_net = MLP(self.in_dim, self.pre_lip_dim, 32, 2)
         self.eye_dim = 1 if self.exp_eye else 0
         self.sigma_net = MLP(self.in_dim + self.audio_dim + self.audio_index_dim + self.eye_dim + self.pre_lip_dim , 1 + self.geo_feat_dim, self.hidden_dim, self.num_layers)
         self.lip_encoder = Lipencoder(40,20)
@@ -169,8 +259,17 @@ class NeRFNetwork(NeRFRenderer):
         self.encoder_dir, self.in_dim_dir = get_encoder('spherical_harmonics')
         self.color_net = MLP(self.in_dim_dir + self.geo_feat_dim + self.individual_dim, 3, self.hidden_dim_color, self.num_layers_color)
 
-        self.unc_net = MLP(self.in_dim, 1, 32, 2)
-        self.aud_ch_att_net = MLP(self.in_dim, self.audio_dim, 64, 2)
+        # the small MLPs on enc_x (attention of each conditioning, and uncertainty), one matmul per layer for all of them.
+        # the attention heads come first, so density() evaluates them without the uncertainty head.
+        self.enc_x_heads = MultiHeadMLP(self.in_dim, [
+            ('aud_ch_att', self.audio_dim, 64),
+            ('audio_index_att', self.audio_index_dim, 16),
+            ('eye_att', 1, 16),
+            ('lip_att', self.pre_lip_dim, 32),
+            ('unc', 1, 32),
+        ])
+        # checkpoints before the fused heads store aud_ch_att_net / audio_index_att_net / eye_att_net / lip_att_net / unc_net
+        self._register_load_state_dict_pre_hook(self.convert_enc_x_heads_state_dict)
 
         self.testing = False
 
@@ -233,51 +332,93 @@ class NeRFNetwork(NeRFRenderer):
         xy, yz, xz = x[:, :-1], x[:, 1:], torch.cat([x[:,:1], x[:,-1:]], dim=-1)
         return xy, yz, xz
 
+    @staticmethod
+    def convert_triplane_state_dict(state_dict, prefix, *args):
+        TriplaneEncoder.convert_state_dict(state_dict, prefix + 'encoder_triplane.', [prefix + 'encoder_xy.', prefix + 'encoder_yz.', prefix + 'encoder_xz.'])
+
+    @staticmethod
+    def convert_enc_x_heads_state_dict(state_dict, prefix, *args):
+        MultiHeadMLP.convert_state_dict(state_dict, prefix + 'enc_x_heads.', [prefix + name + '_net.' for name in ['aud_ch_att', 'audio_index_att', 'eye_att', 'lip_att', 'unc']])
+
     #对空间坐标进行三平面哈希编码
     def encode_x(self, xyz, bound):
         # x: [N, 3], in [-bound, bound]
-        N, M = xyz.shape
-        xy, yz, xz = self.split_xyz(xyz)
-        feat_xy = self.encoder_xy(xy, bound=bound)
-        feat_yz = self.encoder_yz(yz, bound=bound)
-        feat_xz = self.encoder_xz(xz, bound=bound)
-        
-        return torch.cat([feat_xy, feat_yz, feat_xz], dim=-1)
+        # return: [N, in_dim], xy, yz and xz features concatenated
+        return self.encoder_triplane(xyz, bound=bound)
     
 
     def encode_audio(self, a):
         # a: [1, 29, 16] or [8, 29, 16], audio features from deepspeech
         # if emb, a should be: [1, 16] or [8, 16]
+        # a multi-frame batch adds a leading frame dim: [B, 1/8, 29, 16] or [B, 1/8, 16], and returns [B, 64]
 
         # fix audio traininig
         if a is None: return None
 
+        B = a.shape[0] if a.dim() == (3 if self.emb else 4) else 1
+        a = a.reshape(-1, *a.shape[-(1 if self.emb else 2):])
+
         if self.emb:
             a = self.embedding(a).transpose(-1, -2).contiguous() # [1/8, 29, 16]
 
         enc_a = self.audio_net(a) # [1/8, 64]
 
         if self.att > 0:
-            enc_a = self.audio_att_net(enc_a.unsqueeze(0)) # [1, 64]
+            enc_a = self.audio_att_net(enc_a.view(B, -1, self.audio_dim)) # [B, 64]
             
         return enc_a
 
+
+    def encode_audio_table(self, a, chunk=4096):
+        # a: [N, 29, 16] (or [N, 16] if emb), audio features of a whole utterance
+        # return: [N, 64], equals encode_audio(get_audio_features(a, att, i)) of every frame i,
+        # but AudioNet runs once per frame instead of once per frame and window slot.
+
+        N = a.shape[0]
+
+        # out-of-range window slots are zero features, encoded once as row 0.
+        a = torch.cat([torch.zeros_like(a[:1]), a], dim=0)
+
+        if self.emb:
+            a = self.embedding(a).transpose(-1, -2).contiguous() # [1 + N, 29, 16]
+
+        enc_a = torch.cat([self.audio_net(x) for x in a.split(chunk)], dim=0) # [1 + N, 64]
+
+        if self.att == 0:
+            return enc_a[1:]
+
+        # same windows as get_audio_features: [i - 8, i) for att 1, [i - 4, i + 4) for att 2
+        left = -8 if self.att == 1 else -4
+        ids = torch.arange(N, device=a.device)[:, None] + left + torch.arange(8, device=a.device) # [N, 8]
+        ids = torch.where((ids >= 0) & (ids < N), ids + 1, torch.zeros_like(ids))
+
+        return torch.cat([self.audio_att_net(enc_a[x]) for x in ids.split(chunk)], dim=0) # [N, 64]
+
     
     def predict_uncertainty(self, unc_inp):
         if self.testing or not self.opt.unc_loss:
             unc = torch.zeros_like(unc_inp)
         else:
-            unc = self.unc_net(unc_inp.detach())
+            # detached input, so a separate matmul from the attention heads.
+            unc = self.enc_x_heads(unc_inp.detach(), ['unc'])['unc']
 
         return unc
 
 
+    @staticmethod
+    def expand_cond(cond, N):
+        # per-frame conditioning [1, C] is shared by all samples,
+        # per-sample conditioning [N, C] (gathered for multi-frame batches) is used as is.
+        return cond.expand(N, -1) if cond.shape[0] == 1 else cond
+
+
     def forward(self, x, d, enc_a,aud_index, c, e=None,pre_lip = None):
         # x: [N, 3], in [-bound, bound]
         # d: [N, 3], nomalized in [-1, 1]
         # enc_a: [1, aud_dim]
         # c: [1, ind_dim], individual code
         # e: [1, 1], eye feature
+        # all conditioning may also be per-sample ([N, ...]) for multi-frame batches
         enc_x = self.encode_x(x, bound=self.bound)
 
         sigma_result = self.density(x, enc_a,aud_index, e, enc_x ,pre_lip)
@@ -290,7 +431,7 @@ class NeRFNetwork(NeRFRenderer):
         enc_d = self.encoder_dir(d)
 
         if c is not None:
-            h = torch.cat([enc_d, geo_feat, c.repeat(x.shape[0], 1)], dim=-1)
+            h = torch.cat([enc_d, geo_feat, self.expand_cond(c, x.shape[0])], dim=-1)
         else:
             h = torch.cat([enc_d, geo_feat], dim=-1)
                 
@@ -308,34 +449,42 @@ class NeRFNetwork(NeRFRenderer):
         # print("density---")
         # print(pre_lip)
         # x: [N, 3], in [-bound, bound]
+        # enc_a, aud_index, e, pre_lip: per frame ([1, ...]) or per sample ([N, ...]) for multi-frame batches
         if enc_x is None:
             enc_x = self.encode_x(x, bound=self.bound)
-        pre_lip = pre_lip.squeeze(-1).repeat(enc_x.shape[0], 1)
+        N = enc_x.shape[0]
 
-        enc_a = enc_a.repeat(enc_x.shape[0], 1)
         # aud_ch_att 是 enc_x 经过 aud_ch_att_net 网络后，得到的音频特征权重，aud_ch_att_net纯纯MLP一个
-        aud_ch_att = self.aud_ch_att_net(enc_x)
-        enc_w = enc_a * aud_ch_att
-        
-        aud_index = aud_index.repeat(enc_x.shape[0], 1)
-
         if e is not None:
+            heads = self.enc_x_heads(enc_x, ['aud_ch_att', 'audio_index_att', 'eye_att', 'lip_att'])
+            aud_ch_att = heads['aud_ch_att']
             # e = self.encoder_eye(e)
-            eye_att = torch.sigmoid(self.eye_att_net(enc_x))
-            e = e * eye_att
-            audio_index_att = torch.sigmoid(self.audio_index_att_net(enc_x))
-            aud_index = aud_index * audio_index_att
-            pre_lip = self.lip_encoder(pre_lip)
-            pre_lip_att = torch.sigmoid(self.lip_att_net(enc_x))
-            pre_lip = pre_lip * pre_lip_att
-
-            h = torch.cat([enc_x, enc_w,aud_index, e, pre_lip], dim=-1)
+            eye_att = torch.sigmoid(heads['eye_att'])
+            audio_index_att = torch.sigmoid(heads['audio_index_att'])
+            pre_lip_att = torch.sigmoid(heads['lip_att'])
+            # encoded before broadcasting, so once per frame.
+            pre_lip = self.lip_encoder(pre_lip.reshape(-1, 40)) # [40, 1] or [N, 40, 1] --> [1/N, 20]
 
+            conds = [enc_a, aud_index, e, pre_lip]
+            att = torch.cat([aud_ch_att, audio_index_att, eye_att, pre_lip_att], dim=-1) # [N, 64 + 2 + 1 + 20]
 
         else:
-            h = torch.cat([enc_x, enc_w], dim=-1)
+            aud_ch_att = self.enc_x_heads(enc_x, ['aud_ch_att'])['aud_ch_att']
+            conds = [enc_a]
+            att = aud_ch_att
+
+        # sigma_net 也纯纯 MLP 一个，输入[enc_x, enc_w, e]，输出[sigma,geo_feat]
+        # its input is [enc_x, att * cond], the first layer has no bias, so W [enc_x, att * cond] = W_x enc_x + (W_c * cond) att:
+        # per-frame conditioning scales the columns of W_c once per frame, instead of being broadcast to every sample.
+        weight = self.sigma_net.net[0].weight
+        if all(cond.shape[0] == 1 for cond in conds):
+            cond = torch.cat(conds, dim=-1) # [1, C]
+            h = F.linear(enc_x, weight[:, :self.in_dim]) + F.linear(att, weight[:, self.in_dim:] * cond)
+        else:
+            cond = torch.cat([self.expand_cond(cond, N) for cond in conds], dim=-1) # [N, C]
+            h = F.linear(enc_x, weight[:, :self.in_dim]) + F.linear(att * cond, weight[:, self.in_dim:])
 
-        h = self.sigma_net(h) # sigma_net 也纯纯 MLP 一个，输入[enc_x, enc_w, e]，输出[sigma,geo_feat]
+        h = self.sigma_net(F.relu(h, inplace=True), start=1)
 
         #density网络输出的第一位作为sigma密度值
         #后面的所有位作为空间几何特征，给将来的RGB预测网络使用
@@ -371,9 +520,7 @@ class NeRFNetwork(NeRFRenderer):
         params = [
             {'params': self.audio_net.parameters(), 'lr': lr_net, 'weight_decay': wd}, 
 
-            {'params': self.encoder_xy.parameters(), 'lr': lr},
-            {'params': self.encoder_yz.parameters(), 'lr': lr},
-            {'params': self.encoder_xz.parameters(), 'lr': lr},
+            {'params': self.encoder_triplane.parameters(), 'lr': lr},
             # {'params': self.encoder_xyz.parameters(), 'lr': lr},
 
             {'params': self.sigma_net.parameters(), 'lr': lr_net, 'weight_decay': wd},
@@ -389,8 +536,6 @@ class NeRFNetwork(NeRFRenderer):
             params.append({'params': self.camera_dT, 'lr': 1e-5, 'weight_decay': 0})
             params.append({'params': self.camera_dR, 'lr': 1e-5, 'weight_decay': 0})
 
-        params.append({'params': self.aud_ch_att_net.parameters(), 'lr': lr_net, 'weight_decay': wd})
-        params.append({'params': self.unc_net.parameters(), 'lr': lr_net, 'weight_decay': wd})
-        params.append({'params': self.eye_att_net.parameters(), 'lr': lr_net, 'weight_decay': wd})
+        params.append({'params': self.enc_x_heads.parameters(), 'lr': lr_net, 'weight_decay': wd})
 
         return params
\ No newline at end of file
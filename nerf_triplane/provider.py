@@ -2,8 +2,11 @@ import os
 import cv2
 import glob
 import json
+import time
 import tqdm
 import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from scipy.spatial.transform import Slerp, Rotation
 import matplotlib.pyplot as plt 
 
@@ -14,6 +17,8 @@ import torch.nn.functional as F
 from torch.utils.data import DataLoader
 
 from .utils import get_audio_features, get_rays, get_bg_coords, convert_poses
+from .frame_store import read_frame, open_packed_frames, FrameCache
+from .manifest import manifest_key, load_manifest, save_manifest
 
 # ref: https://github.com/NVlabs/instant-ngp/blob/b76004c8cf478880227401ae763be4c02f80b62f/include/neural-graphics-primitives/nerf_loader.h#L50
 #对旋转矩阵进行转变
@@ -55,6 +60,54 @@ def polygon_area(x, y):
     return 0.5 * np.abs(main_area + correction)
 
 
+def timed(timings, key, fn, *args):
+    # call fn and accumulate its wall time into timings[key]
+    t = time.perf_counter()
+    out = fn(*args)
+    timings[key] = timings.get(key, 0) + time.perf_counter() - t
+    return out
+
+
+def parallel_load(fn, items, num_workers, timings, desc=None):
+    # map fn over items on a thread pool, results are returned in item order.
+    # fn returns (result, {asset: seconds}), the seconds are summed into timings.
+    results = []
+    with ThreadPoolExecutor(max_workers=max(1, num_workers)) as pool:
+        for result, t in tqdm.tqdm(pool.map(fn, items), total=len(items), desc=desc):
+            results.append(result)
+            for k, v in t.items():
+                timings[k] = timings.get(k, 0) + v
+    return results
+
+
+# regions of the parsing sampler, in the order of --region_probs
+REGION_HEAD, REGION_FACE, REGION_LIPS, REGION_EYE, REGION_BG = range(5)
+
+
+def get_region_labels(parsing, face_rect, lips_rect, eye_rect):
+    ''' label each pixel with the region it is sampled from (--sample_mode parsing).
+    Args:
+        parsing: [H, W, 3] uint8 tensor, as written by data_utils/face_parsing and read by cv2
+            (head [255, 0, 0], neck [0, 255, 0], torso [0, 0, 255], background white)
+        face_rect, lips_rect, eye_rect: [xmin, xmax, ymin, ymax], rows then columns
+    Returns:
+        labels: [H, W] uint8 tensor of REGION_*
+    '''
+    labels = torch.full(parsing.shape[:2], REGION_HEAD, dtype=torch.uint8, device=parsing.device)
+
+    # background and torso are known from bc.jpg and the torso image
+    bg = (parsing[..., 0] == 255) & (parsing[..., 1] == 255) & (parsing[..., 2] == 255)
+    torso = (parsing[..., 0] == 0) & (parsing[..., 1] == 0) & (parsing[..., 2] == 255)
+    labels[bg | torso] = REGION_BG
+
+    # finer regions override coarser ones
+    for region, rect in [(REGION_FACE, face_rect), (REGION_EYE, eye_rect), (REGION_LIPS, lips_rect)]:
+        xmin, xmax, ymin, ymax = rect
+        labels[max(0, xmin):xmax, max(0, ymin):ymax] = region
+
+    return labels
+
+
 #可视化相机姿态，debug的时候用到
 def visualize_poses(poses, size=0.1):
     # poses: [B, 4, 4]
@@ -265,6 +318,7 @@ class NeRFDataset_Test:
         if self.auds is not None:
             auds = get_audio_features(self.auds, self.opt.att, index[0]).to(self.device)
             results['auds'] = auds
+            results['aud_ids'] = torch.tensor(index) # frames of the utterance, for Trainer.test's enc_a table
 
         # head pose and bg image may mirror (replay --> <-- --> <--).
         index[0] = self.mirror_index(index[0])
@@ -325,7 +379,7 @@ class NeRFDataset:
         self.type = type # train, val, test
         self.downscale = downscale
         self.root_path = opt.path
-        self.preload = opt.preload # 0 = disk, 1 = cpu, 2 = gpu
+        self.preload = opt.preload # 0 = disk, 1 = cpu, 2 = gpu, -1 = packed memmap
         self.scale = opt.scale # camera radius scale to make sure camera are inside the bounding box.
         self.offset = opt.offset # camera offset
         self.bound = opt.bound # bounding box half length, also used as the radius to random sample poses.
@@ -352,16 +406,18 @@ class NeRFDataset:
                         transform['frames'].extend(tmp_transform['frames'])
         # load train and val split
         elif type == 'trainval':
-            with open(os.path.join(self.root_path, f'transforms_train.json'), 'r') as f:
+            transform_paths = [os.path.join(self.root_path, f'transforms_train.json'), os.path.join(self.root_path, f'transforms_val.json')]
+            with open(transform_paths[0], 'r') as f:
                 transform = json.load(f)
-            with open(os.path.join(self.root_path, f'transforms_val.json'), 'r') as f:
+            with open(transform_paths[1], 'r') as f:
                 transform_val = json.load(f)
             transform['frames'].extend(transform_val['frames'])
         # only load one specified split
         else:
             # no test, use val as test
             _split = 'val' if type == 'test' else type
-            with open(os.path.join(self.root_path, f'transforms_{_split}.json'), 'r') as f:
+            transform_paths = [os.path.join(self.root_path, f'transforms_{_split}.json')]
+            with open(transform_paths[0], 'r') as f:
                 transform = json.load(f)
 
         # load image size
@@ -433,11 +489,7 @@ class NeRFDataset:
             print(f'[INFO] load {self.opt.aud} aud_features: {aud_features.shape}')
             print(f'[INFO] load {self.opt.aud_index_src} aud_indexs: {aud_index.shape}')
 
-        # load action units
-        import pandas as pd
-        au_blink_info=pd.read_csv(os.path.join(self.root_path, 'au.csv'))
-        au_blink = au_blink_info[' AU45_r'].values
-
+        self.img_ids = []
         self.torso_img = []
         self.images = []
         self.depth_images = []
@@ -459,117 +511,81 @@ class NeRFDataset:
         self.eye_area = []
         self.eye_rect = []
 
-        for f in tqdm.tqdm(frames, desc=f'Loading {type} data'):
+        # poses, rects, eye areas and lip landmarks are cached in a manifest next to the data
+        manifest_path = os.path.join(self.root_path, f'manifest_{type}.npz')
+        key = manifest_key(self.opt, type, downscale, self.start_index, self.end_index)
+        manifest = load_manifest(manifest_path, key, self.root_path, transform_paths)
 
-            f_path = os.path.join(self.root_path, 'gt_imgs', str(f['img_id']) + '.jpg')
-            
-            #后缀可能修改为png
-            f_depth_path = os.path.join(self.root_path, 'depth_npys', str(f['img_id']) + '.npy')
-            f_parsing_path = os.path.join(self.root_path, 'parsing', str(f['img_id']) + '.png')
-            if not os.path.exists(f_path) or not os.path.exists(f_depth_path):
-                print('[WARN]', f_path, 'NOT FOUND!')
-                continue
-            
-            pose = np.array(f['transform_matrix'], dtype=np.float32) # [4, 4]
-            pose = nerf_matrix_to_ngp(pose, scale=self.scale, offset=self.offset)
-            self.poses.append(pose)
-            
-            #是否在这将图片和深度图给加载进内存
-            if self.preload > 0:
-                image = cv2.imread(f_path, cv2.IMREAD_UNCHANGED) # [H, W, 3] o [H, W, 4]
-                image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-                image = image.astype(np.float32) / 255 # [H, W, 3/4]
-                
-                # depth_image = cv2.imread(f_depth_path, cv2.IMREAD_UNCHANGED) # [H, W, 1]
-                depth_image = np.load(f_depth_path)
-                parsing_image = cv2.imread(f_parsing_path, cv2.IMREAD_UNCHANGED)
-
-                self.images.append(image)
-                self.depth_images.append(depth_image)
-                self.parsing_images.append(parsing_image)
-            else:
-                self.images.append(f_path)
-                self.depth_images.append(f_depth_path)
-                self.parsing_images.append(f_parsing_path)
+        if manifest is not None:
+            # frames without gt image or depth were already dropped when the manifest was built
+            valid_ids = set(manifest['img_ids'].tolist())
+            frames = [f for f in frames if f['img_id'] in valid_ids]
+        else:
+            # drop frames without gt image or depth
+            valid_frames = []
+            for f in frames:
+                f_path = os.path.join(self.root_path, 'gt_imgs', str(f['img_id']) + '.jpg')
+                #后缀可能修改为png
+                f_depth_path = os.path.join(self.root_path, 'depth_npys', str(f['img_id']) + '.npy')
+                if not os.path.exists(f_path) or not os.path.exists(f_depth_path):
+                    print('[WARN]', f_path, 'NOT FOUND!')
+                    continue
+                valid_frames.append(f)
+            frames = valid_frames
+
+        self.img_ids = [f['img_id'] for f in frames]
+
+        # per-asset loading time, summed over all workers
+        load_timings = {}
+        t_load = time.perf_counter()
+
+        #是否在这将图片和深度图给加载进内存
+        if self.preload > 0:
+            assets = parallel_load(self.read_frame_assets, self.img_ids, self.opt.num_workers, load_timings, desc=f'Loading {type} data')
+            for asset in assets:
+                self.images.append(asset['image'])
+                self.depth_images.append(asset['depth'])
+                self.parsing_images.append(asset['parsing'])
+                self.torso_img.append(asset['torso'])
+        else:
+            for img_id in self.img_ids:
+                self.images.append(os.path.join(self.root_path, 'gt_imgs', str(img_id) + '.jpg'))
+                self.depth_images.append(os.path.join(self.root_path, 'depth_npys', str(img_id) + '.npy'))
+                self.parsing_images.append(os.path.join(self.root_path, 'parsing', str(img_id) + '.png'))
+                self.torso_img.append(os.path.join(self.root_path, 'torso_imgs', str(img_id) + '.png'))
+
+        if manifest is None:
+            # read every needed .lms once (stable_lip also needs the previous frame's)
+            lms_ids = set(self.img_ids)
+            if self.opt.stable_lip:
+                lms_ids.update(max(0, img_id - 1) for img_id in self.img_ids)
+            lms_ids = sorted(lms_ids)
+            lms_table = dict(zip(lms_ids, parallel_load(self.read_lms, lms_ids, self.opt.num_workers, load_timings, desc=f'Loading {type} lms')))
 
-            # load frame-wise bg
-        
-            torso_img_path = os.path.join(self.root_path, 'torso_imgs', str(f['img_id']) + '.png')
+            manifest = self.build_manifest(frames, lms_table)
+            manifest['lms_ids'] = np.array(lms_ids, dtype=np.int64)
+            save_manifest(manifest_path, key, self.root_path, transform_paths, **manifest)
 
-            if self.preload > 0:
-                torso_img = cv2.imread(torso_img_path, cv2.IMREAD_UNCHANGED) # [H, W, 4]
-                torso_img = cv2.cvtColor(torso_img, cv2.COLOR_BGRA2RGBA)
-                torso_img = torso_img.astype(np.float32) / 255 # [H, W, 3/4]
+        print(f'[INFO] loaded {len(frames)} {type} frames in {time.perf_counter() - t_load:.2f}s with {self.opt.num_workers} workers: ' + ', '.join(f'{k} {v:.2f}s' for k, v in load_timings.items()))
 
-                self.torso_img.append(torso_img)
-            else:
-                self.torso_img.append(torso_img_path)
+        self.poses = manifest['poses']
+        self.face_rect = manifest['face_rect'].tolist()
+        self.lhalf_rect = manifest['lhalf_rect'].tolist()
+        self.eye_rect = manifest['eye_rect'].tolist()
+        self.lips_rect = manifest['lips_rect'].tolist()
+        if self.opt.exp_eye:
+            self.eye_area = manifest['eye_area']
+        if self.opt.stable_lip:
+            self.pre_lip_lms = manifest['pre_lip_lms']
 
-            # find the corresponding audio to the image frame
-            if not self.opt.asr and self.opt.aud == '':
-                # print(aud_features.shape)
-                # print(aud_index.shape)
-                # exit()
+        # find the corresponding audio to the image frame
+        if not self.opt.asr and self.opt.aud == '':
+            for f in frames:
                 aud = aud_features[min(f['aud_id'], aud_features.shape[0] - 1)] # careful for the last frame...
                 self.auds.append(aud)
                 aud_index_ = aud_index[min(f['aud_id'], aud_index.shape[0] - 1)] # careful for the last frame...
                 self.aud_indexs.append(aud_index_)
 
-            # load lms and extract face
-            lms = np.loadtxt(os.path.join(self.root_path, 'ori_imgs', str(f['img_id']) + '.lms')) # [68, 2]
-
-            lh_xmin, lh_xmax = int(lms[31:36, 1].min()), int(lms[:, 1].max()) # actually lower half area
-            xmin, xmax = int(lms[:, 1].min()), int(lms[:, 1].max())
-            ymin, ymax = int(lms[:, 0].min()), int(lms[:, 0].max())
-            self.face_rect.append([xmin, xmax, ymin, ymax])
-            self.lhalf_rect.append([lh_xmin, lh_xmax, ymin, ymax])
-
-            if self.opt.exp_eye:
-                # eyes_left = slice(36, 42)
-                # eyes_right = slice(42, 48)
-
-                # area_left = polygon_area(lms[eyes_left, 0], lms[eyes_left, 1])
-                # area_right = polygon_area(lms[eyes_right, 0], lms[eyes_right, 1])
-
-                # # area percentage of two eyes of the whole image...
-                # area = (area_left + area_right) / (self.H * self.W) * 100
-
-                # action units blink AU45
-                area = au_blink[f['img_id']]
-                area = np.clip(area, 0, 2) / 2
-                # area = area + np.random.rand() / 10
-                self.eye_area.append(area)
-
-                xmin, xmax = int(lms[36:48, 1].min()), int(lms[36:48, 1].max())
-                ymin, ymax = int(lms[36:48, 0].min()), int(lms[36:48, 0].max())
-                self.eye_rect.append([xmin, xmax, ymin, ymax])
-
-            if self.opt.finetune_lips:
-                lips = slice(48, 60)
-                xmin, xmax = int(lms[lips, 1].min()), int(lms[lips, 1].max())
-                ymin, ymax = int(lms[lips, 0].min()), int(lms[lips, 0].max())
-
-                # padding to H == W
-                cx = (xmin + xmax) // 2
-                cy = (ymin + ymax) // 2
-
-                l = max(xmax - xmin, ymax - ymin) // 2
-                xmin = max(0, cx - l)
-                xmax = min(self.H, cx + l)
-                ymin = max(0, cy - l)
-                ymax = min(self.W, cy + l)
-
-                self.lips_rect.append([xmin, xmax, ymin, ymax])
-
-            if self.opt.stable_lip:
-                if f['img_id'] == 0:
-                    pre_lms = np.loadtxt(os.path.join(self.root_path, 'ori_imgs', str(f['img_id']) + '.lms'))
-                else:
-                    pre_lms = np.loadtxt(os.path.join(self.root_path, 'ori_imgs', str(f['img_id']-1) + '.lms'))
-                pre_lip_lms = pre_lms[48:,:].reshape((40,-1))
-                pre_lip_lms -= np.mean(pre_lip_lms)
-                self.pre_lip_lms.append(pre_lip_lms)
-                # pre_lip_lms = torch.from_numpy(pre_lip_lms)
         # load pre-extracted background image (should be the same size as training image...)
 
         if self.opt.bg_img == 'white': # special
@@ -613,6 +629,32 @@ class NeRFDataset:
             self.parsing_images = np.array(self.parsing_images)
             self.torso_img = np.array(self.torso_img)
 
+        # per-frame low-res training error, rays are drawn proportional to it (mixed with uniform)
+        if self.training and self.opt.error_map:
+            self.error_map = torch.ones([len(self.img_ids), 128 * 128], dtype=torch.float)
+        else:
+            self.error_map = None
+
+        # draw training rays per region (parsing map + face/lips/eye rects) instead of uniformly
+        self.sample_regions = self.training and self.opt.sample_mode == 'parsing'
+        if self.sample_regions:
+            assert len(self.opt.region_probs) == 5 and min(self.opt.region_probs) >= 0 and sum(self.opt.region_probs) > 0, '[ERROR] --region_probs expects 5 non-negative values'
+            self.region_probs = torch.tensor(self.opt.region_probs, dtype=torch.float32, device=self.device) # [5]
+            if self.preload > 0:
+                self.region_labels = torch.stack([get_region_labels(self.parsing_images[i], self.face_rect[i], self.lips_rect[i], self.eye_rect[i]) for i in range(len(self.img_ids))], dim=0) # [N, H, W]
+
+        # keep recently decoded frames within a byte budget (on-the-fly loading only)
+        if self.preload == 0 and self.opt.frame_cache > 0:
+            self.frame_cache = FrameCache(self.opt.frame_cache * 2**30)
+        else:
+            self.frame_cache = None
+
+        # serve frames from a single packed file, frame order follows transforms_*.json
+        if self.preload < 0:
+            pack_path = os.path.join(self.root_path, f'packed_{type}')
+            self.frame_store = open_packed_frames(pack_path, self.img_ids, self.images, self.torso_img, self.depth_images, self.H, self.W)
+            self.frame_rows = self.frame_store.select(self.img_ids)
+
         if self.opt.asr:
             # live streaming, no pre-calculated auds
             self.auds = None
@@ -665,8 +707,10 @@ class NeRFDataset:
 
             self.bg_img = self.bg_img.to(torch.half).to(self.device)
 
-            self.torso_img = self.torso_img.to(torch.half).to(self.device)
-            self.images = self.images.to(torch.half).to(self.device)
+            self.torso_img = self.torso_img.to(self.device) # uint8
+            self.images = self.images.to(self.device) # uint8
+            if self.sample_regions:
+                self.region_labels = self.region_labels.to(self.device) # uint8
             
             if self.opt.exp_eye:
                 self.eye_area = self.eye_area.to(self.device)
@@ -696,6 +740,130 @@ class NeRFDataset:
         self.bg_coords = get_bg_coords(self.H, self.W, self.device) # [1, H*W, 2] in [-1, 1]
 
 
+    def build_manifest(self, frames, lms_table):
+        # derive the per-frame arrays cached in the manifest from transforms and landmarks.
+
+        # load action units
+        if self.opt.exp_eye:
+            import pandas as pd
+            au_blink_info=pd.read_csv(os.path.join(self.root_path, 'au.csv'))
+            au_blink = au_blink_info[' AU45_r'].values
+
+        poses = []
+        face_rect = []
+        lhalf_rect = []
+        lips_rect = []
+        pre_lip_lms = []
+        eye_area = []
+        eye_rect = []
+
+        for f in frames:
+
+            pose = np.array(f['transform_matrix'], dtype=np.float32) # [4, 4]
+            pose = nerf_matrix_to_ngp(pose, scale=self.scale, offset=self.offset)
+            poses.append(pose)
+
+            # load lms and extract face
+            lms = lms_table[f['img_id']] # [68, 2]
+
+            lh_xmin, lh_xmax = int(lms[31:36, 1].min()), int(lms[:, 1].max()) # actually lower half area
+            xmin, xmax = int(lms[:, 1].min()), int(lms[:, 1].max())
+            ymin, ymax = int(lms[:, 0].min()), int(lms[:, 0].max())
+            face_rect.append([xmin, xmax, ymin, ymax])
+            lhalf_rect.append([lh_xmin, lh_xmax, ymin, ymax])
+
+            if self.opt.exp_eye:
+                # eyes_left = slice(36, 42)
+                # eyes_right = slice(42, 48)
+
+                # area_left = polygon_area(lms[eyes_left, 0], lms[eyes_left, 1])
+                # area_right = polygon_area(lms[eyes_right, 0], lms[eyes_right, 1])
+
+                # # area percentage of two eyes of the whole image...
+                # area = (area_left + area_right) / (self.H * self.W) * 100
+
+                # action units blink AU45
+                area = au_blink[f['img_id']]
+                area = np.clip(area, 0, 2) / 2
+                # area = area + np.random.rand() / 10
+                eye_area.append(area)
+
+            # eye and lips rects are also used by the parsing sampler, so they are always kept
+            xmin, xmax = int(lms[36:48, 1].min()), int(lms[36:48, 1].max())
+            ymin, ymax = int(lms[36:48, 0].min()), int(lms[36:48, 0].max())
+            eye_rect.append([xmin, xmax, ymin, ymax])
+
+            lips = slice(48, 60)
+            xmin, xmax = int(lms[lips, 1].min()), int(lms[lips, 1].max())
+            ymin, ymax = int(lms[lips, 0].min()), int(lms[lips, 0].max())
+
+            # padding to H == W
+            cx = (xmin + xmax) // 2
+            cy = (ymin + ymax) // 2
+
+            l = max(xmax - xmin, ymax - ymin) // 2
+            xmin = max(0, cx - l)
+            xmax = min(self.H, cx + l)
+            ymin = max(0, cy - l)
+            ymax = min(self.W, cy + l)
+
+            lips_rect.append([xmin, xmax, ymin, ymax])
+
+            if self.opt.stable_lip:
+                pre_lms = lms_table[max(0, f['img_id'] - 1)]
+                pre_lip_lms_ = pre_lms[48:,:].reshape((40,-1)).copy()
+                pre_lip_lms_ -= np.mean(pre_lip_lms_)
+                pre_lip_lms.append(pre_lip_lms_)
+
+        manifest = {
+            'img_ids': np.array([f['img_id'] for f in frames], dtype=np.int64),
+            'poses': np.stack(poses, axis=0).astype(np.float32) if poses else np.zeros((0, 4, 4), dtype=np.float32), # [N, 4, 4]
+            'face_rect': np.array(face_rect, dtype=np.int64).reshape(-1, 4), # [N, 4]
+            'lhalf_rect': np.array(lhalf_rect, dtype=np.int64).reshape(-1, 4), # [N, 4]
+            'eye_rect': np.array(eye_rect, dtype=np.int64).reshape(-1, 4), # [N, 4]
+            'lips_rect': np.array(lips_rect, dtype=np.int64).reshape(-1, 4), # [N, 4]
+        }
+        if self.opt.exp_eye:
+            manifest['eye_area'] = np.array(eye_area, dtype=np.float32) # [N]
+        if self.opt.stable_lip:
+            manifest['pre_lip_lms'] = np.stack(pre_lip_lms, axis=0) # [N, 40, 2]
+
+        return manifest
+
+    def read_frame_assets(self, img_id):
+        # decode gt, depth, parsing and torso images of one frame for preloading (runs on a worker thread).
+        timings = {}
+
+        f_path = os.path.join(self.root_path, 'gt_imgs', str(img_id) + '.jpg')
+        f_depth_path = os.path.join(self.root_path, 'depth_npys', str(img_id) + '.npy')
+        f_parsing_path = os.path.join(self.root_path, 'parsing', str(img_id) + '.png')
+        torso_img_path = os.path.join(self.root_path, 'torso_imgs', str(img_id) + '.png')
+
+        # keep uint8, collate normalizes only the sampled rays
+        image = timed(timings, 'image', cv2.imread, f_path, cv2.IMREAD_UNCHANGED) # [H, W, 3] o [H, W, 4]
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB) # uint8
+
+        # depth_image = cv2.imread(f_depth_path, cv2.IMREAD_UNCHANGED) # [H, W, 1]
+        depth_image = timed(timings, 'depth', np.load, f_depth_path)
+        parsing_image = timed(timings, 'parsing', cv2.imread, f_parsing_path, cv2.IMREAD_UNCHANGED)
+
+        torso_img = timed(timings, 'torso', cv2.imread, torso_img_path, cv2.IMREAD_UNCHANGED) # [H, W, 4]
+        torso_img = cv2.cvtColor(torso_img, cv2.COLOR_BGRA2RGBA) # uint8
+
+        asset = {
+            'image': image,
+            'depth': depth_image,
+            'parsing': parsing_image,
+            'torso': torso_img,
+        }
+
+        return asset, timings
+
+    def read_lms(self, img_id):
+        timings = {}
+        lms = timed(timings, 'lms', np.loadtxt, os.path.join(self.root_path, 'ori_imgs', str(img_id) + '.lms')) # [68, 2]
+        return lms, timings
+
     def mirror_index(self, index):
         size = self.poses.shape[0]
         turn = index // size
@@ -706,37 +874,125 @@ class NeRFDataset:
             return size - res - 1
 
 
-    def collate(self, index):
+    def load_frame(self, index):
+        # fetch one (already mirrored) frame from the storage device, decoding it if needed.
+        # only touches read-only dataset state, so it is safe to call from a worker thread.
+        # return: images [1, H, W, 3] uint8, torso_img [1, H, W, 4] uint8, depth_images [1, H, W(, 1)] float
+        #         region [1, H, W] uint8 with --sample_mode parsing
+
+        if self.preload == 0: # on the fly loading
+            if self.frame_cache is not None:
+                frame = self.frame_cache.get(index)
+                if frame is not None:
+                    return frame
+            image, torso, depth = read_frame(self.images[index], self.torso_img[index], self.depth_images[index])
+            # 更新：1. 不在將深度保存爲png,會壓縮； 2. 使用3DMM后不再需要人臉掩膜
+            #TODO: 对深度数据进行预处理，以便和推理深度进行对齐
+            images = torch.from_numpy(image).unsqueeze(0)
+            torso_img = torch.from_numpy(torso).unsqueeze(0)
+            depth_images = torch.from_numpy(depth).unsqueeze(0).unsqueeze(-1) # [1, H, W, 1]
+        elif self.preload < 0: # packed memmap
+            row = self.frame_rows[index]
+            images = torch.from_numpy(self.frame_store.image(row)).unsqueeze(0)
+            torso_img = torch.from_numpy(self.frame_store.torso(row)).unsqueeze(0)
+            depth_images = torch.from_numpy(self.frame_store.depth(row)).float().unsqueeze(0).unsqueeze(-1) # [1, H, W, 1]
+        else:
+            images = self.images[[index]]
+            torso_img = self.torso_img[[index]]
+            depth_images = self.depth_images[[index]]
+
+        frame = {
+            'images': images,
+            'torso_img': torso_img,
+            'depth_images': depth_images,
+        }
+
+        if self.sample_regions:
+            frame['region'] = self.load_region(index) # [1, H, W]
+
+        if self.preload == 0 and self.frame_cache is not None:
+            self.frame_cache.put(index, frame)
+
+        return frame
+
+    def load_region(self, index):
+        # per-pixel region labels of the parsing sampler.
+        if self.preload > 0:
+            return self.region_labels[[index]]
+        parsing = torch.from_numpy(cv2.imread(self.parsing_images[index], cv2.IMREAD_UNCHANGED))
+        return get_region_labels(parsing, self.face_rect[index], self.lips_rect[index], self.eye_rect[index]).unsqueeze(0)
+
+
+    def region_sample_prob(self, region):
+        # spread each region's probability evenly over its pixels, regions missing in this frame are dropped.
+        labels = region.view(region.shape[0], -1).to(self.device).long() # [B, H*W]
+        counts = torch.zeros(labels.shape[0], self.region_probs.shape[0], device=self.device).scatter_add_(1, labels, torch.ones_like(labels, dtype=torch.float)) # [B, 5]
+        weights = self.region_probs / counts.clamp(min=1)
+        return torch.gather(weights, 1, labels) # [B, H*W]
+
+    def error_sample_prob(self, error_map):
+        # mix the normalized error with uniform, so converged cells are still visited.
+        u = self.opt.error_map_uniform
+        error_map = error_map / error_map.sum(-1, keepdim=True).clamp(min=1e-8)
+        return (1 - u) * error_map + u / error_map.shape[-1] # [B, 128*128]
+
+    def load_frames(self, index):
+        # load the (already mirrored) frames of a batch and stack them.
+        frames = [self.load_frame(i) for i in index]
+        if len(frames) == 1:
+            return frames[0]
+        return {k: torch.cat([f[k] for f in frames], dim=0) for k in frames[0]}
+
+    def rect_mask(self, rays, rects, index):
+        # mask of the rays inside each frame's rect, rects are [xmin, xmax, ymin, ymax] per frame
+        rect = torch.tensor([rects[i] for i in index], device=rays['i'].device).view(-1, 4, 1) # [B, 4, 1]
+        return (rays['j'] >= rect[:, 0]) & (rays['j'] < rect[:, 1]) & (rays['i'] >= rect[:, 2]) & (rays['i'] < rect[:, 3]) # [B, N]
+
+    def collate(self, index, frame=None):
         
         
-        B = len(index) # a list of length 1
-        # assert B == 1
+        B = len(index) # a list of length 1, or opt.batch_size frames for multi-frame training batches
 
         results = {}
 
         # audio use the original index
         if self.auds is not None:
-            auds = get_audio_features(self.auds, self.opt.att, index[0]).to(self.device)
+            if B == 1:
+                auds = get_audio_features(self.auds, self.opt.att, index[0]).to(self.device)
+            else:
+                auds = torch.stack([get_audio_features(self.auds, self.opt.att, i) for i in index], dim=0).to(self.device) # [B, 8, 29, 16]
             results['auds'] = auds
+            results['aud_ids'] = torch.tensor(index) # frames of the utterance, for Trainer.test's enc_a table
 
         if self.aud_indexs is not None:
-            results['aud_index'] = self.aud_indexs[[index[0]]].to(self.device)
+            results['aud_index'] = self.aud_indexs[index].to(self.device) # [B, 2]
 
 
         # head pose and bg image may mirror (replay --> <-- --> <--).
-        index[0] = self.mirror_index(index[0])
+        index = [self.mirror_index(i) for i in index]
         if self.pre_lip_lms is not None:
             # print(self.pre_lip_lms.shape)
             # exit()
-            results['pre_lip'] = self.pre_lip_lms[index[0]]
+            results['pre_lip'] = self.pre_lip_lms[index[0]] if B == 1 else self.pre_lip_lms[index] # [40, 1] or [B, 40, 1]
         poses = self.poses[index].to(self.device) # [B, 4, 4]
         
+        # decoded gt / depth / torso, may be prefetched by a background loader
+        if frame is None:
+            frame = self.load_frames(index)
+
         if self.training and self.opt.finetune_lips:
+            assert B == 1, '[ERROR] --finetune_lips renders a whole lips rect per step, use --batch_size 1'
             rect = self.lips_rect[index[0]]
             results['rect'] = rect
             rays = get_rays(poses, self.intrinsics, self.H, self.W, -1, rect=rect)
         else:
-            rays = get_rays(poses, self.intrinsics, self.H, self.W, self.num_rays, self.opt.patch_size)
+            sample_prob = self.region_sample_prob(frame['region']) if self.sample_regions else None
+            error_map = None if self.error_map is None else self.error_sample_prob(self.error_map[index])
+            # the ray budget of a step is split across the frames of the batch
+            num_rays = self.num_rays // B if self.num_rays > 0 else self.num_rays
+            rays = get_rays(poses, self.intrinsics, self.H, self.W, num_rays, self.opt.patch_size, sample_prob=sample_prob, error_map=error_map)
+            if 'inds_coarse' in rays:
+                results['inds_coarse'] = rays['inds_coarse']
 
         results['index'] = index # for ind. code
         results['H'] = self.H
@@ -746,83 +1002,54 @@ class NeRFDataset:
 
         # get a mask for rays inside rect_face
         if self.training:
-            xmin, xmax, ymin, ymax = self.face_rect[index[0]]
-            face_mask = (rays['j'] >= xmin) & (rays['j'] < xmax) & (rays['i'] >= ymin) & (rays['i'] < ymax) # [B, N]
+            face_mask = self.rect_mask(rays, self.face_rect, index) # [B, N]
             #face_mask是一个正方形？
             results['face_mask'] = face_mask
             
-            xmin, xmax, ymin, ymax = self.lhalf_rect[index[0]]
-            lhalf_mask = (rays['j'] >= xmin) & (rays['j'] < xmax) & (rays['i'] >= ymin) & (rays['i'] < ymax) # [B, N]
+            lhalf_mask = self.rect_mask(rays, self.lhalf_rect, index) # [B, N]
             results['lhalf_mask'] = lhalf_mask
 
         if self.opt.exp_eye:
-            results['eye'] = self.eye_area[index].to(self.device) # [1]
+            results['eye'] = self.eye_area[index].to(self.device) # [B, 1]
             if self.training:
                 results['eye'] += (np.random.rand()-0.5) / 10
-                xmin, xmax, ymin, ymax = self.eye_rect[index[0]]
-                eye_mask = (rays['j'] >= xmin) & (rays['j'] < xmax) & (rays['i'] >= ymin) & (rays['i'] < ymax) # [B, N]
+                eye_mask = self.rect_mask(rays, self.eye_rect, index) # [B, N]
                 results['eye_mask'] = eye_mask
 
         else:
             results['eye'] = None
 
-        # load bg
-        bg_torso_img = self.torso_img[index]
-        if self.preload == 0: # on the fly loading
-            bg_torso_img = cv2.imread(bg_torso_img[0], cv2.IMREAD_UNCHANGED) # [H, W, 4]
-            bg_torso_img = cv2.cvtColor(bg_torso_img, cv2.COLOR_BGRA2RGBA)
-            bg_torso_img = bg_torso_img.astype(np.float32) / 255 # [H, W, 3/4]
-            bg_torso_img = torch.from_numpy(bg_torso_img).unsqueeze(0)
-        bg_torso_img = bg_torso_img[..., :3] * bg_torso_img[..., 3:] + self.bg_img * (1 - bg_torso_img[..., 3:])
-        bg_torso_img = bg_torso_img.view(B, -1, 3).to(self.device)
+        images = frame['images'] # [B, H, W, 3], uint8
+        torso_img = frame['torso_img'].view(B, -1, 4) # [B, H*W, 4], uint8
+        bg = self.bg_img.view(1, -1, 3).expand(B, -1, -1) # [B, H*W, 3]
+
+        # gather the sampled rays on the storage device, so only those are transferred and normalized
+        if self.training:
+            inds = rays['inds'].to(images.device)
+            images = torch.gather(images.view(B, -1, 3), 1, torch.stack(3 * [inds], -1)) # [B, N, 3]
+            torso_img = torch.gather(torso_img, 1, torch.stack(4 * [inds.to(torso_img.device)], -1)) # [B, N, 4]
+            bg = torch.gather(bg, 1, torch.stack(3 * [inds.to(bg.device)], -1)) # [B, N, 3]
+
+        images = images.to(self.device).float() / 255
+        torso_img = torso_img.to(self.device).float() / 255
+        bg = bg.to(self.device).float()
+
+        bg_torso_img = torso_img[..., :3] * torso_img[..., 3:] + bg * (1 - torso_img[..., 3:]) # [B, N, 3]
 
         if not self.opt.torso:
             bg_img = bg_torso_img
         else:
-            bg_img = self.bg_img.view(1, -1, 3).repeat(B, 1, 1).to(self.device)
-
-        if self.training:
-            bg_img = torch.gather(bg_img, 1, torch.stack(3 * [rays['inds']], -1)) # [B, N, 3]
+            bg_img = bg
 
         results['bg_color'] = bg_img
 
         if self.opt.torso and self.training:
-            bg_torso_img = torch.gather(bg_torso_img, 1, torch.stack(3 * [rays['inds']], -1)) # [B, N, 3]
             results['bg_torso_color'] = bg_torso_img
 
-        images = self.images[index] # [B, H, W, 3/4]
-        if self.preload == 0:
-            images = cv2.imread(images[0], cv2.IMREAD_UNCHANGED) # [H, W, 3]
-            images = cv2.cvtColor(images, cv2.COLOR_BGR2RGB)
-            images = images.astype(np.float32) / 255 # [H, W, 3]
-            images = torch.from_numpy(images).unsqueeze(0)
-        images = images.to(self.device)
-
-        if self.training:
-            C = images.shape[-1]
-            images = torch.gather(images.view(B, -1, C), 1, torch.stack(C * [rays['inds']], -1)) # [B, N, 3/4]
-            
-        results['images'] = images
+        results['images'] = images # [B, N, 3] if training, else [B, H, W, 3]
         
         #拿出一批深度图
-        depth_images = self.depth_images[index]
-        parsing_images = self.parsing_images[index]
-        if self.preload == 0:
-            depth_images = np.load(depth_images[0])
-            # print(depth_images.shape)
-            # exit()
-            # 更新：1. 不在將深度保存爲png,會壓縮； 2. 使用3DMM后不再需要人臉掩膜
-            # depth_images = cv2.imread(depth_images[0], cv2.IMREAD_UNCHANGED) # [H, W]
-            # parsing_images = cv2.imread(parsing_images[0], cv2.IMREAD_UNCHANGED)
-            # headmask = (parsing_images[:,:,2] + parsing_images[:,:,1]) > 0 
-            # depth_images[headmask] = 0
-            # kernel = np.ones(shape=[4,4],dtype=np.uint8) 
-            # depth_images = cv2.erode(depth_images,kernel=kernel)
-            #TODO: 对深度数据进行预处理，以便和推理深度进行对齐
-            depth_images = depth_images.astype(np.float32) # [H, W]
-            #下次从这开始，写深度归一化^-^,还有，弄清楚下面要不要加.unsqueeze(-1)
-            depth_images = torch.from_numpy(depth_images).unsqueeze(0).unsqueeze(-1) #[1,H,W,1]
-        depth_images = depth_images.to(self.device).contiguous()
+        depth_images = frame['depth_images'].to(self.device).contiguous()
 
         if self.training:
             depth_images = torch.gather(depth_images.view(B, -1, 1), 1, torch.stack( [rays['inds']], -1)) # [B, N, 1]
@@ -830,7 +1057,7 @@ class NeRFDataset:
         results['depth_images'] = depth_images
 
         if self.training:
-            bg_coords = torch.gather(self.bg_coords, 1, torch.stack(2 * [rays['inds']], -1)) # [1, N, 2]
+            bg_coords = torch.gather(self.bg_coords.expand(B, -1, -1), 1, torch.stack(2 * [rays['inds']], -1)) # [B, N, 2]
         else:
             bg_coords = self.bg_coords # [1, N, 2]
 
@@ -855,10 +1082,67 @@ class NeRFDataset:
             else:
                 size = 2 * self.poses.shape[0]
 
-        loader = DataLoader(list(range(size)), batch_size=1, collate_fn=self.collate, shuffle=self.training, num_workers=0)
+        # several frames per step only when training
+        batch_size = self.opt.batch_size if self.training else 1
+
+        if self.opt.prefetch > 0:
+            loader = PrefetchLoader(self, size, shuffle=self.training, prefetch=self.opt.prefetch, num_workers=self.opt.num_workers, batch_size=batch_size)
+        else:
+            loader = DataLoader(list(range(size)), batch_size=batch_size, collate_fn=self.collate, shuffle=self.training, num_workers=0)
         loader._data = self # an ugly fix... we need poses in trainer.
 
         # do evaluate if has gt images and use self-driven setting
         loader.has_gt = (self.opt.aud == '')
 
-        return loader        
\ No newline at end of file
+        return loader
+
+
+class PrefetchLoader:
+    # drop-in replacement for DataLoader(batch_size=batch_size) over a NeRFDataset.
+    # the next `prefetch` batches are decoded on a thread pool (cv2 and torch release the GIL),
+    # only ray generation, gathering, device transfer and compositing of the sampled rays run in collate on the iterating thread.
+    def __init__(self, dataset, size, shuffle=False, prefetch=4, num_workers=4, batch_size=1):
+        self.dataset = dataset
+        self.size = size
+        self.shuffle = shuffle
+        self.prefetch = prefetch
+        self.batch_size = batch_size
+        self.pool = ThreadPoolExecutor(max_workers=max(1, num_workers), thread_name_prefix='prefetch')
+        self.queue = deque()
+
+    def __len__(self):
+        return (self.size + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        if self.shuffle:
+            order = torch.randperm(self.size).tolist()
+        else:
+            order = list(range(self.size))
+        batches = iter([order[i:i + self.batch_size] for i in range(0, self.size, self.batch_size)])
+
+        def submit(batch):
+            return batch, self.pool.submit(self.dataset.load_frames, [self.dataset.mirror_index(i) for i in batch])
+
+        self.queue = queue = deque(submit(batch) for batch, _ in zip(batches, range(self.prefetch)))
+
+        try:
+            while queue:
+                batch, future = queue.popleft()
+                nxt = next(batches, None)
+                if nxt is not None:
+                    queue.append(submit(nxt))
+                yield self.dataset.collate(batch, frame=future.result())
+        finally:
+            # stopped early (break or exception), the queued frames will never be collated.
+            for _, future in queue:
+                future.cancel()
+
+    def close(self):
+        # cancel the queued frames and release the worker threads, the loader cannot be iterated afterwards.
+        for _, future in self.queue:
+            future.cancel()
+        self.queue.clear()
+        self.pool.shutdown(wait=False)
+
+    def __del__(self):
+        self.close()
@@ -1,4 +1,7 @@
+import os
 import math
+import time
+import hashlib
 import trimesh
 import numpy as np
 import random
@@ -119,6 +122,12 @@ class NeRFRenderer(nn.Module):
         self.mean_density = 0
         self.iter_density = 0
 
+        # 'full' re-evaluates every cell, 'partial' only a random subset plus occupied cells (after warmup), see update_extra_state.
+        self.grid_update = opt.grid_update
+        self.grid_update_ratio = opt.grid_update_ratio
+        self.grid_update_count = 0
+        self.grid_update_time = 0
+
         # 2D torso density grid
         if self.torso:
             density_grid_torso = torch.zeros([self.grid_size ** 2]) # [H * H]
@@ -134,6 +143,13 @@ class NeRFRenderer(nn.Module):
         # decay for enc_a
         if self.smooth_lips:
             self.enc_a = None
+
+        # [N, 64] enc_a of every frame of a known utterance, see set_audio_table
+        self.enc_a_table = None
+
+        # buffers of the inference marching loop per number of rays, reused across frames, see get_workspace
+        self.use_workspace = True
+        self.workspace = {}
         
         self.pre_lip = None
     
@@ -154,19 +170,110 @@ class NeRFRenderer(nn.Module):
         self.density_grid.zero_()
         self.mean_density = 0
         self.iter_density = 0
+        self.clear_grid_stats()
         # step counter
         self.step_counter.zero_()
         self.mean_count = 0
         self.local_step = 0
 
 
-    def run_cuda(self, rays_o, rays_d, auds,aud_index, bg_coords, poses, eye=None, pre_lip = None,index=0, dt_gamma=0, bg_color=None, perturb=False, force_all_rays=False, max_steps=1024, T_thresh=1e-4, **kwargs):
-        # rays_o, rays_d: [B, N, 3], assumes B == 1
+    @staticmethod
+    def cat_outputs(outputs):
+        # concatenate the outputs of several passes along dim 0. a key only some passes have (e.g. 'deform' when a frame
+        # has no torso rays) is concatenated over those passes, non-tensor values are taken from the first pass.
+        results = {}
+        for o in outputs:
+            for k, v in o.items():
+                results.setdefault(k, []).append(v)
+        return {k: torch.cat(v, dim=0) if torch.is_tensor(v[0]) else v[0] for k, v in results.items()}
+
+
+    @staticmethod
+    def sample_frame_ids(rays, M, rays_per_frame):
+        # frame of every point generated by march_rays_train, rays of frame b are [b * rays_per_frame, (b + 1) * rays_per_frame).
+        # rays: [N, 3], (index, point_offset, point_count); points beyond M (dropped by mean_count) are skipped.
+        ray_ids, offsets, counts = rays[:, 0].long(), rays[:, 1].long(), rays[:, 2].long()
+        point_ray = torch.repeat_interleave(torch.arange(rays.shape[0], device=rays.device), counts) # [P]
+        starts = torch.cumsum(counts, 0) - counts
+        points = offsets[point_ray] + torch.arange(point_ray.shape[0], device=rays.device) - starts[point_ray] # [P]
+        valid = points < M
+        frame_ids = torch.zeros(M, dtype=torch.long, device=rays.device)
+        frame_ids[points[valid]] = ray_ids[point_ray[valid]] // rays_per_frame
+        return frame_ids
+
+
+    def frame_cond(self, auds, pre_lip=None, index=0, aud_ids=None, enc_a=None):
+        # per-frame conditioning of run_cuda: encoded (and smoothed) audio, smoothed pre_lip and the ind code.
+        # updates the smoothing state, so call it once per frame (render passes it to every tile of a staged render).
+        # return: enc_a, pre_lip, ind_code
+
+        if self.enc_a_table is not None and aud_ids is not None:
+            # precomputed (and already smoothed) for the whole utterance
+            enc_a = self.enc_a_table[aud_ids] # [B, 64]
+
+        else:
+            # encode audio
+            if enc_a is None:
+                enc_a = self.encode_audio(auds) # [1, 64]
+
+            #如果对唇部形状进行平滑，需要将上一次的音频信息和当前的音频特征进行加权混合
+            if enc_a is not None and self.smooth_lips:
+                if self.enc_a is not None:
+                    _lambda = 0.35
+                    enc_a = _lambda * self.enc_a + (1 - _lambda) * enc_a
+                self.enc_a = enc_a
+
+        if self.pre_lip is not None and self.pre_lip.shape == pre_lip.shape:
+            _beta = 0.2
+            pre_lip = _beta * self.pre_lip + (1 - _beta) * pre_lip
+            self.pre_lip = pre_lip
+        else:
+            self.pre_lip = pre_lip
+        
+        #训练时用了，推导时没用，那么这玩意到底有没有用捏？MAYBe
+        if self.individual_dim > 0:
+            if self.training:
+                #只会在训练时用到individual_codes，test时使用固定的 ind code。
+                ind_code = self.individual_codes[index]
+            # use a fixed ind code for the unknown test data.
+            else:
+                ind_code = self.individual_codes[0]
+        else:
+            ind_code = None
+
+        return enc_a, pre_lip, ind_code
+
+
+    def get_workspace(self, N, device):
+        # sample and compaction buffers of the inference loop of run_cuda for N rays.
+        # a video or GUI session renders at one or two sizes (the last tile of a staged render), so only a few are kept.
+        key = (N, str(device))
+        if key not in self.workspace:
+            if len(self.workspace) >= 4:
+                self.workspace.clear()
+            M = N + 128 # a marching round has at most N points, padded to a multiple of 128
+            self.workspace[key] = {
+                'rays_alive': torch.empty(2, N, dtype=torch.int32, device=device), # ping-pong for compact_rays
+                'counter': torch.zeros(1, dtype=torch.int32, device=device),
+                'xyzs': torch.empty(M, 3, device=device),
+                'dirs': torch.empty(M, 3, device=device),
+                'deltas': torch.empty(M, 2, device=device),
+                'noises': torch.empty(N, device=device),
+            }
+        return self.workspace[key]
+
+
+    def run_cuda(self, rays_o, rays_d, auds,aud_index, bg_coords, poses, eye=None, pre_lip = None,index=0, aud_ids=None, enc_a=None, cond=None, dt_gamma=0, bg_color=None, perturb=False, force_all_rays=False, max_steps=1024, T_thresh=1e-4, **kwargs):
+        # rays_o, rays_d: [B, N, 3], B > 1 for multi-frame batches (conditioning is then per frame)
         # auds: [B, 16]
         # index: [B]
+        # aud_ids: [B], frames of the utterance, to look up enc_a when set_audio_table was called
+        # enc_a: [1, 64], audio already encoded by the caller (live ASR, see StreamingAudioEncoder)
+        # cond: frame_cond() of this frame, computed by the caller (tiles of a staged render)
         # return: image: [B, N, 3], depth: [B, N]
 
         prefix = rays_o.shape[:-1] #[B, N]
+        B, rays_per_frame = prefix[0], prefix[1]
         rays_o = rays_o.contiguous().view(-1, 3) #[B*N, 3]
         rays_d = rays_d.contiguous().view(-1, 3) #[B*N, 3]
         bg_coords = bg_coords.contiguous().view(-1, 2)
@@ -174,11 +281,11 @@ class NeRFRenderer(nn.Module):
         # only add camera offset at training!
         # 通过训练得到的相机偏移量对相机姿态进行修正
         if self.train_camera and (self.training or self.test_train):
-            dT = self.camera_dT[index] # [1, 3]
-            dR = euler_angles_to_matrix(self.camera_dR[index] / 180 * np.pi + 1e-8).squeeze(0) # [1, 3] --> [3, 3]
+            dT = self.camera_dT[index].view(-1, 1, 3) # [B, 1, 3]
+            dR = euler_angles_to_matrix(self.camera_dR[index].view(-1, 3) / 180 * np.pi + 1e-8) # [B, 3] --> [B, 3, 3]
             
-            rays_o = rays_o + dT
-            rays_d = rays_d @ dR
+            rays_o = (rays_o.view(B, -1, 3) + dT).view(-1, 3)
+            rays_d = (rays_d.view(B, -1, 3) @ dR).view(-1, 3)
 
         N = rays_o.shape[0] # N = B * N, in fact，因为每次仅仅处理单张图片，所以B等于1，因此 N = B * N，共N根光线
         device = rays_o.device
@@ -190,33 +297,9 @@ class NeRFRenderer(nn.Module):
         nears = nears.detach()
         fars = fars.detach()
 
-        # encode audio
-        enc_a = self.encode_audio(auds) # [1, 64]
-
-        #如果对唇部形状进行平滑，需要将上一次的音频信息和当前的音频特征进行加权混合
-        if enc_a is not None and self.smooth_lips:
-            if self.enc_a is not None:
-                _lambda = 0.35
-                enc_a = _lambda * self.enc_a + (1 - _lambda) * enc_a
-            self.enc_a = enc_a
-
-        if self.pre_lip is not None:
-            _beta = 0.2
-            pre_lip = _beta * self.pre_lip + (1 - _beta) * pre_lip
-            self.pre_lip = pre_lip
-        else:
-            self.pre_lip = pre_lip
-        
-        #训练时用了，推导时没用，那么这玩意到底有没有用捏？MAYBe
-        if self.individual_dim > 0:
-            if self.training:
-                #只会在训练时用到individual_codes，test时使用固定的 ind code。
-                ind_code = self.individual_codes[index]
-            # use a fixed ind code for the unknown test data.
-            else:
-                ind_code = self.individual_codes[0]
-        else:
-            ind_code = None
+        if cond is None:
+            cond = self.frame_cond(auds, pre_lip, index, aud_ids, enc_a)
+        enc_a, pre_lip, ind_code = cond
 
         if self.training:
             # setup counter
@@ -225,6 +308,12 @@ class NeRFRenderer(nn.Module):
             self.local_step += 1
 
             xyzs, dirs, deltas, rays = raymarching.march_rays_train(rays_o, rays_d, self.bound, self.density_bitfield, self.cascade, self.grid_size, nears, fars, counter, self.mean_count, perturb, 128, force_all_rays, dt_gamma, max_steps)
+
+            # multi-frame batch: gather each point's frame conditioning
+            if B > 1:
+                frame_ids = self.sample_frame_ids(rays, xyzs.shape[0], rays_per_frame)
+                enc_a, aud_index, eye, pre_lip, ind_code = [None if cond is None else cond[frame_ids] for cond in (enc_a, aud_index, eye, pre_lip, ind_code)]
+
             sigmas, rgbs, amb_aud, amb_eye, uncertainty = self(xyzs, dirs, enc_a,aud_index, ind_code, eye, pre_lip)
             sigmas = self.density_scale * sigmas
 
@@ -253,16 +342,20 @@ class NeRFRenderer(nn.Module):
             uncertainty_sum = torch.zeros(N, dtype=dtype, device=device)
 
             n_alive = N
-            rays_alive = torch.arange(n_alive, dtype=torch.int32, device=device) # [N]
             rays_t = nears.clone() # [N]
 
+            # with the workspace, the sample buffers are reused and dead rays are compacted into the other rays_alive buffer
+            workspace = self.get_workspace(N, device) if self.use_workspace else None
+            if workspace is not None:
+                rays_alive, rays_alive_next = workspace['rays_alive']
+                torch.arange(n_alive, out=rays_alive)
+            else:
+                rays_alive = torch.arange(n_alive, dtype=torch.int32, device=device) # [N]
+
             step = 0
             
             while step < max_steps:
 
-                # count alive rays 
-                n_alive = rays_alive.shape[0]
-                
                 # exit loop
                 if n_alive <= 0:
                     break
@@ -270,15 +363,28 @@ class NeRFRenderer(nn.Module):
                 # decide compact_steps
                 n_step = max(min(N // n_alive, 8), 1)
 
-                xyzs, dirs, deltas = raymarching.march_rays(n_alive, n_step, rays_alive, rays_t, rays_o, rays_d, self.bound, self.density_bitfield, self.cascade, self.grid_size, nears, fars, 128, perturb if step == 0 else False, dt_gamma, max_steps)
+                xyzs, dirs, deltas = raymarching.march_rays(n_alive, n_step, rays_alive, rays_t, rays_o, rays_d, self.bound, self.density_bitfield, self.cascade, self.grid_size, nears, fars, 128, perturb if step == 0 else False, dt_gamma, max_steps, workspace)
+
+                # multi-frame batch: points are [n_alive, n_step], gather each point's frame conditioning
+                if B > 1:
+                    frame_ids = (rays_alive[:n_alive].long() // rays_per_frame).repeat_interleave(n_step)
+                    conds = [None if cond is None else cond[frame_ids] for cond in (enc_a, aud_index, eye, pre_lip, ind_code)]
+                else:
+                    conds = [enc_a, aud_index, eye, pre_lip, ind_code]
 
-                sigmas, rgbs, ambients_aud, ambients_eye, uncertainties = self(xyzs, dirs, enc_a,aud_index, ind_code, eye, pre_lip)
+                sigmas, rgbs, ambients_aud, ambients_eye, uncertainties = self(xyzs, dirs, conds[0], conds[1], conds[4], conds[2], conds[3])
                 sigmas = self.density_scale * sigmas
 
                 # raymarching.composite_rays_uncertainty(n_alive, n_step, rays_alive, rays_t, sigmas, rgbs, deltas, ambients, uncertainties, weights_sum, depth, image, ambient_sum, uncertainty_sum, T_thresh)
                 raymarching.composite_rays_triplane(n_alive, n_step, rays_alive, rays_t, sigmas, rgbs, deltas, ambients_aud, ambients_eye, uncertainties, weights_sum, depth, image, amb_aud_sum, amb_eye_sum, uncertainty_sum, T_thresh)
 
-                rays_alive = rays_alive[rays_alive >= 0]
+                # count alive rays 
+                if workspace is not None:
+                    n_alive = raymarching.compact_rays(n_alive, rays_alive, rays_alive_next, workspace['counter'])
+                    rays_alive, rays_alive_next = rays_alive_next, rays_alive
+                else:
+                    rays_alive = rays_alive[rays_alive >= 0]
+                    n_alive = rays_alive.shape[0]
 
                 # print(f'step = {step}, n_step = {n_step}, n_alive = {n_alive}, xyzs: {xyzs.shape}')
 
@@ -307,7 +413,7 @@ class NeRFRenderer(nn.Module):
     
 
     def run_torso(self, rays_o, bg_coords, poses, index=0, bg_color=None, **kwargs):
-        # rays_o, rays_d: [B, N, 3], assumes B == 1
+        # rays_o, rays_d: [B, N, 3], B > 1 for multi-frame batches
         # auds: [B, 16]
         # index: [B]
         # return: image: [B, N, 3], depth: [B, N]
@@ -323,6 +429,15 @@ class NeRFRenderer(nn.Module):
         # background
         if bg_color is None:
             bg_color = 1
+        elif torch.is_tensor(bg_color) and bg_color.dim() == 3:
+            bg_color = bg_color.reshape(-1, bg_color.shape[-1]) # [B, N, 3] --> [B*N, 3]
+
+        # the torso pose and ind code are per frame, so a multi-frame batch runs one pass per frame
+        B = poses.shape[0]
+        if self.torso and B > 1:
+            n = N // B
+            outputs = [self.run_torso(rays_o[b*n:(b+1)*n], bg_coords[b*n:(b+1)*n], poses[b:b+1], index[b:b+1], bg_color[b*n:(b+1)*n] if torch.is_tensor(bg_color) else bg_color) for b in range(B)]
+            return self.cat_outputs(outputs)
 
         # first mix torso with background
         if self.torso:
@@ -368,9 +483,10 @@ class NeRFRenderer(nn.Module):
 
 
     @torch.no_grad()
-    def mark_untrained_grid(self, poses, intrinsic, S=64):
+    def mark_untrained_grid(self, poses, intrinsic, S=64, cache_path=None):
         # poses: [B, 4, 4]
         # intrinsic: [3, 3]
+        # cache_path: optional .npz to reuse the mask of the same poses, intrinsics and bound across runs.
 
         if not self.cuda_ray:
             return
@@ -378,119 +494,229 @@ class NeRFRenderer(nn.Module):
         if isinstance(poses, np.ndarray):
             poses = torch.from_numpy(poses)
 
+        poses = poses.detach().float()
+        key = hashlib.sha1(b''.join([
+            poses.cpu().numpy().tobytes(),
+            np.asarray(intrinsic, dtype=np.float64).tobytes(),
+            np.array([self.bound, self.grid_size, self.cascade], dtype=np.float64).tobytes(),
+        ])).hexdigest()
+
+        if cache_path is not None and os.path.exists(cache_path):
+            try:
+                cache = np.load(cache_path)
+                if str(cache['key']) == key:
+                    untrained = np.unpackbits(cache['untrained'])[:self.density_grid.numel()].reshape(self.density_grid.shape)
+                    self.density_grid[torch.from_numpy(untrained).bool().to(self.density_grid.device)] = -1
+                    print(f'[INFO] use untrained grid mask {cache_path}')
+                    return
+            except Exception as e:
+                print(f'[WARN] failed to read {cache_path}: {e}, recomputing...')
+
         B = poses.shape[0]
+        H = self.grid_size
+        device = self.density_bitfield.device
         
         fx, fy, cx, cy = intrinsic
-        
-        X = torch.arange(self.grid_size, dtype=torch.int32, device=self.density_bitfield.device).split(S)
-        Y = torch.arange(self.grid_size, dtype=torch.int32, device=self.density_bitfield.device).split(S)
-        Z = torch.arange(self.grid_size, dtype=torch.int32, device=self.density_bitfield.device).split(S)
 
-        count = torch.zeros_like(self.density_grid)
-        poses = poses.to(count.device)
+        # world2cam transform (poses is c2w): cam = (x - t) @ R = x @ R - t @ R
+        poses = poses.to(device)
+        rots = poses[:, :3, :3] # [B, 3, 3]
+        trans = - (poses[:, None, :3, 3] @ rots).squeeze(1) # [B, 3]
 
-        # 5-level loop, forgive me...
+        # every cell in morton order, so the mask can be assigned without scattering.
+        coords = raymarching.morton3D_invert(torch.arange(H ** 3, dtype=torch.int32, device=device)) # [H^3, 3], in [0, 128)
+        world_xyzs = 2 * coords.float() / (H - 1) - 1 # [H^3, 3] in [-1, 1]
 
-        for xs in X:
-            for ys in Y:
-                for zs in Z:
-                    
-                    # construct points
-                    xx, yy, zz = custom_meshgrid(xs, ys, zs)
-                    coords = torch.cat([xx.reshape(-1, 1), yy.reshape(-1, 1), zz.reshape(-1, 1)], dim=-1) # [N, 3], in [0, 128)
-                    indices = raymarching.morton3D(coords).long() # [N]
-                    world_xyzs = (2 * coords.float() / (self.grid_size - 1) - 1).unsqueeze(0) # [1, N, 3] in [-1, 1]
-
-                    # cascading
-                    for cas in range(self.cascade):
-                        bound = min(2 ** cas, self.bound)
-                        half_grid_size = bound / self.grid_size
-                        # scale to current cascade's resolution
-                        cas_world_xyzs = world_xyzs * (bound - half_grid_size)
-
-                        # split batch to avoid OOM
-                        head = 0
-                        while head < B:
-                            tail = min(head + S, B)
-
-                            # world2cam transform (poses is c2w, so we need to transpose it. Another transpose is needed for batched matmul, so the final form is without transpose.)
-                            cam_xyzs = cas_world_xyzs - poses[head:tail, :3, 3].unsqueeze(1)
-                            cam_xyzs = cam_xyzs @ poses[head:tail, :3, :3] # [S, N, 3]
-                            
-                            # query if point is covered by any camera
-                            mask_z = cam_xyzs[:, :, 2] > 0 # [S, N]
-                            mask_x = torch.abs(cam_xyzs[:, :, 0]) < cx / fx * cam_xyzs[:, :, 2] + half_grid_size * 2
-                            mask_y = torch.abs(cam_xyzs[:, :, 1]) < cy / fy * cam_xyzs[:, :, 2] + half_grid_size * 2
-                            mask = (mask_z & mask_x & mask_y).sum(0).reshape(-1) # [N]
-
-                            # update count 
-                            count[cas, indices] += mask
-                            head += S
+        covered = torch.zeros(self.cascade, H ** 3, dtype=torch.bool, device=device)
+
+        for cas in range(self.cascade):
+            bound = min(2 ** cas, self.bound)
+            half_grid_size = bound / H
+            # scale to current cascade's resolution
+            cas_world_xyzs = world_xyzs * (bound - half_grid_size)
+
+            # cells not covered by any camera so far, covered cells are not tested against the remaining poses.
+            todo = torch.arange(H ** 3, device=device)
+
+            # tiles of S poses x S^3 cells bound the memory.
+            for head in range(0, B, S):
+                if todo.shape[0] == 0:
+                    break
+                rot, tran = rots[head:head + S], trans[head:head + S]
+                hit = torch.zeros(todo.shape[0], dtype=torch.bool, device=device)
+
+                for start in range(0, todo.shape[0], S ** 3):
+                    cam_xyzs = torch.einsum('nj,sjk->snk', cas_world_xyzs[todo[start:start + S ** 3]], rot) + tran[:, None] # [S, N, 3]
+
+                    # query if point is covered by any camera
+                    mask_z = cam_xyzs[:, :, 2] > 0 # [S, N]
+                    mask_x = torch.abs(cam_xyzs[:, :, 0]) < cx / fx * cam_xyzs[:, :, 2] + half_grid_size * 2
+                    mask_y = torch.abs(cam_xyzs[:, :, 1]) < cy / fy * cam_xyzs[:, :, 2] + half_grid_size * 2
+                    hit[start:start + S ** 3] = (mask_z & mask_x & mask_y).any(0)
+
+                covered[cas, todo[hit]] = True
+                todo = todo[~hit]
     
         # mark untrained grid as -1
-        self.density_grid[count == 0] = -1
+        self.density_grid[~covered] = -1
 
-        #print(f'[mark untrained grid] {(count == 0).sum()} from {resolution ** 3 * self.cascade}')
+        if cache_path is not None:
+            # write to a temp file and rename, so an interrupted run never leaves a truncated cache.
+            tmp_path = cache_path + '.tmp.npz'
+            np.savez(tmp_path, key=np.array(key), untrained=np.packbits((~covered).cpu().numpy()))
+            os.replace(tmp_path, cache_path)
+            print(f'[INFO] saved untrained grid mask to {cache_path}')
+
+        #print(f'[mark untrained grid] {(~covered).sum()} from {H ** 3 * self.cascade}')
 
     @torch.no_grad()
-    def update_extra_state(self, decay=0.95, S=128):
-        # call before each epoch to update extra states.
+    def set_audio_table(self, aud_features, _lambda=0.35):
+        # aud_features: [N, 29, 16] of a whole utterance, encoded once for offline rendering (test / infer).
+        # None drops the table, so enc_a is encoded per frame again.
 
-        if not self.cuda_ray:
-            return 
-        
+        if aud_features is None:
+            self.enc_a_table = None
+            return
+
+        enc_a = self.encode_audio_table(aud_features.to(self.density_bitfield.device)) # [N, 64]
+
+        if self.smooth_lips:
+            # the per-frame blend of run_cuda, y_t = lambda * y_{t-1} + (1 - lambda) * x_t with y_0 = x_0, as one causal filter.
+            # taps are cut where lambda^k is below float32 precision.
+            K = int(math.ceil(math.log(1e-8) / math.log(_lambda)))
+            x = enc_a.float().clone()
+            x[0] = x[0] / (1 - _lambda)
+            weight = (1 - _lambda) * _lambda ** torch.arange(K - 1, -1, -1, dtype=x.dtype, device=x.device) # oldest first
+            x = F.pad(x.t().unsqueeze(1), (K - 1, 0)) # [64, 1, K - 1 + N]
+            enc_a = F.conv1d(x, weight.view(1, 1, K)).squeeze(1).t().to(enc_a.dtype) # [N, 64]
+
+        self.enc_a_table = enc_a
+
+    def clear_grid_stats(self):
+        self.grid_update_count = 0
+        self.grid_update_time = 0
+
+    def report_grid_stats(self):
+        n = max(1, self.grid_update_count)
+        density_thresh = min(self.mean_density, self.density_thresh)
+        occ_rate = (self.density_grid > density_thresh).float().mean().item()
+        return f'density grid: {self.grid_update_count} updates ({self.grid_update}), {1000 * self.grid_update_time / n:.1f} ms/update, occ_rate = {occ_rate:.3f}'
+
+    def random_grid_cond(self):
+        # conditions of a random training frame, to query density() over the whole grid.
         # use random auds (different expressions should have similar density grid...)
         rand_idx = random.randint(0, self.aud_features.shape[0] - 1)
         auds = get_audio_features(self.aud_features, self.att, rand_idx).to(self.density_bitfield.device)
 
-        # encode audio
-        enc_a = self.encode_audio(auds)
-
-        ### update density grid
-        if not self.torso: # forbid updating head if is training torso...
+        # use a random eye area based on training dataset's statistics...
+        if self.exp_eye:
+            eye = self.eye_area[[rand_idx]].to(self.density_bitfield.device) # [1, 1]
+        else:
+            eye = None
 
-            tmp_grid = torch.zeros_like(self.density_grid)
+        return {
+            'enc_a': self.encode_audio(auds),
+            'aud_index': self.aud_index[[rand_idx]].to(self.density_bitfield.device),
+            'e': eye,
+            'pre_lip': self.pre_lip_lms[[rand_idx]].to(self.density_bitfield.device),
+        }
 
-            # use a random eye area based on training dataset's statistics...
-            if self.exp_eye:
-                eye = self.eye_area[[rand_idx]].to(self.density_bitfield.device) # [1, 1]
+    @torch.no_grad()
+    def evaluate_grid(self, fields, cond, cells=None, S=128):
+        ''' evaluate outputs of density() at the cells of the cascaded grid, in a single sweep.
+        Each chunk of points is encoded once and all requested fields are read from the same density() call.
+        Args:
+            fields: list of keys of density() outputs, e.g. ['sigma', 'ambient_aud', 'ambient_eye']
+            cond: dict of extra arguments to density(), see random_grid_cond.
+            cells: None to evaluate every cell, or a list with (indices [N], coords [N, 3]) of each cascade.
+            S: chunk size, at most S^3 points are queried at once.
+        Returns:
+            dict of field --> [CAS, H * H * H] grid, cells that are not evaluated are -1.
+        '''
+
+        grids = {field: - torch.ones_like(self.density_grid) for field in fields}
+
+        def chunks():
+            if cells is None:
+                X = torch.arange(self.grid_size, dtype=torch.int32, device=self.density_bitfield.device).split(S)
+                Y = torch.arange(self.grid_size, dtype=torch.int32, device=self.density_bitfield.device).split(S)
+                Z = torch.arange(self.grid_size, dtype=torch.int32, device=self.density_bitfield.device).split(S)
+
+                for xs in X:
+                    for ys in Y:
+                        for zs in Z:
+                            # construct points
+                            xx, yy, zz = custom_meshgrid(xs, ys, zs)
+                            coords = torch.cat([xx.reshape(-1, 1), yy.reshape(-1, 1), zz.reshape(-1, 1)], dim=-1) # [N, 3], in [0, 128)
+                            indices = raymarching.morton3D(coords).long() # [N]
+                            for cas in range(self.cascade):
+                                yield cas, indices, coords
             else:
-                eye = None
+                for cas, (indices, coords) in enumerate(cells):
+                    for head in range(0, indices.shape[0], S ** 3):
+                        yield cas, indices[head:head + S ** 3], coords[head:head + S ** 3]
+
+        for cas, indices, coords in chunks():
+            xyzs = 2 * coords.float() / (self.grid_size - 1) - 1 # [N, 3] in [-1, 1]
+            bound = min(2 ** cas, self.bound)
+            half_grid_size = bound / self.grid_size
+            # scale to current cascade's resolution
+            cas_xyzs = xyzs * (bound - half_grid_size)
+            # add noise in [-hgs, hgs]
+            cas_xyzs += (torch.rand_like(cas_xyzs) * 2 - 1) * half_grid_size
+            # query all fields at once
+            outputs = self.density(cas_xyzs, **cond)
+            for field in fields:
+                values = outputs[field].reshape(-1).detach().to(self.density_grid.dtype)
+                if field == 'sigma':
+                    values = values * self.density_scale
+                # assign
+                grids[field][cas, indices] = values
+
+        return grids
 
-            pre_lip = self.pre_lip_lms[[rand_idx]].to(self.density_bitfield.device)
-            aud_index = self.aud_index[[rand_idx]].to(self.density_bitfield.device)
-            
-            # full update
-            X = torch.arange(self.grid_size, dtype=torch.int32, device=self.density_bitfield.device).split(S)
-            Y = torch.arange(self.grid_size, dtype=torch.int32, device=self.density_bitfield.device).split(S)
-            Z = torch.arange(self.grid_size, dtype=torch.int32, device=self.density_bitfield.device).split(S)
+    @torch.no_grad()
+    def update_extra_state(self, decay=0.95, S=128, warmup=16):
+        # call before each epoch to update extra states.
 
-            for xs in X:
-                for ys in Y:
-                    for zs in Z:
-                        
-                        # construct points
-                        xx, yy, zz = custom_meshgrid(xs, ys, zs)
-                        coords = torch.cat([xx.reshape(-1, 1), yy.reshape(-1, 1), zz.reshape(-1, 1)], dim=-1) # [N, 3], in [0, 128)
-                        indices = raymarching.morton3D(coords).long() # [N]
-                        xyzs = 2 * coords.float() / (self.grid_size - 1) - 1 # [N, 3] in [-1, 1]
-
-                        # cascading
-                        for cas in range(self.cascade):
-                            bound = min(2 ** cas, self.bound)
-                            half_grid_size = bound / self.grid_size
-                            # scale to current cascade's resolution
-                            cas_xyzs = xyzs * (bound - half_grid_size)
-                            # add noise in [-hgs, hgs]
-                            cas_xyzs += (torch.rand_like(cas_xyzs) * 2 - 1) * half_grid_size
-                            # query density
-                            sigmas = self.density(cas_xyzs, enc_a = enc_a,aud_index=aud_index, e = eye,pre_lip = pre_lip)['sigma'].reshape(-1).detach().to(tmp_grid.dtype)
-                            sigmas *= self.density_scale
-                            # assign 
-                            tmp_grid[cas, indices] = sigmas
+        if not self.cuda_ray:
+            return 
+
+        t0 = time.time()
+
+        ### update density grid
+        if not self.torso: # forbid updating head if is training torso...
+
+            if self.grid_update == 'full' or self.iter_density < warmup:
+                # full update
+                cells = None
+            else:
+                # partial update (as in instant-ngp): a random subset of cells plus as many cells drawn from the occupied ones.
+                # cells left at -1 are not visited and keep their value in the ema update below.
+                N = max(1, int(self.grid_size ** 3 * self.grid_update_ratio))
+                cells = []
+                for cas in range(self.cascade):
+                    # random cells
+                    coords = torch.randint(0, self.grid_size, (N, 3), dtype=torch.int32, device=self.density_bitfield.device) # [N, 3], in [0, 128)
+                    indices = raymarching.morton3D(coords).long() # [N]
+                    # random occupied cells, allow for duplication
+                    occ_indices = torch.nonzero(self.density_grid[cas] > 0).squeeze(-1) # [Nz]
+                    if occ_indices.shape[0] > 0:
+                        occ_indices = occ_indices[torch.randint(0, occ_indices.shape[0], (N,), device=occ_indices.device)] # [N]
+                        occ_coords = raymarching.morton3D_invert(occ_indices) # [N, 3]
+                        indices = torch.cat([indices, occ_indices], dim=0)
+                        coords = torch.cat([coords, occ_coords], dim=0)
+                    cells.append((indices, coords))
+
+            tmp_grid = self.evaluate_grid(['sigma'], self.random_grid_cond(), cells, S=S)['sigma']
             
             # dilate the density_grid (less aggressive culling)
-            tmp_grid = raymarching.morton3D_dilation(tmp_grid)
+            if cells is None:
+                tmp_grid = raymarching.morton3D_dilation(tmp_grid)
+            else:
+                # unvisited cells (-1) count as empty in the dilation, and stay unvisited.
+                visited = tmp_grid >= 0
+                tmp_grid = torch.where(visited, raymarching.morton3D_dilation(tmp_grid.clamp(min=0)), tmp_grid)
 
             # ema update
             valid_mask = (self.density_grid >= 0) & (tmp_grid >= 0)
@@ -501,7 +727,6 @@ class NeRFRenderer(nn.Module):
             # convert to bitfield
             density_thresh = min(self.mean_density, self.density_thresh)
             self.density_bitfield = raymarching.packbits(self.density_grid, density_thresh, self.density_bitfield)
-
         ### update torso density grid
         if self.torso:
             tmp_grid_torso = torch.zeros_like(self.density_grid_torso)
@@ -554,130 +779,74 @@ class NeRFRenderer(nn.Module):
             self.mean_count = int(self.step_counter[:total_step, 0].sum().item() / total_step)
         self.local_step = 0
 
+        self.grid_update_count += 1
+        self.grid_update_time += time.time() - t0
+
         #print(f'[density grid] min={self.density_grid.min().item():.4f}, max={self.density_grid.max().item():.4f}, mean={self.mean_density:.4f}, occ_rate={(self.density_grid > 0.01).sum() / (128**3 * self.cascade):.3f} | [step counter] mean={self.mean_count}')
 
 
     @torch.no_grad()
-    def get_audio_grid(self,  S=128):
-        # call before each epoch to update extra states.
+    def get_attention_grids(self, S=128):
+        # audio and eye attention of a random training frame over the whole grid, in one sweep.
+        # returns: dict with 'ambient_aud' and 'ambient_eye', [CAS, H * H * H]
 
         if not self.cuda_ray:
             return 
-        
-        # use random auds (different expressions should have similar density grid...)
-        rand_idx = random.randint(0, self.aud_features.shape[0] - 1)
-        auds = get_audio_features(self.aud_features, self.att, rand_idx).to(self.density_bitfield.device)
 
-        # encode audio
-        enc_a = self.encode_audio(auds)
-        tmp_grid = torch.zeros_like(self.density_grid)
+        grids = self.evaluate_grid(['ambient_aud', 'ambient_eye'], self.random_grid_cond(), S=S)
 
-        # use a random eye area based on training dataset's statistics...
-        if self.exp_eye:
-            eye = self.eye_area[[rand_idx]].to(self.density_bitfield.device) # [1, 1]
-        else:
-            eye = None
-        
-        # full update
-        X = torch.arange(self.grid_size, dtype=torch.int32, device=self.density_bitfield.device).split(S)
-        Y = torch.arange(self.grid_size, dtype=torch.int32, device=self.density_bitfield.device).split(S)
-        Z = torch.arange(self.grid_size, dtype=torch.int32, device=self.density_bitfield.device).split(S)
-
-        for xs in X:
-            for ys in Y:
-                for zs in Z:
-                    
-                    # construct points
-                    xx, yy, zz = custom_meshgrid(xs, ys, zs)
-                    coords = torch.cat([xx.reshape(-1, 1), yy.reshape(-1, 1), zz.reshape(-1, 1)], dim=-1) # [N, 3], in [0, 128)
-                    indices = raymarching.morton3D(coords).long() # [N]
-                    xyzs = 2 * coords.float() / (self.grid_size - 1) - 1 # [N, 3] in [-1, 1]
-
-                    # cascading
-                    for cas in range(self.cascade):
-                        bound = min(2 ** cas, self.bound)
-                        half_grid_size = bound / self.grid_size
-                        # scale to current cascade's resolution
-                        cas_xyzs = xyzs * (bound - half_grid_size)
-                        # add noise in [-hgs, hgs]
-                        cas_xyzs += (torch.rand_like(cas_xyzs) * 2 - 1) * half_grid_size
-                        # query density
-                        aud_norms = self.density(cas_xyzs.to(tmp_grid.dtype), enc_a, eye)['ambient_aud'].reshape(-1).detach().to(tmp_grid.dtype)
-                        # assign 
-                        tmp_grid[cas, indices] = aud_norms
-        
-        # dilate the density_grid (less aggressive culling)
-        tmp_grid = raymarching.morton3D_dilation(tmp_grid)
-        return tmp_grid
-        # # ema update
-        # valid_mask = (self.density_grid >= 0) & (tmp_grid >= 0)
-        # self.density_grid[valid_mask] = torch.maximum(self.density_grid[valid_mask] * decay, tmp_grid[valid_mask])
+        # dilate the attention grids (smoother to visualize)
+        return {field: raymarching.morton3D_dilation(grid) for field, grid in grids.items()}
+
+    # grids: a get_attention_grids() result, so the audio and eye grids of one frame share a single sweep.
+    @torch.no_grad()
+    def get_audio_grid(self,  S=128, grids=None):
 
+        if not self.cuda_ray:
+            return 
+
+        if grids is None:
+            grids = self.get_attention_grids(S)
+        return grids['ambient_aud']
 
     @torch.no_grad()
-    def get_eye_grid(self,  S=128):
-        # call before each epoch to update extra states.
+    def get_eye_grid(self,  S=128, grids=None):
 
         if not self.cuda_ray:
             return 
-        
-        # use random auds (different expressions should have similar density grid...)
-        rand_idx = random.randint(0, self.aud_features.shape[0] - 1)
-        auds = get_audio_features(self.aud_features, self.att, rand_idx).to(self.density_bitfield.device)
 
-        # encode audio
-        enc_a = self.encode_audio(auds)
-        tmp_grid = torch.zeros_like(self.density_grid)
+        if grids is None:
+            grids = self.get_attention_grids(S)
+        return grids['ambient_eye']
 
-        # use a random eye area based on training dataset's statistics...
-        if self.exp_eye:
-            eye = self.eye_area[[rand_idx]].to(self.density_bitfield.device) # [1, 1]
-        else:
-            eye = None
-        
-        # full update
-        X = torch.arange(self.grid_size, dtype=torch.int32, device=self.density_bitfield.device).split(S)
-        Y = torch.arange(self.grid_size, dtype=torch.int32, device=self.density_bitfield.device).split(S)
-        Z = torch.arange(self.grid_size, dtype=torch.int32, device=self.density_bitfield.device).split(S)
-
-        for xs in X:
-            for ys in Y:
-                for zs in Z:
-                    
-                    # construct points
-                    xx, yy, zz = custom_meshgrid(xs, ys, zs)
-                    coords = torch.cat([xx.reshape(-1, 1), yy.reshape(-1, 1), zz.reshape(-1, 1)], dim=-1) # [N, 3], in [0, 128)
-                    indices = raymarching.morton3D(coords).long() # [N]
-                    xyzs = 2 * coords.float() / (self.grid_size - 1) - 1 # [N, 3] in [-1, 1]
-
-                    # cascading
-                    for cas in range(self.cascade):
-                        bound = min(2 ** cas, self.bound)
-                        half_grid_size = bound / self.grid_size
-                        # scale to current cascade's resolution
-                        cas_xyzs = xyzs * (bound - half_grid_size)
-                        # add noise in [-hgs, hgs]
-                        cas_xyzs += (torch.rand_like(cas_xyzs) * 2 - 1) * half_grid_size
-                        # query density
-                        eye_norms = self.density(cas_xyzs.to(tmp_grid.dtype), enc_a, eye)['ambient_eye'].reshape(-1).detach().to(tmp_grid.dtype)
-                        # assign 
-                        tmp_grid[cas, indices] = eye_norms
-        
-        # dilate the density_grid (less aggressive culling)
-        tmp_grid = raymarching.morton3D_dilation(tmp_grid)
-        return tmp_grid
-        # # ema update
-        # valid_mask = (self.density_grid >= 0) & (tmp_grid >= 0)
-        # self.density_grid[valid_mask] = torch.maximum(self.density_grid[valid_mask] * decay, tmp_grid[valid_mask])
 
+    # rough peak bytes per ray of an inference pass: a marching round has at most one sample per ray on average
+    # (n_alive * n_step <= N), and a sample costs its position / direction plus the network activations (fp32).
+    ray_bytes = 4096
+
+    def staged_ray_batch(self, N, max_ray_batch=0, max_ray_mem=0):
+        # rays per pass of a staged render, from a ray budget and / or a memory budget (MB), 0 means no limit.
+        batch = max_ray_batch if max_ray_batch > 0 else N
+        if max_ray_mem > 0:
+            batch = min(batch, max(int(max_ray_mem * 2 ** 20) // self.ray_bytes, 1))
+        return min(batch, N)
 
 
-    def render(self, rays_o, rays_d, auds, aud_index, bg_coords, poses, staged=False, max_ray_batch=4096, **kwargs):
-        # rays_o, rays_d: [B, N, 3], assumes B == 1
+    @staticmethod
+    def split_bg_color(bg_color, i, j):
+        # bg_color of the rays [i, j): a per-ray tensor ([B, N, 3] or [N, 3]) is sliced, a constant is shared.
+        if torch.is_tensor(bg_color) and bg_color.dim() >= 2 and bg_color.shape[-2] > 1:
+            return bg_color[..., i:j, :]
+        return bg_color
+
+
+    def render(self, rays_o, rays_d, auds, aud_index, bg_coords, poses, staged=False, max_ray_batch=0, max_ray_mem=0, **kwargs):
+        # rays_o, rays_d: [B, N, 3], B > 1 for multi-frame training batches
         # auds: [B, 29, 16]
         # aud_index: [B, 2]
         # eye: [B, 1]
         # bg_coords: [1, N, 2]
+        # staged: full-frame inference, rendered in tiles of staged_ray_batch() rays to bound the peak memory
         # return: pred_rgb: [B, N, 3]
 
         _run = self.run_cuda
@@ -685,10 +854,21 @@ class NeRFRenderer(nn.Module):
         B, N = rays_o.shape[:2]
         device = rays_o.device
 
-        # never stage when cuda_ray
-        if staged and not self.cuda_ray:
-            # not used
-            raise NotImplementedError
+        batch = self.staged_ray_batch(N, max_ray_batch, max_ray_mem)
+
+        if staged and not self.training and batch < N:
+            # conditioning is per frame, so audio is encoded (and smoothed) once for all tiles.
+            cond = self.frame_cond(auds, kwargs.pop('pre_lip', None), kwargs.get('index', 0), kwargs.pop('aud_ids', None), kwargs.pop('enc_a', None))
+            bg_color = kwargs.pop('bg_color', None)
+
+            outputs = []
+            for i in range(0, N, batch):
+                j = min(i + batch, N)
+                outputs.append(_run(rays_o[:, i:j], rays_d[:, i:j], auds, aud_index, bg_coords[:, i:j], poses, cond=cond, bg_color=self.split_bg_color(bg_color, i, j), **kwargs))
+
+            results = {k: torch.cat([o[k] for o in outputs], dim=1) for k in ['image', 'depth', 'ambient_aud', 'ambient_eye']}
+            # uncertainty is flattened [B * N]
+            results['uncertainty'] = torch.cat([o['uncertainty'].view(B, -1) for o in outputs], dim=1).view(-1)
 
         else:
             results = _run(rays_o, rays_d, auds,aud_index, bg_coords, poses, **kwargs)
@@ -696,8 +876,8 @@ class NeRFRenderer(nn.Module):
         return results
     
     
-    def render_torso(self, rays_o, rays_d, auds, bg_coords, poses, staged=False, max_ray_batch=4096, **kwargs):
-        # rays_o, rays_d: [B, N, 3], assumes B == 1
+    def render_torso(self, rays_o, rays_d, auds, bg_coords, poses, staged=False, max_ray_batch=0, max_ray_mem=0, **kwargs):
+        # rays_o, rays_d: [B, N, 3], B > 1 for multi-frame training batches
         # auds: [B, 29, 16]
         # eye: [B, 1]
         # bg_coords: [1, N, 2]
@@ -708,10 +888,18 @@ class NeRFRenderer(nn.Module):
         B, N = rays_o.shape[:2]
         device = rays_o.device
 
-        # never stage when cuda_ray
-        if staged and not self.cuda_ray:
-            # not used
-            raise NotImplementedError
+        batch = self.staged_ray_batch(N, max_ray_batch, max_ray_mem)
+
+        if staged and not self.training and batch < N:
+            bg_color = kwargs.pop('bg_color', None)
+
+            outputs = []
+            for i in range(0, N, batch):
+                j = min(i + batch, N)
+                outputs.append(_run(rays_o[:, i:j], bg_coords[:, i:j], poses, bg_color=self.split_bg_color(bg_color, i, j), **kwargs))
+
+            # per-ray outputs are [B * n, ...], deform is per torso sample, so both concatenate along dim 0.
+            results = self.cat_outputs(outputs)
 
         else:
             results = _run(rays_o, bg_coords, poses, **kwargs)
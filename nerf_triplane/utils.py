@@ -245,16 +245,56 @@ def get_bg_coords(H, W, device):
     return bg_coords
 
 
+# normalized camera-space directions of all pixels, keyed by (H, W, intrinsics, device).
+# intrinsics are fixed per dataset, but the GUI may change them (zoom, downscale), so the cache is kept small.
+_ray_directions_cache = {}
+_ray_directions_cache_size = 8
+
+@torch.cuda.amp.autocast(enabled=False)
+def get_ray_directions(H, W, intrinsics, device):
+    ''' get (cached) per-pixel ray directions in camera space
+    Args:
+        H, W: int
+        intrinsics: [4]
+    Returns:
+        i, j: [H*W], pixel centers (x, y)
+        directions: [H*W, 3], normalized
+    '''
+
+    fx, fy, cx, cy = [float(x) for x in intrinsics]
+    device = torch.device(device)
+    key = (H, W, fx, fy, cx, cy, str(device))
+
+    if key not in _ray_directions_cache:
+        i, j = custom_meshgrid(torch.linspace(0, W-1, W, device=device), torch.linspace(0, H-1, H, device=device)) # float
+        i = i.t().reshape(H*W) + 0.5
+        j = j.t().reshape(H*W) + 0.5
+
+        zs = torch.ones_like(i)
+        xs = (i - cx) / fx * zs
+        ys = (j - cy) / fy * zs
+        directions = torch.stack((xs, ys, zs), dim=-1)
+        directions = directions / torch.norm(directions, dim=-1, keepdim=True)
+
+        if len(_ray_directions_cache) >= _ray_directions_cache_size:
+            _ray_directions_cache.pop(next(iter(_ray_directions_cache)))
+        _ray_directions_cache[key] = (i, j, directions)
+
+    return _ray_directions_cache[key]
+
+
 #根据是否切块，是否有掩模，对H*W的图片区域进行二维采样，并对每个采样得到的二维点
 #进行三维射线的计算，分别是相机原点rays_o和射线方向单位向量rays_d
 #对训练，采样N = 4096*16根，验证or测试直接N = H*W
 @torch.cuda.amp.autocast(enabled=False)
-def get_rays(poses, intrinsics, H, W, N=-1, patch_size=1, rect=None):
+def get_rays(poses, intrinsics, H, W, N=-1, patch_size=1, rect=None, sample_prob=None, error_map=None):
     ''' get rays
     Args:
         poses: [B, 4, 4], cam2world
         intrinsics: [4]
         H, W, N: int
+        sample_prob: [H*W] or [B, H*W], unnormalized pixel weights for random sampling, None for uniform
+        error_map: [B, 128*128], unnormalized sampling weights on a low-res grid, takes precedence over sample_prob
     Returns:
         rays_o, rays_d: [B, N, 3]
         inds: [B, N]
@@ -262,15 +302,13 @@ def get_rays(poses, intrinsics, H, W, N=-1, patch_size=1, rect=None):
 
     device = poses.device
     B = poses.shape[0]
-    fx, fy, cx, cy = intrinsics
 
     if rect is not None:
         xmin, xmax, ymin, ymax = rect
         N = (xmax - xmin) * (ymax - ymin)
 
-    i, j = custom_meshgrid(torch.linspace(0, W-1, W, device=device), torch.linspace(0, H-1, H, device=device)) # float
-    i = i.t().reshape([1, H*W]).expand([B, H*W]) + 0.5
-    j = j.t().reshape([1, H*W]).expand([B, H*W]) + 0.5
+    # pixel centers and directions are cached, sampling only gathers from them
+    i, j, directions = get_ray_directions(H, W, intrinsics, device) # [H*W], [H*W], [H*W, 3]
 #i = tensor([[0.5000, 1.5000, 2.5000, 3.5000, 4.5000, 0.5000, 1.5000, 2.5000, 3.5000,
 #          4.5000, 0.5000, 1.5000, 2.5000, 3.5000, 4.5000, 0.5000, 1.5000, 2.5000,
 #          3.5000, 4.5000, 0.5000, 1.5000, 2.5000, 3.5000, 4.5000]])
@@ -307,32 +345,48 @@ def get_rays(poses, intrinsics, H, W, N=-1, patch_size=1, rect=None):
         # only get rays in the specified rect
         elif rect is not None:
             # assert B == 1
-            mask = torch.zeros(H, W, dtype=torch.bool, device=device)
             xmin, xmax, ymin, ymax = rect
-            mask[xmin:xmax, ymin:ymax] = 1
-            inds = torch.where(mask.view(-1))[0] # [nzn]
+            xs = torch.arange(max(0, xmin), min(H, xmax), device=device)
+            ys = torch.arange(max(0, ymin), min(W, ymax), device=device)
+            inds = (xs[:, None] * W + ys[None, :]).view(-1) # [nzn], row-major as the rect mask
             inds = inds.unsqueeze(0) # [1, N]
 
-        else:
-            inds = torch.randint(0, H*W, size=[N], device=device) # may duplicate
+        # weighted sample on a low-res error grid
+        elif error_map is not None:
+            res = int(math.sqrt(error_map.shape[-1]))
+            inds_coarse = torch.multinomial(error_map.to(device), N, replacement=True) # [B, N], in [0, res*res)
+
+            # map to the original resolution with random perturb.
+            inds_x, inds_y = inds_coarse // res, inds_coarse % res
+            sx, sy = H / res, W / res
+            inds_x = (inds_x * sx + torch.rand(B, N, device=device) * sx).long().clamp(max=H - 1)
+            inds_y = (inds_y * sy + torch.rand(B, N, device=device) * sy).long().clamp(max=W - 1)
+            inds = inds_x * W + inds_y
+
+            results['inds_coarse'] = inds_coarse # need this when updating error_map
+
+        # importance sampling, e.g. by face region
+        elif sample_prob is not None:
+            inds = torch.multinomial(sample_prob.view(-1, H*W).float(), N, replacement=True) # [B or 1, N]
             inds = inds.expand([B, N])
 
-        i = torch.gather(i, -1, inds)
-        j = torch.gather(j, -1, inds)
+        else:
+            inds = torch.randint(0, H*W, size=[B, N], device=device) # may duplicate, independent per frame
+
+        i = i[inds] # [B, N]
+        j = j[inds]
+        directions = directions[inds] # [B, N, 3]
 
 
     else:
         inds = torch.arange(H*W, device=device).expand([B, H*W])
+        i = i.expand([B, H*W])
+        j = j.expand([B, H*W])
+        directions = directions.expand([B, H*W, 3])
     
     results['i'] = i
     results['j'] = j
     results['inds'] = inds
-
-    zs = torch.ones_like(i)
-    xs = (i - cx) / fx * zs
-    ys = (j - cy) / fy * zs
-    directions = torch.stack((xs, ys, zs), dim=-1)
-    directions = directions / torch.norm(directions, dim=-1, keepdim=True)
     
     rays_d = directions @ poses[:, :3, :3].transpose(-1, -2) # (B, N, 3)
     
@@ -598,6 +652,78 @@ class DepthNorm:
         scaled = self.gamma * x + self.beta
         return scaled
 
+
+class StaticFrameCache:
+    ''' last rendered frame of test / infer, so that with a fixed camera only its dynamic region is re-rendered.
+    The dynamic region is where ambient_aud or ambient_eye of the cached frame is above thresh * its max (mouth and eyes),
+    dilated by `dilate` pixels. The whole frame is rendered again every `refresh` frames, or when the pose, size or
+    background changes.
+    '''
+    def __init__(self, thresh=0.05, dilate=8, refresh=25, pose_tol=1e-4):
+        self.thresh = thresh
+        self.dilate = dilate
+        self.refresh = refresh
+        self.pose_tol = pose_tol
+        self.reset()
+
+    def reset(self):
+        self.frame = None # image [1, N, 3], depth / ambient_aud / ambient_eye [1, N] of the last frame
+        self.bg_color = None # background the cached frame was composited on
+        self.inds = None # [n], rays of the dynamic region
+        self.count = 0 # frames since the last full render
+        self.rendered = 0 # stats: rays rendered / rays of all frames
+        self.total = 0
+
+    @staticmethod
+    def same_bg(a, b):
+        # every cached pixel is composited on the background, so any change of it needs a full render.
+        if torch.is_tensor(a) and torch.is_tensor(b):
+            return a.shape == b.shape and torch.equal(a, b.to(a.device))
+        return not torch.is_tensor(a) and not torch.is_tensor(b) and a == b
+
+    def rays(self, data, bg_color):
+        # rays to render for this frame, None for all of them.
+        if self.frame is None or self.count >= self.refresh or self.shape != (data['H'], data['W']) or \
+            (data['poses'] - self.poses).abs().max().item() > self.pose_tol or not self.same_bg(bg_color, self.bg_color):
+            return None
+        return self.inds
+
+    def update(self, data, outputs, inds, bg_color):
+        # outputs of the rays inds (all if None) --> outputs of the full frame
+        H, W = data['H'], data['W']
+        N = H * W
+
+        if inds is None:
+            # copies, the next frames patch them in place.
+            self.frame = {k: outputs[k].clone() for k in ['image', 'depth', 'ambient_aud', 'ambient_eye']}
+            self.bg_color = bg_color.clone() if torch.is_tensor(bg_color) else bg_color
+            self.poses = data['poses'].clone()
+            self.shape = (H, W)
+            self.count = 0
+            self.rendered += N
+        else:
+            if inds.shape[0] > 0:
+                for k, v in self.frame.items():
+                    v[:, inds] = outputs[k].to(v.dtype)
+            self.count += 1
+            self.rendered += inds.shape[0]
+        self.total += N
+
+        # dynamic region of the next frame
+        dynamic = torch.zeros(H, W, dtype=torch.bool, device=self.frame['image'].device)
+        for k in ['ambient_aud', 'ambient_eye']:
+            amb = self.frame[k].view(H, W).float()
+            dynamic |= amb > self.thresh * amb.max()
+        if self.dilate > 0:
+            dynamic = F.max_pool2d(dynamic[None, None].float(), 2 * self.dilate + 1, stride=1, padding=self.dilate)[0, 0] > 0
+        self.inds = dynamic.view(-1).nonzero()[:, 0]
+
+        return self.frame
+
+    def report(self):
+        return f'rendered {self.rendered / max(self.total, 1) * 100:.1f}% of the rays'
+
+
 class Trainer(object):
     def __init__(self, 
                  name, # name of this experiment
@@ -692,6 +818,7 @@ class Trainer(object):
         self.epoch = 0
         self.global_step = 0
         self.local_step = 0
+        self.error_map = None # [N, 128*128], per-frame training error, shared with the train dataset
         self.stats = {
             "loss": [],
             "valid_loss": [],
@@ -807,7 +934,7 @@ class Trainer(object):
 
 
         else:
-            pred_rgb = outputs['torso_color']
+            pred_rgb = outputs['torso_color'].view(B, N, 3)
 
         # numpy_array3 = pred_depth.reshape(N,-1).cpu().detach().numpy()
         # # 保存 NumPy 数组到文本文件
@@ -826,6 +953,23 @@ class Trainer(object):
         else:
             loss = self.criterion(pred_rgb, rgb).mean(-1) # [B, N, 3] --> [B, N]
 
+        # update error_map
+        if self.error_map is not None and 'inds_coarse' in data:
+            index = data['index'] # [B]
+            inds = data['inds_coarse'] # [B, N]
+
+            # take out, this is an advanced indexing and the copy is unavoidable.
+            error_map = self.error_map[index] # [B, 128*128]
+
+            error = loss.detach().view(B, N).to(error_map.device) # [B, N], already in [0, 1]
+
+            # ema update
+            ema_error = 0.1 * error_map.gather(1, inds.to(error_map.device)) + 0.9 * error
+            error_map.scatter_(1, inds.to(error_map.device), ema_error)
+
+            # put back
+            self.error_map[index] = error_map
+
         if self.opt.torso:
             loss = loss.mean()
             loss += ((1 - self.model.anchor_points[:, 3])**2).mean()
@@ -838,7 +982,7 @@ class Trainer(object):
 
         if self.opt.unc_loss and not self.flip_finetune_lips:
             alpha = 0.2
-            uncertainty = outputs['uncertainty'] # [N], abs sum
+            uncertainty = outputs['uncertainty'].view(B, N) # [B, N], abs sum
             beta = uncertainty + 1
 
             unc_weight = F.softmax(uncertainty, dim=-1) * N
@@ -849,10 +993,10 @@ class Trainer(object):
             beta = uncertainty + 1
             norm_rgb = torch.norm((pred_rgb - rgb), dim=-1).detach()
             loss_u = norm_rgb / (2*beta**2) + (torch.log(beta)**2) / 2
-            loss_u *= face_mask.view(-1)
+            loss_u *= face_mask
             loss += step_factor * loss_u
 
-            loss_static_uncertainty = (uncertainty * (~face_mask.view(-1)))
+            loss_static_uncertainty = (uncertainty * (~face_mask))
             loss += 1e-3 * step_factor * loss_static_uncertainty
         
         # patch-based rendering
@@ -908,7 +1052,7 @@ class Trainer(object):
         # aud att loss (regions out of face should be static)
         if self.opt.amb_aud_loss and not self.opt.torso:
             ambient_aud = outputs['ambient_aud']
-            loss_amb_aud = (ambient_aud * (~face_mask.view(-1))).mean()
+            loss_amb_aud = (ambient_aud * (~face_mask)).mean()
             # gradually increase it
             lambda_amb = step_factor * self.opt.lambda_amb 
             loss += lambda_amb * loss_amb_aud
@@ -917,7 +1061,7 @@ class Trainer(object):
         if self.opt.amb_eye_loss and not self.opt.torso:
             ambient_eye = outputs['ambient_eye'] / self.opt.max_steps
 
-            loss_cross = ((ambient_eye * ambient_aud.detach())*face_mask.view(-1)).mean()
+            loss_cross = ((ambient_eye * ambient_aud.detach())*face_mask).mean()
             loss += lambda_amb * loss_cross
         
         # regularize
@@ -979,7 +1123,8 @@ class Trainer(object):
         return pred_rgb, pred_depth, pred_ambient_aud, pred_ambient_eye, pred_uncertainty, images, loss, loss_raw
 
     # moved out bg_color and perturb for more flexible control...
-    def test_step(self, data, bg_color=None, perturb=False):  
+    def test_step(self, data, bg_color=None, perturb=False, cache=None):  
+        # cache: StaticFrameCache, only its dynamic rays are rendered (for a single frame of a fixed camera)
 
         rays_o = data['rays_o'] # [B, N, 3]
         rays_d = data['rays_d'] # [B, N, 3]
@@ -1002,10 +1147,24 @@ class Trainer(object):
         else:
             bg_color = data['bg_color']
 
+        inds = cache.rays(data, bg_color) if cache is not None else None
+        if inds is not None:
+            rays_o, rays_d, bg_coords = rays_o[:, inds], rays_d[:, inds], bg_coords[:, inds]
+            if torch.is_tensor(bg_color) and bg_color.dim() >= 2 and bg_color.shape[-2] > 1:
+                bg_color = bg_color[..., inds, :]
+
         self.model.testing = True
-        outputs = self.model.render(rays_o, rays_d, auds,aud_index, bg_coords, poses, eye=eye, index=index,pre_lip = pre_lip, staged=True, bg_color=bg_color, perturb=perturb, **vars(self.opt))
+        if inds is not None and inds.shape[0] == 0:
+            # nothing moves, still advance the per-frame smoothing state
+            self.model.frame_cond(auds, pre_lip, index, data.get('aud_ids'), data.get('enc_a'))
+            outputs = None
+        else:
+            outputs = self.model.render(rays_o, rays_d, auds,aud_index, bg_coords, poses, eye=eye, index=index,pre_lip = pre_lip, aud_ids=data.get('aud_ids'), enc_a=data.get('enc_a'), staged=True, bg_color=bg_color, perturb=perturb, **vars(self.opt))
         self.model.testing = False
 
+        if cache is not None:
+            outputs = cache.update(data, outputs, inds, bg_color)
+
         pred_rgb = outputs['image'].reshape(-1, H, W, 3)
         pred_depth = outputs['depth'].reshape(-1, H, W)
 
@@ -1044,7 +1203,10 @@ class Trainer(object):
 
         # mark untrained region (i.e., not covered by any camera from the training dataset)
         if self.model.cuda_ray:
-            self.model.mark_untrained_grid(train_loader._data.poses, train_loader._data.intrinsics)
+            self.model.mark_untrained_grid(train_loader._data.poses, train_loader._data.intrinsics, cache_path=os.path.join(train_loader._data.root_path, 'untrained_grid.npz'))
+
+        # get a ref to error_map
+        self.error_map = train_loader._data.error_map
 
         for epoch in range(self.epoch + 1, max_epochs + 1):
             self.epoch = epoch
@@ -1058,6 +1220,11 @@ class Trainer(object):
                 self.evaluate_one_epoch(valid_loader)
                 self.save_checkpoint(full=False, best=True)
 
+        # stop the prefetch threads (--prefetch), the loaders are not iterated after training.
+        for loader in (train_loader, valid_loader):
+            if hasattr(loader, 'close'):
+                loader.close()
+
         if self.use_tensorboardX and self.local_rank == 0:
             self.writer.close()
 
@@ -1066,6 +1233,12 @@ class Trainer(object):
         self.evaluate_one_epoch(loader, name)
         self.use_tensorboardX = use_tensorboardX
 
+    def static_frame_cache(self):
+        # --static_cache: re-render only the dynamic region of each test / infer frame
+        if not self.opt.static_cache:
+            return None
+        return StaticFrameCache(self.opt.static_thresh, self.opt.static_dilate, self.opt.static_refresh, self.opt.static_pose_tol)
+
     def test(self, loader, save_path=None, name=None, write_image=False):
 
         if save_path is None:
@@ -1086,10 +1259,16 @@ class Trainer(object):
 
         with torch.no_grad():
 
+            # encode the whole utterance once, each frame then looks up its enc_a.
+            with torch.cuda.amp.autocast(enabled=self.fp16):
+                self.model.set_audio_table(loader._data.auds)
+
+            cache = self.static_frame_cache()
+
             for i, data in enumerate(loader):
                 
                 with torch.cuda.amp.autocast(enabled=self.fp16):
-                    preds, preds_depth = self.test_step(data)                
+                    preds, preds_depth = self.test_step(data, cache=cache)                
                 
                 path = os.path.join(save_path, f'{name}_{i:04d}_rgb.png')
                 path_depth = os.path.join(save_path, f'{name}_{i:04d}_depth.png')
@@ -1114,6 +1293,11 @@ class Trainer(object):
 
                 pbar.update(loader.batch_size)
 
+        if cache is not None:
+            self.log(f"[INFO] static cache: {cache.report()}")
+
+        self.model.set_audio_table(None)
+
         # write video
         all_preds = np.stack(all_preds, axis=0)
         all_preds_depth = np.stack(all_preds_depth, axis=0)
@@ -1143,11 +1327,17 @@ class Trainer(object):
 
         with torch.no_grad():
 
+            # encode the whole utterance once, each frame then looks up its enc_a.
+            with torch.cuda.amp.autocast(enabled=self.fp16):
+                self.model.set_audio_table(loader._data.auds)
+
+            cache = self.static_frame_cache()
+
             for i, data in enumerate(loader):
                 if pre_lip_lms != None:
                     data['pre_lip'] = pre_lip_lms
                 with torch.cuda.amp.autocast(enabled=self.fp16):
-                    preds, preds_depth = self.test_step(data)                
+                    preds, preds_depth = self.test_step(data, cache=cache)                
                 
                 path = os.path.join(save_path, f'{name}_{i:04d}_rgb.png')
                 path_depth = os.path.join(save_path, f'{name}_{i:04d}_depth.png')
@@ -1179,6 +1369,11 @@ class Trainer(object):
 
                 pbar.update(loader.batch_size)
 
+        if cache is not None:
+            self.log(f"[INFO] static cache: {cache.report()}")
+
+        self.model.set_audio_table(None)
+
         # write video
         all_preds = np.stack(all_preds, axis=0)
         all_preds_depth = np.stack(all_preds_depth, axis=0)
@@ -1198,7 +1393,10 @@ class Trainer(object):
 
         # mark untrained grid
         if self.global_step == 0:
-            self.model.mark_untrained_grid(train_loader._data.poses, train_loader._data.intrinsics)
+            self.model.mark_untrained_grid(train_loader._data.poses, train_loader._data.intrinsics, cache_path=os.path.join(train_loader._data.root_path, 'untrained_grid.npz'))
+
+        # get a ref to error_map
+        self.error_map = train_loader._data.error_map
 
         for _ in range(step):
             
@@ -1314,7 +1512,8 @@ class Trainer(object):
         return outputs
 
     # [GUI] test with provided data
-    def test_gui_with_data(self, data, W, H):
+    def test_gui_with_data(self, data, W, H, audio_stream=None):
+        # audio_stream: StreamingAudioEncoder, when data['auds'] is the next window of the live ASR
         
         self.model.eval()
 
@@ -1324,6 +1523,8 @@ class Trainer(object):
 
         with torch.no_grad():
             with torch.cuda.amp.autocast(enabled=self.fp16):
+                if audio_stream is not None:
+                    data['enc_a'] = audio_stream(data['auds'])
                 # here spp is used as perturb random seed!
                 # face: do not perturb for the first spp, else lead to scatters.
                 preds, preds_depth = self.test_step(data, perturb=False)
@@ -1415,6 +1616,15 @@ class Trainer(object):
         average_loss = total_loss / self.local_step
         self.stats["loss"].append(average_loss)
 
+        frame_cache = getattr(loader._data, 'frame_cache', None)
+        if frame_cache is not None:
+            self.log(f"[INFO] {frame_cache.report()}")
+            frame_cache.clear_stats()
+
+        if self.model.cuda_ray:
+            self.log(f"[INFO] {self.model.report_grid_stats()}")
+            self.model.clear_grid_stats()
+
         if self.local_rank == 0:
             pbar.close()
             if self.report_metric_at_train:
@@ -1517,6 +1727,18 @@ class Trainer(object):
         average_loss = total_loss / self.local_step
         self.stats["valid_loss"].append(average_loss)
 
+        # dump the training error map: raw [N, res, res] values and the mean over frames as an image
+        if self.local_rank == 0 and self.error_map is not None and self.workspace is not None:
+            error_map = self.error_map.detach().cpu()
+            res = int(math.sqrt(error_map.shape[-1]))
+            error_map = error_map.view(-1, res, res).numpy()
+            save_path_error = os.path.join(self.workspace, 'validation', f'{name}_errormap')
+            os.makedirs(os.path.dirname(save_path_error), exist_ok=True)
+            np.save(save_path_error + '.npy', error_map)
+            mean_error = error_map.mean(0)
+            mean_error = mean_error / max(mean_error.max(), 1e-8)
+            cv2.imwrite(save_path_error + '.png', (mean_error * 255).astype(np.uint8))
+
         if self.local_rank == 0:
             pbar.close()
             if not self.use_loss_as_metric and len(self.metrics) > 0:
@@ -1623,7 +1845,12 @@ class Trainer(object):
             self.log(f"[WARN] unexpected keys: {unexpected_keys}")   
 
         if self.ema is not None and 'ema' in checkpoint_dict:
-            self.ema.load_state_dict(checkpoint_dict['ema'])
+            try:
+                self.ema.load_state_dict(checkpoint_dict['ema'])
+            except (ValueError, RuntimeError):
+                # e.g. the parameter list changed (fused triplane encoder or enc_x heads), restart from the loaded model.
+                self.log("[WARN] Failed to load ema, reset it to the loaded model.")
+                self.ema = ExponentialMovingAverage(self.model.parameters(), decay=self.ema_decay)
 
     
         if 'mean_count' in checkpoint_dict:
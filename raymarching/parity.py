@@ -0,0 +1,149 @@
+''' Check the pytorch kernels (torch_backend.py) against the CUDA extension.
+Needs a GPU and the compiled extension, run from the repo root:
+    python -m raymarching.parity
+'''
+
+import torch
+
+from . import torch_backend
+from .backend import _backend
+
+
+def check(name, a, b, atol=1e-4, rtol=1e-3):
+    a = a.float().cpu()
+    b = b.float().cpu()
+    ok = a.shape == b.shape and torch.allclose(a, b, atol=atol, rtol=rtol)
+    err = (a - b).abs().max().item() if a.shape == b.shape and a.numel() > 0 else float('nan')
+    print(f'[{"OK" if ok else "FAIL"}] {name}: max abs err = {err:.3e}')
+    return ok
+
+
+def run_both(fn, *args, outputs):
+    ''' call fn of both backends on copies of the inputs.
+    Args:
+        args: arguments, tensors are copied to the GPU for CUDA and to the CPU for pytorch.
+        outputs: indices of args that are written in-place.
+    Returns:
+        two lists with the in-place outputs of CUDA and pytorch.
+    '''
+    results = []
+    for backend, device in ((_backend.load(), 'cuda'), (torch_backend, 'cpu')):
+        xs = [x.clone().to(device) if torch.is_tensor(x) else x for x in args]
+        getattr(backend, fn)(*xs)
+        results.append([xs[i] for i in outputs])
+    return results
+
+
+def random_rays(N, device='cpu'):
+    rays_o = torch.randn(N, 3, device=device) * 0.3 + torch.tensor([0, 0, 2.0], device=device)
+    rays_d = torch.nn.functional.normalize(torch.randn(N, 3, device=device) * 0.2 + torch.tensor([0, 0, -1.0], device=device), dim=-1)
+    return rays_o, rays_d
+
+
+def main(N=4096, C=1, H=128, bound=1, seed=0):
+    torch.manual_seed(seed)
+    ok = True
+
+    rays_o, rays_d = random_rays(N)
+    aabb = torch.tensor([-bound, -bound, -bound, bound, bound, bound], dtype=torch.float32)
+
+    # utils
+    (c_near, c_far), (t_near, t_far) = run_both('near_far_from_aabb', rays_o, rays_d, aabb, N, 0.05, torch.empty(N), torch.empty(N), outputs=[5, 6])
+    ok &= check('near_far_from_aabb/nears', c_near, t_near)
+    ok &= check('near_far_from_aabb/fars', c_far, t_far)
+    nears, fars = t_near, t_far
+
+    (c_coords,), (t_coords,) = run_both('sph_from_ray', rays_o, rays_d, 10.0, N, torch.empty(N, 2), outputs=[4])
+    ok &= check('sph_from_ray', c_coords, t_coords)
+
+    coords = torch.randint(0, H, (N, 3), dtype=torch.int32)
+    (c_ind,), (t_ind,) = run_both('morton3D', coords, N, torch.empty(N, dtype=torch.int32), outputs=[2])
+    ok &= check('morton3D', c_ind, t_ind, atol=0, rtol=0)
+
+    (c_xyz,), (t_xyz,) = run_both('morton3D_invert', t_ind, N, torch.empty(N, 3, dtype=torch.int32), outputs=[2])
+    ok &= check('morton3D_invert', c_xyz, t_xyz, atol=0, rtol=0)
+
+    # a blob of density in the middle, so rays both hit and skip voxels.
+    grid = torch.rand(C, H ** 3) * (torch.rand(C, H ** 3) > 0.7)
+    (c_dil,), (t_dil,) = run_both('morton3D_dilation', grid, C, H, torch.empty(C, H ** 3), outputs=[3])
+    ok &= check('morton3D_dilation', c_dil, t_dil, atol=0, rtol=0)
+
+    (c_bits,), (t_bits,) = run_both('packbits', grid, C * H ** 3 // 8, 0.5, torch.empty(C * H ** 3 // 8, dtype=torch.uint8), outputs=[3])
+    ok &= check('packbits', c_bits, t_bits, atol=0, rtol=0)
+    bitfield = t_bits
+
+    # training: ray order differs (atomics), so compare ray by ray.
+    max_steps = 1024
+    M = N * max_steps
+    args = [rays_o, rays_d, bitfield, bound, 0, max_steps, N, C, H, M, nears, fars,
+            torch.zeros(M, 3), torch.zeros(M, 3), torch.zeros(M, 2), torch.empty(N, 3, dtype=torch.int32), torch.zeros(2, dtype=torch.int32), torch.zeros(N)]
+    c_out, t_out = run_both('march_rays_train', *args, outputs=[12, 13, 14, 15, 16])
+    ok &= check('march_rays_train/counter', c_out[4], t_out[4], atol=0, rtol=0)
+
+    def by_ray(xyzs, dirs, deltas, rays, counter):
+        xyzs, deltas, rays = xyzs.cpu(), deltas.cpu(), rays.cpu().long()
+        rays = rays[torch.argsort(rays[:, 0])]
+        _, seg, point, _ = torch_backend._segments(rays, xyzs.shape[0])
+        return rays[:, 2], xyzs[point], deltas[point]
+
+    c_counts, c_xyzs, c_deltas = by_ray(*c_out)
+    t_counts, t_xyzs, t_deltas = by_ray(*t_out)
+    ok &= check('march_rays_train/num_steps', c_counts, t_counts, atol=0, rtol=0)
+    ok &= check('march_rays_train/xyzs', c_xyzs, t_xyzs)
+    ok &= check('march_rays_train/deltas', c_deltas, t_deltas)
+
+    # composite forward / backward, fed with the pytorch rays layout for both.
+    xyzs, dirs, deltas, rays, counter = t_out
+    M = int(counter[0])
+    sigmas = torch.rand(M) * 20
+    rgbs = torch.rand(M, 3)
+    amb_aud, amb_eye, uncertainty = torch.rand(M), torch.rand(M), torch.rand(M)
+    deltas = deltas[:M]
+    outs = [torch.empty(N) for _ in range(5)] + [torch.empty(N, 3)]
+    c_fwd, t_fwd = run_both('composite_rays_train_triplane_forward', sigmas, rgbs, amb_aud, amb_eye, uncertainty, deltas, rays, M, N, 1e-4, *outs, outputs=list(range(10, 16)))
+    for name, a, b in zip(['weights_sum', 'amb_aud_sum', 'amb_eye_sum', 'uncertainty_sum', 'depth', 'image'], c_fwd, t_fwd):
+        ok &= check(f'composite_rays_train_triplane_forward/{name}', a, b)
+
+    grads = [torch.randn(N) for _ in range(4)] + [torch.randn(N, 3)]
+    grad_outs = [torch.zeros(M), torch.zeros(M, 3), torch.zeros(M), torch.zeros(M), torch.zeros(M)]
+    weights_sum, amb_aud_sum, amb_eye_sum, uncertainty_sum, depth, image = t_fwd
+    c_bwd, t_bwd = run_both('composite_rays_train_triplane_backward', *grads, sigmas, rgbs, amb_aud, amb_eye, uncertainty, deltas, rays, weights_sum, amb_aud_sum, amb_eye_sum, uncertainty_sum, image, M, N, 1e-4, *grad_outs, outputs=list(range(20, 25)))
+    for name, a, b in zip(['sigmas', 'rgbs', 'amb_aud', 'amb_eye', 'uncertainty'], c_bwd, t_bwd):
+        ok &= check(f'composite_rays_train_triplane_backward/{name}', a, b, atol=1e-3)
+
+    grad_xyzs, grad_dirs = torch.randn(M, 3), torch.randn(M, 3)
+    c_grad, t_grad = run_both('march_rays_train_backward', grad_xyzs, grad_dirs, rays, deltas, N, M, torch.zeros(N, 3), torch.zeros(N, 3), outputs=[6, 7])
+    ok &= check('march_rays_train_backward/rays_o', c_grad[0], t_grad[0], atol=1e-3)
+    ok &= check('march_rays_train_backward/rays_d', c_grad[1], t_grad[1], atol=1e-3)
+
+    # inference: one round of march + composite on all rays.
+    n_step = 8
+    P = N * n_step
+    rays_alive = torch.arange(N, dtype=torch.int32)
+    c_march, t_march = run_both('march_rays', N, n_step, rays_alive, nears.clone(), rays_o, rays_d, bound, 0, max_steps, C, H, bitfield, nears, fars, torch.zeros(P, 3), torch.zeros(P, 3), torch.zeros(P, 2), torch.zeros(N), outputs=[14, 15, 16])
+    ok &= check('march_rays/xyzs', c_march[0], t_march[0])
+    ok &= check('march_rays/deltas', c_march[2], t_march[2])
+
+    deltas = t_march[2]
+    sigmas, rgbs = torch.rand(P) * 20, torch.rand(P, 3)
+    ambs_aud, ambs_eye, uncertainties = torch.rand(P), torch.rand(P), torch.rand(P)
+    state = [rays_alive, nears.clone()]
+    sums = [torch.zeros(N), torch.zeros(N), torch.zeros(N, 3), torch.zeros(N), torch.zeros(N), torch.zeros(N)]
+    c_comp, t_comp = run_both('composite_rays_triplane', N, n_step, 1e-2, *state, sigmas, rgbs, deltas, ambs_aud, ambs_eye, uncertainties, *sums, outputs=[3, 4] + list(range(11, 17)))
+    for name, a, b in zip(['rays_alive', 'rays_t', 'weights_sum', 'depth', 'image', 'amb_aud_sum', 'amb_eye_sum', 'uncertainty_sum'], c_comp, t_comp):
+        ok &= check(f'composite_rays_triplane/{name}', a, b, atol=0 if name == 'rays_alive' else 1e-4)
+
+    # compaction of the rays terminated above.
+    rays_alive = t_comp[0]
+    c_cmp, t_cmp = run_both('compact_rays', N, rays_alive, torch.full((N,), -1, dtype=torch.int32), torch.zeros(1, dtype=torch.int32), outputs=[2, 3])
+    ok &= check('compact_rays/counter', c_cmp[1], t_cmp[1], atol=0, rtol=0)
+    n = int(t_cmp[1][0])
+    ok &= check('compact_rays/rays_alive', c_cmp[0][:n], t_cmp[0][:n], atol=0, rtol=0)
+
+    print('[INFO] all kernels match.' if ok else '[WARN] some kernels differ, see above.')
+    return ok
+
+
+if __name__ == '__main__':
+    assert _backend.use_cuda, 'parity check needs a GPU and the CUDA extension.'
+    main()
@@ -6,10 +6,8 @@ import torch.nn as nn
 from torch.autograd import Function
 from torch.cuda.amp import custom_bwd, custom_fwd
 
-try:
-    import _raymarching_face as _backend
-except ImportError:
-    from .backend import _backend
+# kernels are loaded on first use, see backend.py
+from .backend import _backend
 
 # ----------------------------------------
 # utils
@@ -30,8 +28,8 @@ class _near_far_from_aabb(Function):
             nears: float, [N]
             fars: float, [N]
         '''
-        if not rays_o.is_cuda: rays_o = rays_o.cuda()
-        if not rays_d.is_cuda: rays_d = rays_d.cuda()
+        if _backend.use_cuda and not rays_o.is_cuda: rays_o = rays_o.cuda()
+        if _backend.use_cuda and not rays_d.is_cuda: rays_d = rays_d.cuda()
 
         rays_o = rays_o.contiguous().view(-1, 3)
         rays_d = rays_d.contiguous().view(-1, 3)
@@ -62,8 +60,8 @@ class _sph_from_ray(Function):
         Return:
             coords: [N, 2], in [-1, 1], theta and phi on a sphere. (further-surface)
         '''
-        if not rays_o.is_cuda: rays_o = rays_o.cuda()
-        if not rays_d.is_cuda: rays_d = rays_d.cuda()
+        if _backend.use_cuda and not rays_o.is_cuda: rays_o = rays_o.cuda()
+        if _backend.use_cuda and not rays_d.is_cuda: rays_d = rays_d.cuda()
 
         rays_o = rays_o.contiguous().view(-1, 3)
         rays_d = rays_d.contiguous().view(-1, 3)
@@ -90,7 +88,7 @@ class _morton3D(Function):
             indices: [N], int32, in [0, 128^3)
             
         '''
-        if not coords.is_cuda: coords = coords.cuda()
+        if _backend.use_cuda and not coords.is_cuda: coords = coords.cuda()
         
         N = coords.shape[0]
 
@@ -112,7 +110,7 @@ class _morton3D_invert(Function):
             coords: [N, 3], int32, in [0, 128)
             
         '''
-        if not indices.is_cuda: indices = indices.cuda()
+        if _backend.use_cuda and not indices.is_cuda: indices = indices.cuda()
         
         N = indices.shape[0]
 
@@ -137,7 +135,7 @@ class _packbits(Function):
         Returns:
             bitfield: uint8, [C, H * H * H / 8]
         '''
-        if not grid.is_cuda: grid = grid.cuda()
+        if _backend.use_cuda and not grid.is_cuda: grid = grid.cuda()
         grid = grid.contiguous()
 
         C = grid.shape[0]
@@ -165,7 +163,7 @@ class _morton3D_dilation(Function):
         Returns:
             grid_dilate: float, [C, H * H * H], assume H % 2 == 0bitfield: uint8, [C, H * H * H / 8]
         '''
-        if not grid.is_cuda: grid = grid.cuda()
+        if _backend.use_cuda and not grid.is_cuda: grid = grid.cuda()
         grid = grid.contiguous()
 
         C = grid.shape[0]
@@ -212,9 +210,9 @@ class _march_rays_train(Function):
             rays: int32, [N, 3], all rays' (index, point_offset, point_count), e.g., xyzs[rays[i, 1]:rays[i, 1] + rays[i, 2]] --> points belonging to rays[i, 0]
         '''
 
-        if not rays_o.is_cuda: rays_o = rays_o.cuda()
-        if not rays_d.is_cuda: rays_d = rays_d.cuda()
-        if not density_bitfield.is_cuda: density_bitfield = density_bitfield.cuda()
+        if _backend.use_cuda and not rays_o.is_cuda: rays_o = rays_o.cuda()
+        if _backend.use_cuda and not rays_d.is_cuda: rays_d = rays_d.cuda()
+        if _backend.use_cuda and not density_bitfield.is_cuda: density_bitfield = density_bitfield.cuda()
         
         rays_o = rays_o.contiguous().view(-1, 3)
         rays_d = rays_d.contiguous().view(-1, 3)
@@ -350,7 +348,7 @@ composite_rays_train = _composite_rays_train.apply
 class _march_rays(Function):
     @staticmethod
     @custom_fwd(cast_inputs=torch.float32)
-    def forward(ctx, n_alive, n_step, rays_alive, rays_t, rays_o, rays_d, bound, density_bitfield, C, H, near, far, align=-1, perturb=False, dt_gamma=0, max_steps=1024):
+    def forward(ctx, n_alive, n_step, rays_alive, rays_t, rays_o, rays_d, bound, density_bitfield, C, H, near, far, align=-1, perturb=False, dt_gamma=0, max_steps=1024, workspace=None):
         ''' march rays to generate points (forward only, for inference)
         Args:
             n_alive: int, number of alive rays
@@ -367,14 +365,16 @@ class _march_rays(Function):
             perturb: bool/int, int > 0 is used as the random seed.
             dt_gamma: float, called cone_angle in instant-ngp, exponentially accelerate ray marching if > 0. (very significant effect, but generally lead to worse performance)
             max_steps: int, max number of sampled points along each ray, also affect min_stepsize.
+            workspace: dict of preallocated float buffers xyzs [>= M, 3], dirs [>= M, 3], deltas [>= M, 2] and noises [>= n_alive],
+                the outputs are then views of them (overwritten by the next call) instead of new tensors.
         Returns:
             xyzs: float, [n_alive * n_step, 3], all generated points' coords
             dirs: float, [n_alive * n_step, 3], all generated points' view dirs.
             deltas: float, [n_alive * n_step, 2], all generated points' deltas (here we record two deltas, the first is for RGB, the second for depth).
         '''
         
-        if not rays_o.is_cuda: rays_o = rays_o.cuda()
-        if not rays_d.is_cuda: rays_d = rays_d.cuda()
+        if _backend.use_cuda and not rays_o.is_cuda: rays_o = rays_o.cuda()
+        if _backend.use_cuda and not rays_d.is_cuda: rays_d = rays_d.cuda()
         
         rays_o = rays_o.contiguous().view(-1, 3)
         rays_d = rays_d.contiguous().view(-1, 3)
@@ -384,15 +384,27 @@ class _march_rays(Function):
         if align > 0:
             M += align - (M % align)
         
-        xyzs = torch.zeros(M, 3, dtype=rays_o.dtype, device=rays_o.device)
-        dirs = torch.zeros(M, 3, dtype=rays_o.dtype, device=rays_o.device)
-        deltas = torch.zeros(M, 2, dtype=rays_o.dtype, device=rays_o.device) # 2 vals, one for rgb, one for depth
+        if workspace is not None:
+            # steps a ray does not reach are left untouched by the kernel, and deltas == 0 marks them for composite_rays*.
+            xyzs = workspace['xyzs'][:M].zero_()
+            dirs = workspace['dirs'][:M].zero_()
+            deltas = workspace['deltas'][:M].zero_()
+            noises = workspace['noises'][:n_alive]
+            if perturb:
+                noises.uniform_()
+            else:
+                noises.zero_()
 
-        if perturb:
-            # torch.manual_seed(perturb) # test_gui uses spp index as seed
-            noises = torch.rand(n_alive, dtype=rays_o.dtype, device=rays_o.device)
         else:
-            noises = torch.zeros(n_alive, dtype=rays_o.dtype, device=rays_o.device)
+            xyzs = torch.zeros(M, 3, dtype=rays_o.dtype, device=rays_o.device)
+            dirs = torch.zeros(M, 3, dtype=rays_o.dtype, device=rays_o.device)
+            deltas = torch.zeros(M, 2, dtype=rays_o.dtype, device=rays_o.device) # 2 vals, one for rgb, one for depth
+
+            if perturb:
+                # torch.manual_seed(perturb) # test_gui uses spp index as seed
+                noises = torch.rand(n_alive, dtype=rays_o.dtype, device=rays_o.device)
+            else:
+                noises = torch.zeros(n_alive, dtype=rays_o.dtype, device=rays_o.device)
 
         _backend.march_rays(n_alive, n_step, rays_alive, rays_t, rays_o, rays_d, bound, dt_gamma, max_steps, C, H, density_bitfield, near, far, xyzs, dirs, deltas, noises)
 
@@ -671,4 +683,20 @@ class _composite_rays_triplane(Function):
         return tuple()
 
 
-composite_rays_triplane = _composite_rays_triplane.apply
\ No newline at end of file
+composite_rays_triplane = _composite_rays_triplane.apply
+
+
+def compact_rays(n_alive, rays_alive, rays_alive_out, counter):
+    ''' remove the rays terminated by composite_rays* (rays_alive = -1) without allocating, for inference.
+    Args:
+        n_alive: int, number of rays in rays_alive
+        rays_alive: int, [N], the first n_alive are used
+        rays_alive_out: int, [N], a different buffer, the alive ids are written to its front in the same order
+        counter: int, [1], scratch buffer
+    Returns:
+        n_alive: int, number of alive rays in rays_alive_out
+    The count is read back to the host, the one sync per marching step: n_alive sizes the next march_rays and the loop exit.
+    It replaces the sync of the boolean indexing (rays_alive[rays_alive >= 0]) used without a workspace.
+    '''
+    _backend.compact_rays(n_alive, rays_alive, rays_alive_out, counter)
+    return int(counter.item())
@@ -35,5 +35,6 @@ PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
     m.def("composite_rays_train_triplane_forward", &composite_rays_train_triplane_forward, "composite_rays_train_forward (CUDA)");
     m.def("composite_rays_train_triplane_backward", &composite_rays_train_triplane_backward, "composite_rays_train_backward (CUDA)");
     m.def("composite_rays_triplane", &composite_rays_triplane, "composite rays with ambient (CUDA)");
+    m.def("compact_rays", &compact_rays, "compact alive rays (CUDA)");
 
 }
\ No newline at end of file
@@ -5,6 +5,8 @@
 #include <ATen/cuda/CUDAContext.h>
 #include <torch/torch.h>
 
+#include <cub/cub.cuh>
+
 #include <cstdio>
 #include <stdint.h>
 #include <stdexcept>
@@ -2256,3 +2258,20 @@ void composite_rays_triplane(const uint32_t n_alive, const uint32_t n_step, cons
         kernel_composite_rays_triplane<<<div_round_up(n_alive, N_THREAD), N_THREAD>>>(n_alive, n_step, T_thresh, rays_alive.data_ptr<int>(), rays_t.data_ptr<scalar_t>(), sigmas.data_ptr<scalar_t>(), rgbs.data_ptr<scalar_t>(), deltas.data_ptr<scalar_t>(), ambs_aud.data_ptr<scalar_t>(), ambs_eye.data_ptr<scalar_t>(), uncertainties.data_ptr<scalar_t>(), weights.data_ptr<scalar_t>(), depth.data_ptr<scalar_t>(), image.data_ptr<scalar_t>(), amb_aud_sum.data_ptr<scalar_t>(), amb_eye_sum.data_ptr<scalar_t>(), uncertainty_sum.data_ptr<scalar_t>());
     }));
 }
+
+
+struct is_alive {
+    __host__ __device__ bool operator()(const int index) const { return index >= 0; }
+};
+
+
+// rays_alive: [n_alive], ray ids, -1 for the rays terminated by composite_rays*
+// rays_alive_out: [N], the alive ids are written to the front, in the same order (an ordered scan, so rendering is deterministic)
+// counter: [1], number of alive rays
+void compact_rays(const uint32_t n_alive, const at::Tensor rays_alive, at::Tensor rays_alive_out, at::Tensor counter) {
+    // first call only sizes the scan's scratch, which comes from the caching allocator.
+    size_t temp_bytes = 0;
+    cub::DeviceSelect::If(nullptr, temp_bytes, rays_alive.data_ptr<int>(), rays_alive_out.data_ptr<int>(), counter.data_ptr<int>(), (int)n_alive, is_alive());
+    at::Tensor temp = at::empty({(int64_t)temp_bytes}, rays_alive.options().dtype(at::kByte));
+    cub::DeviceSelect::If(temp.data_ptr(), temp_bytes, rays_alive.data_ptr<int>(), rays_alive_out.data_ptr<int>(), counter.data_ptr<int>(), (int)n_alive, is_alive());
+}
@@ -0,0 +1,464 @@
+''' Pure-PyTorch implementation of the raymarching kernels.
+
+Every function mirrors the binding of the same name in src/bindings.cpp: same arguments, and outputs are written
+in-place into the preallocated tensors, so the autograd wrappers in raymarching.py run unchanged on top of it.
+Rays are processed in parallel, the per-ray loops of the CUDA kernels become loops over marching iterations.
+'''
+
+import math
+
+import torch
+
+SQRT3 = math.sqrt(3)
+
+
+# ----------------------------------------
+# helpers
+# ----------------------------------------
+
+def _expand_bits(v):
+    # v: int64 tensor in [0, 1024)
+    v = (v * 0x00010001) & 0xFF0000FF
+    v = (v * 0x00000101) & 0x0F00F00F
+    v = (v * 0x00000011) & 0xC30C30C3
+    v = (v * 0x00000005) & 0x49249249
+    return v
+
+
+def _morton3D(x, y, z):
+    return _expand_bits(x) | (_expand_bits(y) << 1) | (_expand_bits(z) << 2)
+
+
+def _morton3D_invert(x):
+    x = x & 0x49249249
+    x = (x | (x >> 2)) & 0xc30c30c3
+    x = (x | (x >> 4)) & 0x0f00f00f
+    x = (x | (x >> 8)) & 0xff0000ff
+    x = (x | (x >> 16)) & 0x0000ffff
+    return x
+
+
+def _mip_level(mx, C):
+    # frexp exponent: [0, 0.5) --> -1, [0.5, 1) --> 0, [1, 2) --> 1, [2, 4) --> 2, ...
+    return torch.frexp(mx)[1].long().clamp(0, C - 1)
+
+
+def _segments(rays, M):
+    ''' unpack the (index, offset, num_steps) layout of training rays.
+    Empty rays and rays that exceed M (dropped by march_rays_train) are skipped, as in the CUDA kernels.
+    Returns:
+        index: int64, [R], output slot of each valid ray.
+        seg: int64, [P], which valid ray each point belongs to, points of a ray are contiguous and in marching order.
+        point: int64, [P], row of each point in sigmas/rgbs/deltas.
+        start: int64, [R], position of each ray's first point in [P].
+    '''
+    rays = rays.long()
+    counts = rays[:, 2]
+    valid = (counts > 0) & (rays[:, 1] + counts <= M)
+    rays = rays[valid]
+    counts = counts[valid]
+
+    start = torch.cumsum(counts, 0) - counts
+    seg = torch.repeat_interleave(torch.arange(rays.shape[0], device=rays.device), counts)
+    point = rays[seg, 1] + torch.arange(seg.shape[0], device=rays.device) - start[seg]
+
+    return rays[:, 0], seg, point, start
+
+
+def _segment_cumsum(values, seg, start):
+    # inclusive cumsum restarted at every ray, accumulated in double as a ray may sit deep in a long buffer.
+    cs = torch.cumsum(values.double(), 0)
+    before = cs[start] - values[start].double()
+    return (cs - before[seg]).to(values.dtype)
+
+
+def _segment_sum(values, seg, R):
+    out = torch.zeros(R, *values.shape[1:], dtype=values.dtype, device=values.device)
+    return out.index_add_(0, seg, values)
+
+
+def _occupied(xyzs, dts, bound, C, H, grid):
+    ''' query the packed occupancy bitfield.
+    Returns:
+        occ: bool, [n]
+        nxyzs: int64, [n, 3], voxel coordinates at the selected cascade.
+        mip_bound: float, [n]
+    '''
+    level = torch.maximum(_mip_level(xyzs.abs().amax(-1), C), _mip_level(dts * H * 0.5, C))
+    mip_bound = torch.clamp(torch.pow(2.0, level.to(xyzs.dtype)), max=bound)
+    mip_rbound = 1 / mip_bound
+
+    # the CUDA kernel scales by a double 0.5, keep that precision for the truncation to voxel coords.
+    nxyzs = ((xyzs * mip_rbound[:, None] + 1).double() * 0.5 * H).to(xyzs.dtype).clamp(0, H - 1).long()
+
+    index = level * H ** 3 + _morton3D(nxyzs[:, 0], nxyzs[:, 1], nxyzs[:, 2])
+    occ = (grid[index // 8].long() >> (index % 8)) & 1
+
+    return occ.bool(), nxyzs, mip_bound
+
+
+def _march(rays_o, rays_d, t, fars, max_points, bound, dt_gamma, max_steps, C, H, grid):
+    ''' march all rays together, one event (a sampled point or a skipped voxel) per ray and iteration.
+    Args:
+        rays_o/d: float, [n, 3]
+        t: float, [n], starting t (already perturbed)
+        fars: float, [n]
+        max_points: int, max number of points of each ray
+    Returns:
+        ray_ids: int64, [P], steps: int64, [P], xyzs: [P, 3], dts: [P], ts: [P] (t after the step)
+        num_steps: int64, [n]
+    '''
+    n = rays_o.shape[0]
+    device = rays_o.device
+
+    dt_max = 2 * SQRT3 * (1 << (C - 1)) / H
+    dt_min = min(dt_max, 2 * SQRT3 / max_steps)
+    rH = 1 / H
+
+    rays_rd = 1 / rays_d
+    signs = torch.copysign(torch.ones_like(rays_d), rays_d)
+
+    t = t.clone()
+    num_steps = torch.zeros(n, dtype=torch.long, device=device)
+    outputs = []
+
+    alive = torch.nonzero(t < fars, as_tuple=False).squeeze(1)
+
+    while alive.numel() > 0:
+        ta = t[alive]
+        xyzs = (rays_o[alive] + ta[:, None] * rays_d[alive]).clamp(-bound, bound)
+        dts = (ta * dt_gamma).clamp(dt_min, dt_max)
+
+        occ, nxyzs, mip_bound = _occupied(xyzs, dts, bound, C, H, grid)
+
+        # occupied: write the point and advance a small step
+        ids = alive[occ]
+        if ids.numel() > 0:
+            t_next = ta[occ] + dts[occ]
+            outputs.append((ids, num_steps[ids], xyzs[occ], dts[occ], t_next))
+            t[ids] = t_next
+            num_steps[ids] += 1
+
+        # empty: step until the next voxel
+        empty = ~occ
+        ids = alive[empty]
+        if ids.numel() > 0:
+            te = ta[empty]
+            txyz = (((nxyzs[empty].to(te.dtype) + 0.5 + 0.5 * signs[ids]) * rH * 2 - 1) * mip_bound[empty, None] - xyzs[empty]) * rays_rd[ids]
+            tt = te + torch.fmax(torch.zeros_like(te), torch.fmin(txyz[:, 0], torch.fmin(txyz[:, 1], txyz[:, 2])))
+            stepping = torch.ones_like(te, dtype=torch.bool)
+            while stepping.any():
+                te = torch.where(stepping, te + (te * dt_gamma).clamp(dt_min, dt_max), te)
+                stepping = te < tt
+            t[ids] = te
+
+        alive = alive[(t[alive] < fars[alive]) & (num_steps[alive] < max_points)]
+
+    if len(outputs) == 0:
+        empty = torch.empty(0, dtype=torch.long, device=device)
+        return empty, empty, rays_o.new_empty(0, 3), rays_o.new_empty(0), rays_o.new_empty(0), num_steps
+
+    ray_ids, steps, xyzs, dts, ts = [torch.cat(x, 0) for x in zip(*outputs)]
+
+    return ray_ids, steps, xyzs, dts, ts, num_steps
+
+
+# ----------------------------------------
+# utils
+# ----------------------------------------
+
+def near_far_from_aabb(rays_o, rays_d, aabb, N, min_near, nears, fars):
+    rays_o = rays_o.view(-1, 3)
+    rays_d = rays_d.view(-1, 3)
+    aabb = aabb.to(rays_o)
+
+    rd = 1 / rays_d
+    t0 = (aabb[:3] - rays_o) * rd
+    t1 = (aabb[3:] - rays_o) * rd
+    swap = t0 > t1
+    near_xyz = torch.where(swap, t1, t0)
+    far_xyz = torch.where(swap, t0, t1)
+
+    near, far = near_xyz[:, 0], far_xyz[:, 0]
+    miss = torch.zeros_like(near, dtype=torch.bool)
+    for i in (1, 2):
+        miss |= (near > far_xyz[:, i]) | (near_xyz[:, i] > far)
+        near = torch.where(near_xyz[:, i] > near, near_xyz[:, i], near)
+        far = torch.where(far_xyz[:, i] < far, far_xyz[:, i], far)
+
+    near = torch.where(near < min_near, torch.full_like(near, min_near), near)
+
+    fmax = torch.finfo(nears.dtype).max
+    nears.copy_(torch.where(miss, torch.full_like(near, fmax), near))
+    fars.copy_(torch.where(miss, torch.full_like(far, fmax), far))
+
+
+def sph_from_ray(rays_o, rays_d, radius, N, coords):
+    rays_o = rays_o.view(-1, 3)
+    rays_d = rays_d.view(-1, 3)
+
+    # solve t from || o + td || = radius, always use the larger solution (positive)
+    A = (rays_d * rays_d).sum(-1)
+    B = (rays_o * rays_d).sum(-1) # in fact B / 2
+    C = (rays_o * rays_o).sum(-1) - radius * radius
+    t = (- B + torch.sqrt(B * B - A * C)) / A
+
+    # solve theta, phi (assume y is the up axis)
+    x, y, z = (rays_o + t[:, None] * rays_d).unbind(-1)
+    theta = torch.atan2(torch.sqrt(x * x + z * z), y) # [0, PI)
+    phi = torch.atan2(z, x) # [-PI, PI)
+
+    # normalize to [-1, 1]
+    coords.copy_(torch.stack([2 * theta / math.pi - 1, phi / math.pi], -1))
+
+
+def morton3D(coords, N, indices):
+    coords = coords.long()
+    indices.copy_(_morton3D(coords[:, 0], coords[:, 1], coords[:, 2]))
+
+
+def morton3D_invert(indices, N, coords):
+    indices = indices.long()
+    coords.copy_(torch.stack([_morton3D_invert(indices >> i) for i in range(3)], -1))
+
+
+def packbits(grid, N, density_thresh, bitfield):
+    bits = (grid.reshape(-1, 8) > density_thresh).long() << torch.arange(8, device=grid.device)
+    bitfield.copy_(bits.sum(-1))
+
+
+def morton3D_dilation(grid, C, H, grid_dilation):
+    grid = grid.reshape(C, -1)
+
+    # manual max pool over the 6-neighbourhood, in morton order.
+    ind = torch.arange(H ** 3, device=grid.device)
+    x, y, z = [_morton3D_invert(ind >> i) for i in range(3)]
+
+    res = grid.clone()
+    for axis, delta in ((0, 1), (0, -1), (1, 1), (1, -1), (2, 1), (2, -1)):
+        xyz = [x, y, z]
+        xyz[axis] = xyz[axis] + delta
+        valid = (xyz[axis] >= 0) & (xyz[axis] < H)
+        neighbour = _morton3D(*[c.clamp(0, H - 1) for c in xyz])
+        res = torch.where(valid, torch.maximum(res, grid[:, neighbour]), res)
+
+    grid_dilation.copy_(res.view_as(grid_dilation))
+
+
+# ----------------------------------------
+# train functions
+# ----------------------------------------
+
+def march_rays_train(rays_o, rays_d, grid, bound, dt_gamma, max_steps, N, C, H, M, nears, fars, xyzs, dirs, deltas, rays, counter, noises):
+    dt_max = 2 * SQRT3 * (1 << (C - 1)) / H
+    dt_min = min(dt_max, 2 * SQRT3 / max_steps)
+
+    # perturb
+    t0 = nears + (nears * dt_gamma).clamp(dt_min, dt_max) * noises
+
+    ray_ids, steps, points, dts, ts, num_steps = _march(rays_o, rays_d, t0, fars, max_steps, bound, dt_gamma, max_steps, C, H, grid)
+
+    # rays are laid out in order (the CUDA kernel takes them in whatever order the atomics give).
+    offsets = counter[0].long() + torch.cumsum(num_steps, 0) - num_steps
+    rays.copy_(torch.stack([torch.arange(N, device=rays.device), offsets, num_steps], -1))
+    counter[0] += num_steps.sum().to(counter.dtype)
+    counter[1] += N
+
+    # points of rays exceeding M are dropped.
+    keep = offsets[ray_ids] + num_steps[ray_ids] <= M
+    index = offsets[ray_ids[keep]] + steps[keep]
+    xyzs[index] = points[keep]
+    dirs[index] = rays_d[ray_ids[keep]]
+    deltas[index] = torch.stack([dts[keep], ts[keep]], -1)
+
+
+def march_rays_train_backward(grad_xyzs, grad_dirs, rays, deltas, N, M, grad_rays_o, grad_rays_d):
+    # the CUDA kernel accumulates into row n of the grads, not rays[n, 0].
+    rays = rays.long()
+    counts = rays[:, 2]
+    valid = torch.nonzero((counts > 0) & (rays[:, 1] + counts <= M), as_tuple=False).squeeze(1)
+    _, seg, point, _ = _segments(rays[valid], M)
+    rows = valid[seg]
+
+    grad_rays_o.index_add_(0, rows, grad_xyzs[point])
+    grad_rays_d.index_add_(0, rows, grad_xyzs[point] * deltas[point, 1:2] + grad_dirs[point])
+
+
+def _composite_train_forward(sigmas, deltas, rays, M, T_thresh, weights_sum, depth, weighted, summed):
+    ''' shared forward of the composite_rays_train* family.
+    Args:
+        weighted: list of (values [M, ...], output [N, ...]), accumulated with the compositing weights (image, uncertainty, ...)
+        summed: list of (values [M], output [N]), accumulated as plain sums (ambient)
+    '''
+    index, seg, point, start = _segments(rays, M)
+    R = index.shape[0]
+
+    sd = sigmas[point] * deltas[point, 0]
+    alpha = 1 - torch.exp(- sd)
+    # transmittance before each step, the ray stops once it falls under T_thresh.
+    T = torch.exp(- (_segment_cumsum(sd, seg, start) - sd))
+    mask = T >= T_thresh
+    weights = alpha * T * mask
+
+    outputs = [weights_sum, depth] + [out for _, out in weighted] + [out for _, out in summed]
+    for out in outputs:
+        out.zero_()
+
+    weights_sum[index] = _segment_sum(weights, seg, R)
+    depth[index] = _segment_sum(weights * deltas[point, 1], seg, R)
+    for values, out in weighted:
+        values = values[point]
+        out[index] = _segment_sum(values * weights.view(-1, *[1] * (values.dim() - 1)), seg, R)
+    for values, out in summed:
+        out[index] = _segment_sum(values[point] * mask, seg, R)
+
+
+def _composite_train_backward(grad_weights_sum, sigmas, deltas, rays, weights_sum, M, T_thresh, grad_sigmas, weighted, summed):
+    ''' shared backward of the composite_rays_train* family, check https://note.kiui.moe/others/nerf_gradient/
+    Args:
+        weighted: list of (grad_output [N, ...], values [M, ...], output [N, ...], grad_values [M, ...])
+        summed: list of (grad_output [N], grad_values [M])
+    '''
+    index, seg, point, start = _segments(rays, M)
+
+    sd = sigmas[point] * deltas[point, 0]
+    alpha = 1 - torch.exp(- sd)
+    T = torch.exp(- (_segment_cumsum(sd, seg, start) - sd))
+    mask = T >= T_thresh
+    weights = alpha * T * mask
+    T = T * (1 - alpha) # transmittance after the step
+
+    ray = index[seg]
+    grad = grad_weights_sum[ray] * (1 - weights_sum[ray])
+    for grad_out, values, out, grad_values in weighted:
+        values = values[point].view(point.shape[0], -1)
+        grad_out = grad_out[ray].view(point.shape[0], -1)
+        acc = _segment_cumsum(values * weights[:, None], seg, start)
+        grad = grad + (grad_out * (T[:, None] * values - (out[ray].view(point.shape[0], -1) - acc))).sum(-1)
+        grad_values[point] = (grad_out * weights[:, None]).view_as(grad_values[point])
+    for grad_out, grad_values in summed:
+        grad_values[point] = grad_out[ray] * mask
+
+    grad_sigmas[point] = deltas[point, 0] * grad * mask
+
+
+def composite_rays_train_forward(sigmas, rgbs, ambient, deltas, rays, M, N, T_thresh, weights_sum, ambient_sum, depth, image):
+    _composite_train_forward(sigmas, deltas, rays, M, T_thresh, weights_sum, depth, [(rgbs, image)], [(ambient, ambient_sum)])
+
+
+def composite_rays_train_backward(grad_weights_sum, grad_ambient_sum, grad_image, sigmas, rgbs, ambient, deltas, rays, weights_sum, ambient_sum, image, M, N, T_thresh, grad_sigmas, grad_rgbs, grad_ambient):
+    _composite_train_backward(grad_weights_sum, sigmas, deltas, rays, weights_sum, M, T_thresh, grad_sigmas, [(grad_image, rgbs, image, grad_rgbs)], [(grad_ambient_sum, grad_ambient)])
+
+
+def composite_rays_train_sigma_forward(sigmas, rgbs, ambient, deltas, rays, M, N, T_thresh, weights_sum, ambient_sum, depth, image):
+    _composite_train_forward(sigmas, deltas, rays, M, T_thresh, weights_sum, depth, [(rgbs, image), (ambient, ambient_sum)], [])
+
+
+def composite_rays_train_sigma_backward(grad_weights_sum, grad_ambient_sum, grad_image, sigmas, rgbs, ambient, deltas, rays, weights_sum, ambient_sum, image, M, N, T_thresh, grad_sigmas, grad_rgbs, grad_ambient):
+    _composite_train_backward(grad_weights_sum, sigmas, deltas, rays, weights_sum, M, T_thresh, grad_sigmas, [(grad_image, rgbs, image, grad_rgbs), (grad_ambient_sum, ambient, ambient_sum, grad_ambient)], [])
+
+
+def composite_rays_train_uncertainty_forward(sigmas, rgbs, ambient, uncertainty, deltas, rays, M, N, T_thresh, weights_sum, ambient_sum, uncertainty_sum, depth, image):
+    _composite_train_forward(sigmas, deltas, rays, M, T_thresh, weights_sum, depth, [(rgbs, image), (uncertainty, uncertainty_sum)], [(ambient, ambient_sum)])
+
+
+def composite_rays_train_uncertainty_backward(grad_weights_sum, grad_ambient_sum, grad_uncertainty_sum, grad_image, sigmas, rgbs, ambient, uncertainty, deltas, rays, weights_sum, ambient_sum, uncertainty_sum, image, M, N, T_thresh, grad_sigmas, grad_rgbs, grad_ambient, grad_uncertainty):
+    _composite_train_backward(grad_weights_sum, sigmas, deltas, rays, weights_sum, M, T_thresh, grad_sigmas, [(grad_image, rgbs, image, grad_rgbs), (grad_uncertainty_sum, uncertainty, uncertainty_sum, grad_uncertainty)], [(grad_ambient_sum, grad_ambient)])
+
+
+def composite_rays_train_triplane_forward(sigmas, rgbs, amb_aud, amb_eye, uncertainty, deltas, rays, M, N, T_thresh, weights_sum, amb_aud_sum, amb_eye_sum, uncertainty_sum, depth, image):
+    _composite_train_forward(sigmas, deltas, rays, M, T_thresh, weights_sum, depth, [(rgbs, image), (uncertainty, uncertainty_sum)], [(amb_aud, amb_aud_sum), (amb_eye, amb_eye_sum)])
+
+
+def composite_rays_train_triplane_backward(grad_weights_sum, grad_amb_aud_sum, grad_amb_eye_sum, grad_uncertainty_sum, grad_image, sigmas, rgbs, amb_aud, amb_eye, uncertainty, deltas, rays, weights_sum, amb_aud_sum, amb_eye_sum, uncertainty_sum, image, M, N, T_thresh, grad_sigmas, grad_rgbs, grad_amb_aud, grad_amb_eye, grad_uncertainty):
+    _composite_train_backward(grad_weights_sum, sigmas, deltas, rays, weights_sum, M, T_thresh, grad_sigmas, [(grad_image, rgbs, image, grad_rgbs), (grad_uncertainty_sum, uncertainty, uncertainty_sum, grad_uncertainty)], [(grad_amb_aud_sum, grad_amb_aud), (grad_amb_eye_sum, grad_amb_eye)])
+
+
+# ----------------------------------------
+# infer functions
+# ----------------------------------------
+
+def march_rays(n_alive, n_step, rays_alive, rays_t, rays_o, rays_d, bound, dt_gamma, max_steps, C, H, grid, near, far, xyzs, dirs, deltas, noises):
+    dt_max = 2 * SQRT3 * (1 << (C - 1)) / H
+    dt_min = min(dt_max, 2 * SQRT3 / max_steps)
+
+    index = rays_alive[:n_alive].long()
+    t = rays_t[index]
+
+    # introduce some randomness
+    t = t + (t * dt_gamma).clamp(dt_min, dt_max) * noises[:n_alive]
+
+    ray_ids, steps, points, dts, ts, _ = _march(rays_o[index], rays_d[index], t, far[index], n_step, bound, dt_gamma, max_steps, C, H, grid)
+
+    # points are laid out as [n_alive, n_step]
+    rows = ray_ids * n_step + steps
+    xyzs[rows] = points
+    dirs[rows] = rays_d[index[ray_ids]]
+    deltas[rows] = torch.stack([dts, ts], -1)
+
+
+def _composite_infer(n_alive, n_step, T_thresh, rays_alive, rays_t, sigmas, deltas, weights_sum, depth, weighted, summed):
+    ''' shared in-place compositing of the composite_rays* family, rays terminated in this round get rays_alive = -1.
+    Args:
+        weighted: list of (values [n_alive * n_step, ...], output [N, ...]), accumulated with the compositing weights.
+        summed: list of (values [n_alive * n_step], output [N]), accumulated as plain sums.
+    '''
+    if n_alive == 0:
+        return
+
+    P = n_alive * n_step
+    index = rays_alive[:n_alive].long()
+    sigmas = sigmas[:P].view(n_alive, n_step)
+    deltas = deltas[:P].view(n_alive, n_step, 2)
+
+    sd = sigmas * deltas[..., 0]
+    alpha = 1 - torch.exp(- sd)
+    # T_i = 1 - \sum_{j=0}^{i-1} w_j = (1 - weights_sum) * \prod_{j=0}^{i-1} (1 - alpha_j)
+    T = (1 - weights_sum[index])[:, None] * torch.exp(- (torch.cumsum(sd.double(), 1) - sd.double())).to(sd.dtype)
+
+    # a ray is terminated if delta == 0, or after the step where T is too small.
+    nonzero = deltas[..., 0] != 0
+    cont = nonzero & (T >= T_thresh)
+    before = torch.cat([torch.ones_like(cont[:, :1]), cont[:, :-1]], 1).long().cumprod(1).bool()
+    mask = before & nonzero
+    weights = alpha * T * mask
+
+    weights_sum[index] += weights.sum(1)
+    depth[index] += (weights * deltas[..., 1]).sum(1)
+    for values, out in weighted:
+        values = values[:P].view(n_alive, n_step, -1)
+        out[index] += (values * weights[..., None]).sum(1).view_as(out[index])
+    for values, out in summed:
+        out[index] += (values[:P].view(n_alive, n_step) * mask).sum(1)
+
+    terminated = ~cont.all(1)
+    rays_t[index[~terminated]] = deltas[~terminated, -1, 1]
+    rays_alive[:n_alive][terminated] = -1
+
+
+def composite_rays(n_alive, n_step, T_thresh, rays_alive, rays_t, sigmas, rgbs, deltas, weights, depth, image):
+    _composite_infer(n_alive, n_step, T_thresh, rays_alive, rays_t, sigmas, deltas, weights, depth, [(rgbs, image)], [])
+
+
+def composite_rays_ambient(n_alive, n_step, T_thresh, rays_alive, rays_t, sigmas, rgbs, deltas, ambients, weights, depth, image, ambient_sum):
+    _composite_infer(n_alive, n_step, T_thresh, rays_alive, rays_t, sigmas, deltas, weights, depth, [(rgbs, image)], [(ambients, ambient_sum)])
+
+
+def composite_rays_ambient_sigma(n_alive, n_step, T_thresh, rays_alive, rays_t, sigmas, rgbs, deltas, ambients, weights, depth, image, ambient_sum):
+    _composite_infer(n_alive, n_step, T_thresh, rays_alive, rays_t, sigmas, deltas, weights, depth, [(rgbs, image), (ambients, ambient_sum)], [])
+
+
+def composite_rays_uncertainty(n_alive, n_step, T_thresh, rays_alive, rays_t, sigmas, rgbs, deltas, ambients, uncertainties, weights, depth, image, ambient_sum, uncertainty_sum):
+    _composite_infer(n_alive, n_step, T_thresh, rays_alive, rays_t, sigmas, deltas, weights, depth, [(rgbs, image), (uncertainties, uncertainty_sum)], [(ambients, ambient_sum)])
+
+
+def composite_rays_triplane(n_alive, n_step, T_thresh, rays_alive, rays_t, sigmas, rgbs, deltas, ambs_aud, ambs_eye, uncertainties, weights, depth, image, amb_aud_sum, amb_eye_sum, uncertainty_sum):
+    _composite_infer(n_alive, n_step, T_thresh, rays_alive, rays_t, sigmas, deltas, weights, depth, [(rgbs, image), (uncertainties, uncertainty_sum)], [(ambs_aud, amb_aud_sum), (ambs_eye, amb_eye_sum)])
+
+
+def compact_rays(n_alive, rays_alive, rays_alive_out, counter):
+    # the alive rays keep their order, like the ordered scan of the CUDA kernel.
+    alive = rays_alive[:n_alive]
+    alive = alive[alive >= 0]
+    rays_alive_out[:alive.shape[0]] = alive
+    counter[0] = alive.shape[0]
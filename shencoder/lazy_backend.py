@@ -0,0 +1,101 @@
+# copied in raymarching, gridencoder, shencoder and freqencoder so each package is self-contained, keep them in sync.
+
+import os
+import time
+
+import torch
+
+nvcc_flags = [
+    '-O3', '-std=c++14',
+    '-U__CUDA_NO_HALF_OPERATORS__', '-U__CUDA_NO_HALF_CONVERSIONS__', '-U__CUDA_NO_HALF2_OPERATORS__',
+]
+
+if os.name == "posix":
+    c_flags = ['-O3', '-std=c++14']
+elif os.name == "nt":
+    c_flags = ['/O2', '/std:c++17']
+
+    # find cl.exe
+    def find_cl_path():
+        import glob
+        for edition in ["Enterprise", "Professional", "BuildTools", "Community"]:
+            paths = sorted(glob.glob(r"C:\\Program Files (x86)\\Microsoft Visual Studio\\*\\%s\\VC\\Tools\\MSVC\\*\\bin\\Hostx64\\x64" % edition), reverse=True)
+            if paths:
+                return paths[0]
+
+
+class LazyBackend:
+    ''' resolve the kernels of an extension (raymarching, gridencoder, ...) on the first call, so importing the package does not compile anything.
+    Tries the prebuilt extension (setup.py install) first, then JIT compilation. The pytorch kernels are used without a GPU,
+    or when the JIT build fails and ALLOW_TORCH_FALLBACK=1 is set, otherwise the build error is raised.
+    Attribute access is forwarded to the loaded module.
+
+    Args:
+        name: package name, only used in the log.
+        module: name of the prebuilt extension module.
+        jit_name: name of the JIT build, torch caches it in TORCH_EXTENSIONS_DIR so later runs only link it.
+        sources: absolute paths of the .cu/.cpp files for the JIT build.
+        fallback: the pytorch module mirroring the bindings.
+        extra_cflags, extra_cuda_cflags: appended to the default host / nvcc flags.
+    '''
+    def __init__(self, name, module, jit_name, sources, fallback, extra_cflags=(), extra_cuda_cflags=()):
+        self.name = name
+        self.module_name = module
+        self.jit_name = jit_name
+        self.sources = sources
+        self.fallback = fallback
+        self.extra_cflags = extra_cflags
+        self.extra_cuda_cflags = extra_cuda_cflags
+        self.module = None
+
+    def jit_load(self):
+        from torch.utils.cpp_extension import load
+
+        if os.name == "nt":
+            # If cl.exe is not on path, try to find it.
+            if os.system("where cl.exe >nul 2>nul") != 0:
+                cl_path = find_cl_path()
+                if cl_path is None:
+                    raise RuntimeError("Could not locate a supported Microsoft Visual C++ installation")
+                os.environ["PATH"] += ";" + cl_path
+
+        return load(name=self.jit_name,
+                    extra_cflags=c_flags + list(self.extra_cflags),
+                    extra_cuda_cflags=nvcc_flags + list(self.extra_cuda_cflags),
+                    sources=self.sources,
+                    )
+
+    def load(self):
+        if self.module is not None:
+            return self.module
+
+        t = time.time()
+
+        if not torch.cuda.is_available():
+            module, name = self.fallback, 'pytorch (no GPU)'
+        else:
+            try:
+                module, name = __import__(self.module_name), 'prebuilt CUDA'
+            except ImportError:
+                try:
+                    module, name = self.jit_load(), 'JIT-compiled CUDA'
+                except Exception as e:
+                    # the pytorch kernels are far slower, a GPU run must not silently end up on them.
+                    if os.environ.get('ALLOW_TORCH_FALLBACK', '0') != '1':
+                        raise RuntimeError(f'failed to build the {self.name} extension, set ALLOW_TORCH_FALLBACK=1 to run on the pytorch kernels instead') from e
+                    print(f'[WARN] failed to build the {self.name} extension, fall back to pytorch: {e}')
+                    module, name = self.fallback, 'pytorch'
+
+        print(f'[INFO] {self.name}: loaded {name} backend in {time.time() - t:.2f}s')
+
+        self.module = module
+        return self.module
+
+    @property
+    def use_cuda(self):
+        # inputs are only moved to the GPU for the CUDA kernels.
+        return self.load() is not self.fallback
+
+    def __getattr__(self, name):
+        # only reached for names not set in __init__, i.e. the kernels.
+        return getattr(self.load(), name)
@@ -6,10 +6,8 @@ from torch.autograd import Function
 from torch.autograd.function import once_differentiable
 from torch.cuda.amp import custom_bwd, custom_fwd 
 
-try:
-    import _shencoder as _backend
-except ImportError:
-    from .backend import _backend
+# kernels are loaded on first use, see backend.py
+from .backend import _backend
 
 class _sh_encoder(Function):
     @staticmethod
@@ -0,0 +1,38 @@
+''' CPU checks of the frequency encoder on the pytorch kernels (freqencoder/torch_backend.py).
+Run from the repo root: python -m pytest tests
+'''
+
+import pytest
+import torch
+
+from freqencoder import FreqEncoder
+from freqencoder import torch_backend
+from freqencoder.backend import _backend
+
+
+@pytest.fixture(autouse=True)
+def pytorch_kernels(monkeypatch):
+    monkeypatch.setattr(_backend, 'module', torch_backend)
+
+
+@pytest.mark.parametrize('input_dim', [1, 3])
+def test_layout(input_dim):
+    # [x, sin(x), cos(x), sin(2x), cos(2x), ...], each block of input_dim channels.
+    torch.manual_seed(0)
+    x = torch.randn(32, input_dim, dtype=torch.float64)
+    encoder = FreqEncoder(input_dim=input_dim, degree=4)
+    y = encoder(x)
+    assert y.shape == (32, encoder.output_dim) == (32, input_dim * 9)
+
+    blocks = [x]
+    for i in range(4):
+        blocks += [torch.sin(2 ** i * x), torch.cos(2 ** i * x)]
+    assert torch.allclose(y, torch.cat(blocks, -1), atol=1e-12)
+
+
+@pytest.mark.parametrize('input_dim', [1, 3])
+@pytest.mark.parametrize('degree', [1, 4])
+def test_gradcheck(input_dim, degree):
+    torch.manual_seed(0)
+    x = torch.randn(16, input_dim, dtype=torch.float64, requires_grad=True)
+    assert torch.autograd.gradcheck(FreqEncoder(input_dim=input_dim, degree=degree), (x,))
@@ -0,0 +1,180 @@
+''' CPU checks of the grid encoders on the pytorch kernels (gridencoder/torch_backend.py).
+Run from the repo root: python -m pytest tests
+'''
+
+import numpy as np
+import pytest
+import torch
+import torch.nn as nn
+
+from gridencoder import GridEncoder, TriplaneEncoder
+from gridencoder import parity, torch_backend
+from gridencoder.backend import _backend
+
+
+@pytest.fixture(autouse=True)
+def pytorch_kernels(monkeypatch):
+    monkeypatch.setattr(_backend, 'module', torch_backend)
+
+
+@pytest.mark.parametrize('gridtype', ['hash', 'tiled'])
+@pytest.mark.parametrize('align_corners', [False, True])
+@pytest.mark.parametrize('level_dim', [1, 2])
+def test_triplane_matches_grids(gridtype, align_corners, level_dim):
+    for name, a, b in parity.triplane_vs_grids('cpu', 512, gridtype, align_corners, level_dim):
+        torch.testing.assert_close(a, b, msg=name)
+
+
+class _OldNetwork(nn.Module):
+    # the encoders of NeRFNetwork before TriplaneEncoder.
+    def __init__(self, **kwargs):
+        super().__init__()
+        self.encoder_xy = GridEncoder(input_dim=2, **kwargs)
+        self.encoder_yz = GridEncoder(input_dim=2, **kwargs)
+        self.encoder_xz = GridEncoder(input_dim=2, **kwargs)
+        self.sigma_net = nn.Linear(4, 4)
+
+    def encode_x(self, xyz, bound):
+        xy, yz, xz = xyz[:, :-1], xyz[:, 1:], torch.cat([xyz[:, :1], xyz[:, -1:]], dim=-1)
+        return torch.cat([self.encoder_xy(xy, bound=bound), self.encoder_yz(yz, bound=bound), self.encoder_xz(xz, bound=bound)], dim=-1)
+
+
+class _Network(nn.Module):
+    # the encoder of NeRFNetwork now, loading old checkpoints with the same hook.
+    def __init__(self, **kwargs):
+        super().__init__()
+        self.encoder_triplane = TriplaneEncoder(**kwargs)
+        self.sigma_net = nn.Linear(4, 4)
+        self._register_load_state_dict_pre_hook(self.convert_triplane_state_dict)
+
+    @staticmethod
+    def convert_triplane_state_dict(state_dict, prefix, *args):
+        TriplaneEncoder.convert_state_dict(state_dict, prefix + 'encoder_triplane.', [prefix + 'encoder_xy.', prefix + 'encoder_yz.', prefix + 'encoder_xz.'])
+
+    def encode_x(self, xyz, bound):
+        return self.encoder_triplane(xyz, bound=bound)
+
+
+def test_convert_state_dict():
+    torch.manual_seed(0)
+    kwargs = dict(num_levels=12, level_dim=1, base_resolution=64, log2_hashmap_size=14, desired_resolution=1024)
+
+    old = _OldNetwork(**kwargs)
+    for name in ['encoder_xy', 'encoder_yz', 'encoder_xz']:
+        getattr(old, name).embeddings.data.uniform_(-1, 1)
+
+    # nested under a prefix, as the checkpoints store the model.
+    checkpoint = {'model.' + k: v for k, v in old.state_dict().items()}
+    new = nn.Module()
+    new.model = _Network(**kwargs)
+    missing, unexpected = new.load_state_dict(checkpoint)
+    assert missing == [] and unexpected == []
+
+    xyz = (torch.rand(1024, 3) * 2 - 1) * 2
+    assert torch.equal(new.model.encode_x(xyz, bound=2), old.encode_x(xyz, bound=2))
+    assert torch.equal(new.model.sigma_net.weight, old.sigma_net.weight)
+
+    # a new checkpoint loads unchanged.
+    again = _Network(**kwargs)
+    again.load_state_dict(new.model.state_dict())
+    assert torch.equal(again.encode_x(xyz, bound=2), old.encode_x(xyz, bound=2))
+
+
+# ----------------------------------------
+# layout of the pytorch grid, hand-computed
+# ----------------------------------------
+
+def _encode(encoder, u):
+    # encode points given in [0, 1], with embeddings[i] = i so the outputs are the interpolated row indices.
+    encoder.embeddings.data.copy_(torch.arange(encoder.embeddings.shape[0], dtype=torch.float32)[:, None])
+    x = (torch.tensor(u, dtype=torch.float32) * 2 - 1).requires_grad_(True)
+    y = encoder(x, bound=1)
+    y.sum().backward()
+    return y.detach(), x.grad, encoder.embeddings.grad[:, 0]
+
+
+def test_dense_level():
+    # resolution 4: scale = 4 - 1 = 3, a (3 + 2)^2 = 25 grid padded to 32 rows, row = x + 5 * y
+    encoder = GridEncoder(input_dim=2, num_levels=1, level_dim=1, base_resolution=4)
+    assert encoder.offsets.tolist() == [0, 32]
+
+    # u = (0.5, 0.25) --> pos = u * 3 + 0.5 = (2, 1.25): 0.75 of row 2 + 5 * 1 = 7 and 0.25 of row 2 + 5 * 2 = 12
+    y, grad_x, grad_embeddings = _encode(encoder, [[0.5, 0.25]])
+    assert y.tolist() == [[8.25]]
+    expected = torch.zeros(32)
+    expected[[7, 12]] = torch.tensor([0.75, 0.25])
+    assert torch.equal(grad_embeddings, expected)
+    # rows grow by 1 along x and 5 along y, times scale 3, times 1/2 from [-1, 1] to [0, 1].
+    assert grad_x.tolist() == [[1.5, 7.5]]
+
+
+def test_hashed_level():
+    # resolution 16 needs 17^2 rows, more than the 2^6 of the table, so rows are hashed:
+    # (x * 1) ^ (y * 2654435761) mod 2^32, then mod 64. 2654435761 = 49 mod 64, and the xor keeps the low 6 bits.
+    encoder = GridEncoder(input_dim=2, num_levels=1, level_dim=1, base_resolution=16, log2_hashmap_size=6)
+    assert encoder.offsets.tolist() == [0, 64]
+
+    # u = (0.25, 0.75) --> pos = u * 15 + 0.5 = (4.25, 11.75)
+    # y = 11: 11 * 49 = 27 mod 64, rows 4 ^ 27 = 31 and 5 ^ 27 = 30
+    # y = 12: 12 * 49 = 12 mod 64, rows 4 ^ 12 = 8 and 5 ^ 12 = 9
+    y, _, grad_embeddings = _encode(encoder, [[0.25, 0.75]])
+    weights = {31: 0.75 * 0.25, 30: 0.25 * 0.25, 8: 0.75 * 0.75, 9: 0.25 * 0.75}
+    assert y.tolist() == [[sum(w * row for row, w in weights.items())]] == [[13.875]]
+    expected = torch.zeros(64)
+    for row, w in weights.items():
+        expected[row] = w
+    assert torch.equal(grad_embeddings, expected)
+
+
+def test_float32_resolution():
+    # base 4 to 6 in 4 levels: the last level scale is exp2(3 * log2(6 / 4) / 3) * 4 - 1, 5 in float32 like the kernel
+    # but 5.000000000000001 in float64, which would give resolution 7 instead of 6 and a hashed level.
+    encoder = GridEncoder(input_dim=2, num_levels=4, level_dim=1, base_resolution=4, desired_resolution=6)
+    assert encoder.offsets.tolist() == [0, 32, 72, 128, 184]
+
+    _, _, hashmap_size, resolution, scale = torch_backend._level(torch.zeros(1, 2), encoder.offsets, 3, np.log2(encoder.per_level_scale), 4, False)
+    assert (hashmap_size, resolution, scale) == (56, 6, 5.0)
+
+    # u = 0.5 --> pos = 0.5 * 5 + 0.5 = 3, dense row 3 + 3 * (6 + 1) = 24 of level 3.
+    y, _, _ = _encode(encoder, [[0.5, 0.5]])
+    assert y[0, 3].item() == 128 + 24
+
+
+class _GridEncode(torch.autograd.Function):
+    # _grid_encode without its cast of the inputs to float32, so gradcheck can run in float64.
+    @staticmethod
+    def forward(ctx, inputs, embeddings, offsets, S, H, gridtype, align_corners):
+        B, D = inputs.shape
+        L = offsets.shape[0] - 1
+        C = embeddings.shape[1]
+        outputs = inputs.new_empty(L, B, C)
+        dy_dx = inputs.new_empty(B, L * D * C)
+        torch_backend.grid_encode_forward(inputs, embeddings, offsets, outputs, B, D, C, L, S, H, dy_dx, gridtype, align_corners)
+        ctx.save_for_backward(inputs, embeddings, offsets, dy_dx)
+        ctx.dims = [B, D, C, L, S, H, gridtype, align_corners]
+        return outputs
+
+    @staticmethod
+    def backward(ctx, grad):
+        inputs, embeddings, offsets, dy_dx = ctx.saved_tensors
+        B, D, C, L, S, H, gridtype, align_corners = ctx.dims
+        grad_embeddings = torch.zeros_like(embeddings)
+        grad_inputs = torch.zeros_like(inputs)
+        torch_backend.grid_encode_backward(grad.contiguous(), inputs, embeddings, offsets, grad_embeddings, B, D, C, L, S, H, dy_dx, grad_inputs, gridtype, align_corners)
+        return grad_inputs, grad_embeddings, None, None, None, None, None
+
+
+@pytest.mark.parametrize('D', [2, 3])
+@pytest.mark.parametrize('gridtype', ['hash', 'tiled'])
+@pytest.mark.parametrize('align_corners', [False, True])
+def test_grid_encode_gradcheck(D, gridtype, align_corners):
+    torch.manual_seed(0)
+    # a small table, so the finer levels are hashed.
+    encoder = GridEncoder(input_dim=D, num_levels=4, level_dim=2, base_resolution=4, log2_hashmap_size=6, desired_resolution=32, gridtype=gridtype, align_corners=align_corners)
+    embeddings = torch.rand(encoder.embeddings.shape, dtype=torch.float64, requires_grad=True)
+    inputs = (torch.rand(16, D, dtype=torch.float64) * 0.9 + 0.05).requires_grad_(True)
+
+    def encode(inputs, embeddings):
+        return _GridEncode.apply(inputs, embeddings, encoder.offsets, np.log2(encoder.per_level_scale), encoder.base_resolution, encoder.gridtype_id, align_corners)
+
+    assert torch.autograd.gradcheck(encode, (inputs, embeddings))
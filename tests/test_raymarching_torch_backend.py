@@ -0,0 +1,462 @@
+''' CPU checks of the pytorch raymarching kernels (raymarching/torch_backend.py), against hand-computed values
+for the utils, and against naive per-ray loops transcribed from the CUDA kernels for marching and compositing.
+Run from the repo root: python -m pytest tests
+'''
+
+import math
+
+import pytest
+import torch
+
+import raymarching
+from raymarching import torch_backend
+from raymarching.backend import _backend
+
+SQRT3 = math.sqrt(3)
+
+
+def test_near_far_from_aabb():
+    aabb = torch.tensor([-1, -1, -1, 1, 1, 1], dtype=torch.float32)
+    rays_o = torch.tensor([
+        [-3, 0, 0], # along +x through the center
+        [0, 0, 0], # from inside, near is clamped to min_near
+        [-2, -2, -2], # along the diagonal
+        [-3, 3, 0], # passes above the box
+    ], dtype=torch.float32)
+    rays_d = torch.tensor([
+        [1, 0, 0],
+        [0, 0, 1],
+        [1, 1, 1],
+        [1, 0, 0],
+    ], dtype=torch.float32)
+    N = rays_o.shape[0]
+    nears = torch.empty(N)
+    fars = torch.empty(N)
+
+    torch_backend.near_far_from_aabb(rays_o, rays_d, aabb, N, 0.05, nears, fars)
+
+    fmax = torch.finfo(torch.float32).max
+    assert torch.allclose(nears, torch.tensor([2, 0.05, 1, fmax]))
+    assert torch.allclose(fars, torch.tensor([4, 1, 3, fmax]))
+
+
+def test_morton3D():
+    coords = torch.tensor([[1, 0, 0], [0, 1, 0], [0, 0, 1], [1, 1, 1], [2, 0, 0], [3, 5, 7]], dtype=torch.int32)
+    indices = torch.empty(coords.shape[0], dtype=torch.int32)
+
+    torch_backend.morton3D(coords, coords.shape[0], indices)
+
+    # x, y, z bits interleaved from the lowest: 3 = 011, 5 = 101, 7 = 111 --> 110 101 111 = 431
+    assert indices.tolist() == [1, 2, 4, 7, 8, 431]
+
+
+def test_morton3D_invert_round_trip():
+    H = 8
+    x, y, z = torch.meshgrid(torch.arange(H), torch.arange(H), torch.arange(H), indexing='ij')
+    coords = torch.stack([x, y, z], -1).reshape(-1, 3).int()
+    N = coords.shape[0]
+
+    indices = torch.empty(N, dtype=torch.int32)
+    torch_backend.morton3D(coords, N, indices)
+    # a bijection onto [0, H^3)
+    assert sorted(indices.tolist()) == list(range(N))
+
+    inverted = torch.empty(N, 3, dtype=torch.int32)
+    torch_backend.morton3D_invert(indices, N, inverted)
+    assert torch.equal(inverted, coords)
+
+
+def test_packbits():
+    grid = torch.zeros(16)
+    grid[[0, 7]] = 1 # bits 0 and 7 of the first byte
+    grid[[9, 10]] = 1 # bits 1 and 2 of the second byte
+    grid[11] = 0.5 # not above the threshold
+    bitfield = torch.empty(2, dtype=torch.uint8)
+
+    torch_backend.packbits(grid, 2, 0.5, bitfield)
+
+    assert bitfield.tolist() == [129, 6]
+
+
+def test_compact_rays():
+    # -1 marks rays that finished, entries after n_alive are ignored.
+    rays_alive = torch.tensor([3, -1, 5, -1, 7, 9], dtype=torch.int32)
+    rays_alive_out = torch.full((6,), -1, dtype=torch.int32)
+    counter = torch.zeros(1, dtype=torch.int32)
+
+    torch_backend.compact_rays(5, rays_alive, rays_alive_out, counter)
+
+    n = counter.item()
+    assert n == 3
+    # in order, so rendering does not depend on thread scheduling.
+    assert rays_alive_out[:n].tolist() == [3, 5, 7]
+
+
+# ----------------------------------------
+# naive references, one ray at a time as in src/raymarching.cu
+# ----------------------------------------
+
+def _naive_morton3D(x, y, z):
+    return sum((((x >> i) & 1) | (((y >> i) & 1) << 1) | (((z >> i) & 1) << 2)) << (3 * i) for i in range(10))
+
+
+def _mip(x, C):
+    # mip_from_pos / mip_from_dt
+    return min(C - 1, max(0, math.frexp(float(x))[1]))
+
+
+def _f32(x):
+    return float(torch.tensor(x, dtype=torch.float32))
+
+
+def _naive_march(o, d, t, far, max_points, bound, dt_gamma, max_steps, C, H, grid):
+    ''' the marching loop of kernel_march_rays_train / kernel_march_rays for a single ray, in float32.
+    Args:
+        o, d: float32, [3]
+        t, far: float32, 0-dim, t is already perturbed.
+    Returns:
+        list of (xyz [3], dt, t after the step)
+    '''
+    dt_max = 2 * SQRT3 * (1 << (C - 1)) / H
+    dt_min = min(dt_max, 2 * SQRT3 / max_steps)
+    grid = grid.tolist()
+
+    points = []
+    while t < far and len(points) < max_points:
+        xyz = (o + t * d).clamp(-bound, bound)
+        dt = (t * dt_gamma).clamp(dt_min, dt_max)
+
+        level = max(_mip(xyz.abs().max(), C), _mip(dt * H * 0.5, C))
+        mip_bound = min(2.0 ** level, bound)
+
+        # 0.5 is a double in the kernel, the result is truncated after rounding back to float.
+        nxyz = [int(min(max(_f32(0.5 * float(v) * H), 0), H - 1)) for v in xyz / mip_bound + 1]
+
+        index = level * H ** 3 + _naive_morton3D(*nxyz)
+        if (grid[index // 8] >> (index % 8)) & 1:
+            points.append((xyz, dt, t + dt))
+            t = t + dt
+        else:
+            signs = torch.tensor([math.copysign(1, float(v)) for v in d])
+            txyz = (((torch.tensor(nxyz, dtype=torch.float32) + 0.5 + 0.5 * signs) * (1 / H) * 2 - 1) * mip_bound - xyz) * (1 / d)
+            tt = t + txyz.min().clamp(min=0)
+            while True:
+                t = t + (t * dt_gamma).clamp(dt_min, dt_max)
+                if not t < tt:
+                    break
+
+    return points
+
+
+def _naive_composite_train(sigmas, rgbs, amb_aud, amb_eye, uncertainty, deltas, rays, M, N, T_thresh):
+    # kernel_composite_rays_train_triplane_forward
+    weights_sum, amb_aud_sum, amb_eye_sum, uncertainty_sum, depth = [[0.0] * N for _ in range(5)]
+    image = [[0.0] * 3 for _ in range(N)]
+
+    for index, offset, num_steps in rays.tolist():
+        if num_steps == 0 or offset + num_steps > M:
+            continue
+        T = 1
+        for i in range(offset, offset + num_steps):
+            alpha = 1 - math.exp(- sigmas[i] * deltas[i][0])
+            weight = alpha * T
+            for c in range(3):
+                image[index][c] += weight * rgbs[i][c]
+            depth[index] += weight * deltas[i][1]
+            weights_sum[index] += weight
+            amb_aud_sum[index] += amb_aud[i]
+            amb_eye_sum[index] += amb_eye[i]
+            uncertainty_sum[index] += weight * uncertainty[i]
+            T *= 1 - alpha
+            if T < T_thresh:
+                break
+
+    return weights_sum, amb_aud_sum, amb_eye_sum, uncertainty_sum, depth, image
+
+
+def _naive_composite_train_backward(grad_weights_sum, grad_amb_aud_sum, grad_amb_eye_sum, grad_uncertainty_sum, grad_image, sigmas, rgbs, uncertainty, deltas, rays, weights_sum, uncertainty_sum, image, M, T_thresh):
+    # kernel_composite_rays_train_triplane_backward
+    P = len(sigmas)
+    grad_sigmas, grad_amb_aud, grad_amb_eye, grad_uncertainty = [[0.0] * P for _ in range(4)]
+    grad_rgbs = [[0.0] * 3 for _ in range(P)]
+
+    for index, offset, num_steps in rays.tolist():
+        if num_steps == 0 or offset + num_steps > M:
+            continue
+        T = 1
+        rgb = [0.0] * 3
+        unc = 0
+        for i in range(offset, offset + num_steps):
+            alpha = 1 - math.exp(- sigmas[i] * deltas[i][0])
+            weight = alpha * T
+            for c in range(3):
+                rgb[c] += weight * rgbs[i][c]
+            unc += weight * uncertainty[i]
+            T *= 1 - alpha
+
+            for c in range(3):
+                grad_rgbs[i][c] = grad_image[index][c] * weight
+            grad_amb_aud[i] = grad_amb_aud_sum[index]
+            grad_amb_eye[i] = grad_amb_eye_sum[index]
+            grad_uncertainty[i] = grad_uncertainty_sum[index] * weight
+            grad_sigmas[i] = deltas[i][0] * (
+                sum(grad_image[index][c] * (T * rgbs[i][c] - (image[index][c] - rgb[c])) for c in range(3)) +
+                grad_uncertainty_sum[index] * (T * uncertainty[i] - (uncertainty_sum[index] - unc)) +
+                grad_weights_sum[index] * (1 - weights_sum[index])
+            )
+            if T < T_thresh:
+                break
+
+    return grad_sigmas, grad_rgbs, grad_amb_aud, grad_amb_eye, grad_uncertainty
+
+
+def _naive_composite_infer(n_alive, n_step, T_thresh, rays_alive, rays_t, sigmas, rgbs, deltas, ambs_aud, ambs_eye, uncertainties, weights_sum, depth, image, amb_aud_sum, amb_eye_sum, uncertainty_sum):
+    # kernel_composite_rays_triplane, updates the python lists in-place.
+    for n in range(n_alive):
+        index = rays_alive[n]
+        t = rays_t[index]
+        step = 0
+        while step < n_step:
+            i = n * n_step + step
+            if deltas[i][0] == 0:
+                break
+            alpha = 1 - math.exp(- sigmas[i] * deltas[i][0])
+            T = 1 - weights_sum[index]
+            weight = alpha * T
+            weights_sum[index] += weight
+            t = deltas[i][1]
+            depth[index] += weight * t
+            for c in range(3):
+                image[index][c] += weight * rgbs[i][c]
+            amb_aud_sum[index] += ambs_aud[i]
+            amb_eye_sum[index] += ambs_eye[i]
+            uncertainty_sum[index] += weight * uncertainties[i]
+            if T < T_thresh:
+                break
+            step += 1
+
+        if step < n_step:
+            rays_alive[n] = -1
+        else:
+            rays_t[index] = t
+
+
+# ----------------------------------------
+# marching and compositing
+# ----------------------------------------
+
+def _scene(N=32, C=2, H=16, bound=2, seed=0):
+    # a random occupancy grid, and rays shot from outside the bound towards its center (the last one misses it).
+    g = torch.Generator().manual_seed(seed)
+    density = torch.rand(C, H ** 3, generator=g)
+    grid = torch.empty(C * H ** 3 // 8, dtype=torch.uint8)
+    torch_backend.packbits(density, grid.shape[0], 0.5, grid)
+
+    rays_o = torch.nn.functional.normalize(torch.randn(N, 3, generator=g), dim=-1) * 3.5
+    rays_d = torch.nn.functional.normalize(torch.rand(N, 3, generator=g) * 2 - 1 - rays_o, dim=-1)
+    rays_o[-1] = torch.tensor([3.5, 0, 0])
+    rays_d[-1] = torch.nn.functional.normalize(torch.tensor([1, 0.1, 0.1]), dim=0)
+
+    nears = torch.empty(N)
+    fars = torch.empty(N)
+    aabb = torch.tensor([-bound] * 3 + [bound] * 3, dtype=torch.float32)
+    torch_backend.near_far_from_aabb(rays_o, rays_d, aabb, N, 0.05, nears, fars)
+    noises = torch.rand(N, generator=g)
+
+    return grid, rays_o, rays_d, nears, fars, noises
+
+
+@pytest.mark.parametrize('M_scale', [1, 0.5])
+def test_march_rays_train(M_scale):
+    C, H, bound, dt_gamma, max_steps = 2, 16, 2, 1 / 8, 64
+    grid, rays_o, rays_d, nears, fars, noises = _scene(C=C, H=H, bound=bound)
+    N = rays_o.shape[0]
+
+    dt_max = 2 * SQRT3 * (1 << (C - 1)) / H
+    dt_min = min(dt_max, 2 * SQRT3 / max_steps)
+    expected = []
+    for n in range(N):
+        t0 = nears[n] + (nears[n] * dt_gamma).clamp(dt_min, dt_max) * noises[n]
+        expected.append(_naive_march(rays_o[n], rays_d[n], t0, fars[n], max_steps, bound, dt_gamma, max_steps, C, H, grid))
+    total = sum(len(p) for p in expected)
+    assert total > 0
+
+    # with M_scale < 1, the rays past M are dropped.
+    M = int(total * M_scale)
+    xyzs = torch.zeros(M, 3)
+    dirs = torch.zeros(M, 3)
+    deltas = torch.zeros(M, 2)
+    rays = torch.empty(N, 3, dtype=torch.int32)
+    counter = torch.zeros(2, dtype=torch.int32)
+
+    torch_backend.march_rays_train(rays_o, rays_d, grid, bound, dt_gamma, max_steps, N, C, H, M, nears, fars, xyzs, dirs, deltas, rays, counter, noises)
+
+    assert counter.tolist() == [total, N]
+    assert sorted(rays[:, 0].tolist()) == list(range(N))
+    for index, offset, num_steps in rays.tolist():
+        points = expected[index]
+        assert num_steps == len(points)
+        if num_steps == 0 or offset + num_steps > M:
+            continue
+        torch.testing.assert_close(xyzs[offset:offset + num_steps], torch.stack([p[0] for p in points]))
+        torch.testing.assert_close(dirs[offset:offset + num_steps], rays_d[index].expand(num_steps, 3))
+        torch.testing.assert_close(deltas[offset:offset + num_steps], torch.stack([torch.stack([p[1], p[2]]) for p in points]))
+
+    # backward, accumulated per row of rays
+    grad_xyzs = torch.randn(M, 3, dtype=torch.float64)
+    grad_dirs = torch.randn(M, 3, dtype=torch.float64)
+    grad_rays_o = torch.zeros(N, 3, dtype=torch.float64)
+    grad_rays_d = torch.zeros(N, 3, dtype=torch.float64)
+    torch_backend.march_rays_train_backward(grad_xyzs, grad_dirs, rays, deltas.double(), N, M, grad_rays_o, grad_rays_d)
+
+    expected_o = torch.zeros(N, 3, dtype=torch.float64)
+    expected_d = torch.zeros(N, 3, dtype=torch.float64)
+    for n, (index, offset, num_steps) in enumerate(rays.tolist()):
+        if num_steps == 0 or offset + num_steps > M:
+            continue
+        for i in range(offset, offset + num_steps):
+            expected_o[n] += grad_xyzs[i]
+            expected_d[n] += grad_xyzs[i] * deltas[i, 1].double() + grad_dirs[i]
+    torch.testing.assert_close(grad_rays_o, expected_o)
+    torch.testing.assert_close(grad_rays_d, expected_d)
+
+
+def test_march_rays():
+    C, H, bound, dt_gamma, max_steps, n_step = 2, 16, 2, 1 / 8, 64, 8
+    grid, rays_o, rays_d, nears, fars, noises = _scene(C=C, H=H, bound=bound, seed=1)
+    N = rays_o.shape[0]
+
+    # a permuted subset of the rays, some of them already marched a bit.
+    g = torch.Generator().manual_seed(1)
+    rays_alive = torch.cat([torch.randperm(N - 1, generator=g)[:20], torch.tensor([N - 1])]).int()
+    n_alive = rays_alive.shape[0]
+    rays_t = torch.where(nears < fars, nears + torch.rand(N, generator=g) * (fars - nears) * 0.5, nears)
+
+    P = n_alive * n_step
+    xyzs = torch.zeros(P, 3)
+    dirs = torch.zeros(P, 3)
+    deltas = torch.zeros(P, 2)
+
+    torch_backend.march_rays(n_alive, n_step, rays_alive, rays_t.clone(), rays_o, rays_d, bound, dt_gamma, max_steps, C, H, grid, nears, fars, xyzs, dirs, deltas, noises)
+
+    dt_max = 2 * SQRT3 * (1 << (C - 1)) / H
+    dt_min = min(dt_max, 2 * SQRT3 / max_steps)
+    expected_xyzs = torch.zeros(P, 3)
+    expected_dirs = torch.zeros(P, 3)
+    expected_deltas = torch.zeros(P, 2)
+    for n, index in enumerate(rays_alive.tolist()):
+        t = rays_t[index] + (rays_t[index] * dt_gamma).clamp(dt_min, dt_max) * noises[n]
+        for step, (xyz, dt, t_next) in enumerate(_naive_march(rays_o[index], rays_d[index], t, fars[index], n_step, bound, dt_gamma, max_steps, C, H, grid)):
+            expected_xyzs[n * n_step + step] = xyz
+            expected_dirs[n * n_step + step] = rays_d[index]
+            expected_deltas[n * n_step + step] = torch.stack([dt, t_next])
+
+    assert (expected_deltas[:, 0] > 0).any()
+    torch.testing.assert_close(xyzs, expected_xyzs)
+    torch.testing.assert_close(dirs, expected_dirs)
+    torch.testing.assert_close(deltas, expected_deltas)
+
+
+def _train_points(N=10, seed=0):
+    # packed points of N rays in a shuffled order, with an empty ray and a ray past M.
+    g = torch.Generator().manual_seed(seed)
+    counts = torch.randint(1, 9, (N,), generator=g)
+    counts[3] = 0
+    offsets = torch.cumsum(counts, 0) - counts
+    M = int(counts.sum()) - int(counts[-1]) // 2
+    rays = torch.stack([torch.randperm(N, generator=g), offsets, counts], -1).int()
+
+    sigmas = torch.rand(M, generator=g, dtype=torch.float64) * 20
+    rgbs = torch.rand(M, 3, generator=g, dtype=torch.float64)
+    amb_aud = torch.rand(M, generator=g, dtype=torch.float64)
+    amb_eye = torch.rand(M, generator=g, dtype=torch.float64)
+    uncertainty = torch.rand(M, generator=g, dtype=torch.float64)
+    deltas = torch.stack([torch.rand(M, generator=g, dtype=torch.float64) * 0.15 + 0.05, torch.rand(M, generator=g, dtype=torch.float64) * 4], -1)
+
+    return sigmas, rgbs, amb_aud, amb_eye, uncertainty, deltas, rays
+
+
+def test_composite_rays_train_triplane():
+    T_thresh = 1e-2
+    sigmas, rgbs, amb_aud, amb_eye, uncertainty, deltas, rays = _train_points()
+    M, N = sigmas.shape[0], rays.shape[0]
+
+    outputs = [torch.empty(N, dtype=torch.float64) for _ in range(5)] + [torch.empty(N, 3, dtype=torch.float64)]
+    torch_backend.composite_rays_train_triplane_forward(sigmas, rgbs, amb_aud, amb_eye, uncertainty, deltas, rays, M, N, T_thresh, *outputs)
+    weights_sum, amb_aud_sum, amb_eye_sum, uncertainty_sum, depth, image = outputs
+
+    expected = _naive_composite_train(sigmas.tolist(), rgbs.tolist(), amb_aud.tolist(), amb_eye.tolist(), uncertainty.tolist(), deltas.tolist(), rays, M, N, T_thresh)
+    for output, value in zip(outputs, expected):
+        torch.testing.assert_close(output, torch.tensor(value, dtype=torch.float64))
+
+    # some rays stop on T_thresh before their last point.
+    assert (weights_sum > 1 - T_thresh).any()
+
+    g = torch.Generator().manual_seed(1)
+    grads = [torch.randn(N, generator=g, dtype=torch.float64) for _ in range(4)] + [torch.randn(N, 3, generator=g, dtype=torch.float64)]
+    grad_sigmas = torch.zeros_like(sigmas)
+    grad_rgbs = torch.zeros_like(rgbs)
+    grad_amb_aud = torch.zeros_like(amb_aud)
+    grad_amb_eye = torch.zeros_like(amb_eye)
+    grad_uncertainty = torch.zeros_like(uncertainty)
+    torch_backend.composite_rays_train_triplane_backward(*grads, sigmas, rgbs, amb_aud, amb_eye, uncertainty, deltas, rays, weights_sum, amb_aud_sum, amb_eye_sum, uncertainty_sum, image, M, N, T_thresh, grad_sigmas, grad_rgbs, grad_amb_aud, grad_amb_eye, grad_uncertainty)
+
+    expected = _naive_composite_train_backward(*[x.tolist() for x in grads], sigmas.tolist(), rgbs.tolist(), uncertainty.tolist(), deltas.tolist(), rays, weights_sum.tolist(), uncertainty_sum.tolist(), image.tolist(), M, T_thresh)
+    for output, value in zip([grad_sigmas, grad_rgbs, grad_amb_aud, grad_amb_eye, grad_uncertainty], expected):
+        torch.testing.assert_close(output, torch.tensor(value, dtype=torch.float64))
+
+
+def test_composite_rays_train_triplane_gradcheck(monkeypatch):
+    # through the autograd wrapper, pinned to the pytorch kernels.
+    monkeypatch.setattr(_backend, 'module', torch_backend)
+
+    sigmas, rgbs, amb_aud, amb_eye, uncertainty, deltas, rays = _train_points(seed=2)
+    inputs = [x.requires_grad_() for x in (sigmas, rgbs, amb_aud, amb_eye, uncertainty)]
+
+    def composite(*inputs):
+        weights_sum, amb_aud_sum, amb_eye_sum, uncertainty_sum, depth, image = raymarching.composite_rays_train_triplane(*inputs, deltas, rays, 1e-2)
+        # the backward does not propagate depth.
+        return weights_sum, amb_aud_sum, amb_eye_sum, uncertainty_sum, image
+
+    assert torch.autograd.gradcheck(composite, inputs)
+
+
+def test_composite_rays_triplane():
+    T_thresh, N, n_step = 1e-2, 12, 6
+    g = torch.Generator().manual_seed(0)
+
+    # second round of compositing: the alive rays already hold some weight.
+    rays_alive = torch.randperm(N, generator=g)[:8].int()
+    n_alive = rays_alive.shape[0]
+    P = n_alive * n_step
+    rays_t = torch.rand(N, generator=g, dtype=torch.float64)
+    # weights_sum, depth, image, amb_aud_sum, amb_eye_sum, uncertainty_sum
+    state = [torch.rand(N, generator=g, dtype=torch.float64) * 0.5, torch.rand(N, generator=g, dtype=torch.float64), torch.rand(N, 3, generator=g, dtype=torch.float64)] + [torch.rand(N, generator=g, dtype=torch.float64) for _ in range(3)]
+
+    sigmas = torch.rand(P, generator=g, dtype=torch.float64) * 20
+    rgbs = torch.rand(P, 3, generator=g, dtype=torch.float64)
+    ambs_aud = torch.rand(P, generator=g, dtype=torch.float64)
+    ambs_eye = torch.rand(P, generator=g, dtype=torch.float64)
+    uncertainties = torch.rand(P, generator=g, dtype=torch.float64)
+    deltas = torch.stack([torch.rand(P, generator=g, dtype=torch.float64) * 0.1 + 0.01, torch.rand(P, generator=g, dtype=torch.float64) * 4], -1)
+    # rays that left the bound while marching, their remaining steps have delta == 0.
+    deltas.view(n_alive, n_step, 2)[[1, 4], 3:] = 0
+    sigmas.view(n_alive, n_step)[2] = 0.01
+
+    outputs = [x.clone() for x in state]
+    alive = rays_alive.clone()
+    t = rays_t.clone()
+    torch_backend.composite_rays_triplane(n_alive, n_step, T_thresh, alive, t, sigmas, rgbs, deltas, ambs_aud, ambs_eye, uncertainties, *outputs)
+
+    expected = [x.tolist() for x in state]
+    expected_alive = rays_alive.tolist()
+    expected_t = rays_t.tolist()
+    _naive_composite_infer(n_alive, n_step, T_thresh, expected_alive, expected_t, sigmas.tolist(), rgbs.tolist(), deltas.tolist(), ambs_aud.tolist(), ambs_eye.tolist(), uncertainties.tolist(), *expected)
+
+    for output, value in zip(outputs, expected):
+        torch.testing.assert_close(output, torch.tensor(value, dtype=torch.float64))
+    assert alive.tolist() == expected_alive
+    torch.testing.assert_close(t, torch.tensor(expected_t, dtype=torch.float64))
+
+    # some rays terminate (delta == 0 or T_thresh), ray 2 is kept alive by its low densities.
+    assert -1 in expected_alive and expected_alive[2] != -1
@@ -0,0 +1,66 @@
+''' CPU checks of the spherical harmonics encoder on the pytorch kernels (shencoder/torch_backend.py).
+Run from the repo root: python -m pytest tests
+'''
+
+import math
+
+import pytest
+import torch
+
+from shencoder import SHEncoder
+from shencoder import torch_backend
+from shencoder.backend import _backend
+
+
+@pytest.fixture(autouse=True)
+def pytorch_kernels(monkeypatch):
+    monkeypatch.setattr(_backend, 'module', torch_backend)
+
+
+def _directions(B=64, seed=0):
+    torch.manual_seed(seed)
+    d = torch.randn(B, 3, dtype=torch.float64)
+    return d / d.norm(dim=-1, keepdim=True)
+
+
+def _closed_form(d):
+    # real spherical harmonics of degree 0 to 2 (l < 2), with the Condon-Shortley phase, in the order m = -l .. l.
+    x, y, z = d.unbind(-1)
+    c0 = 0.5 * math.sqrt(1 / math.pi)
+    c1 = math.sqrt(3 / (4 * math.pi))
+    c2 = 0.5 * math.sqrt(15 / math.pi)
+    c20 = 0.25 * math.sqrt(5 / math.pi)
+    return torch.stack([
+        torch.full_like(x, c0),
+        -c1 * y, c1 * z, -c1 * x,
+        c2 * x * y, -c2 * y * z, c20 * (3 * z * z - 1), -c2 * x * z, 0.5 * c2 * (x * x - y * y),
+    ], -1)
+
+
+@pytest.mark.parametrize('degree', [1, 2])
+def test_closed_form(degree):
+    d = _directions()
+    y = SHEncoder(degree=degree)(d)
+    assert torch.allclose(y, _closed_form(d)[:, :degree ** 2], atol=1e-12)
+
+
+@pytest.mark.parametrize('degree', [1, 2])
+def test_dy_dx(degree):
+    # the jacobian written by the forward kernel against autograd through the closed form.
+    d = _directions()
+    B, C = d.shape[0], degree
+    outputs = torch.empty(B, C * C, dtype=d.dtype)
+    dy_dx = torch.empty(B, 3 * C * C, dtype=d.dtype)
+    torch_backend.sh_encode_forward(d, outputs, B, 3, C, dy_dx)
+
+    x = d.clone().requires_grad_(True)
+    sh = _closed_form(x)[:, :C * C]
+    # the first coefficient is constant.
+    expected = torch.stack([torch.zeros_like(d)] + [torch.autograd.grad(sh[:, i].sum(), x, retain_graph=True)[0] for i in range(1, C * C)], -1)
+    assert torch.allclose(dy_dx.view(B, 3, C * C), expected, atol=1e-12)
+
+
+@pytest.mark.parametrize('degree', [1, 2, 4, 8])
+def test_gradcheck(degree):
+    d = _directions(16).requires_grad_(True)
+    assert torch.autograd.gradcheck(SHEncoder(degree=degree), (d,))